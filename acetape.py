@@ -0,0 +1,131 @@
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# Jupiter Ace ROM cassette timings. All pulse lengths are in Z80 T-states
+# of the 3.25MHz Ace clock. A bit is written as two pulses of equal length.
+#
+########################################################################
+
+ACE_CLOCK_HZ = 3250000
+
+PILOT_PULSE = 2011
+SYNC1_PULSE = 601
+SYNC2_PULSE = 791
+ZERO_PULSE = 795
+ONE_PULSE = 1585
+
+HEADER_PILOT_PULSES = 8192
+DATA_PILOT_PULSES = 1024
+
+HEADER_FLAG = 0x00
+DATA_FLAG = 0xff
+
+
+def tstates_to_seconds(tstates):
+  return tstates / ACE_CLOCK_HZ
+
+
+def seconds_to_tstates(seconds):
+  return seconds * ACE_CLOCK_HZ
+
+
+class Timings(object):
+  """Pulse lengths, in T-states, and pilot tone lengths used to write blocks."""
+  def __init__(self,
+               pilot = PILOT_PULSE,
+               sync1 = SYNC1_PULSE,
+               sync2 = SYNC2_PULSE,
+               zero = ZERO_PULSE,
+               one = ONE_PULSE,
+               header_pilot_pulses = HEADER_PILOT_PULSES,
+               data_pilot_pulses = DATA_PILOT_PULSES):
+    self.__pilot = pilot
+    self.__sync1 = sync1
+    self.__sync2 = sync2
+    self.__zero = zero
+    self.__one = one
+    self.__header_pilot_pulses = header_pilot_pulses
+    self.__data_pilot_pulses = data_pilot_pulses
+
+  @property
+  def pilot(self):
+    return self.__pilot
+
+  @property
+  def sync1(self):
+    return self.__sync1
+
+  @property
+  def sync2(self):
+    return self.__sync2
+
+  @property
+  def zero(self):
+    return self.__zero
+
+  @property
+  def one(self):
+    return self.__one
+
+  def pilot_pulses(self, block):
+    return self.__header_pilot_pulses if block[0] == HEADER_FLAG else self.__data_pilot_pulses
+
+  def scaled(self, factor, min_pilot_pulses = 256):
+    """Returns the timings with pulses and pilot tones shortened by factor."""
+    return Timings(*[int(round(pulse / factor)) for pulse in (self.__pilot, self.__sync1, self.__sync2,
+                                                               self.__zero, self.__one)],
+                   header_pilot_pulses = max(min_pilot_pulses, int(self.__header_pilot_pulses / factor)),
+                   data_pilot_pulses = max(min_pilot_pulses, int(self.__data_pilot_pulses / factor)))
+
+  def block_tstates(self, block, pilot_pulses = None, used_bits = 8):
+    """Returns the T-states taken to write a block, flag byte included, without its pause."""
+    pilot_pulses = self.pilot_pulses(block) if pilot_pulses is None else pilot_pulses
+    bits = len(block) * 8
+    if used_bits != 8 and block:
+      # Bits are written most significant first, only the top bits of the last byte are used
+      bits -= 8 - used_bits
+      block = bytes(block[:-1]) + bytes([block[-1] & (0xff << (8 - used_bits)) & 0xff])
+    ones = bit_count(block)
+    return pilot_pulses * self.__pilot + self.__sync1 + self.__sync2 + \
+      2 * (ones * self.__one + (bits - ones) * self.__zero)
+
+
+STANDARD_TIMINGS = Timings()
+
+# Time the ROM takes to check a header before it listens for the data pilot
+HEADER_PROCESSING_TSTATES = 32500
+
+
+def bit_count(data):
+  """Returns the number of set bits in a bytes-like object."""
+  return bin(int.from_bytes(bytes(data), 'big')).count('1')
+
+
+def pause_tstates(pause_ms):
+  return seconds_to_tstates(pause_ms / 1000)
+
+
+def min_header_pause_ms():
+  """Returns the shortest pause, in ms, to write between a header and its data block."""
+  return max(1, -(-HEADER_PROCESSING_TSTATES * 1000 // ACE_CLOCK_HZ))
@@ -22,10 +22,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 ########################################################################
-import argparse
 import os
 import sys
 
+import tapautorun
+import tapstats
+
+
+CHUNK_SIZE = 4096
+DEFAULT_ORIGIN = 0x4000
+
+BYTE_RUN_MIN = 4
+CELL_RUN_MIN = 3
+BYTE_RUN_WORD = 'C,N'
+CELL_RUN_WORD = ',N'
+
+HEX_CODES = ['%02X C,' % b for b in range(0, 256)]
+DECIMAL_CODES = ['%d C,' % b for b in range(0, 256)]
 
 word_names = dict()
 
@@ -42,25 +55,132 @@ def get_word_name(file_name):
 
 
 def get_file_bytes(fn):
-  with open(fn, 'rb') as f:
-    return f.read()
+  with tapstats.STATS.phase('parse', file = fn), open(fn, 'rb') as f:
+    bytes = f.read()
+  tapstats.STATS.count(bytes = len(bytes), files = 1)
+  return bytes
+
+
+def write_code(bytes, codes, fd = sys.stdout):
+  # Large binaries are written a chunk at a time, rather than building the
+  # whole of the Forth text in memory
+  for idx in range(0, len(bytes), CHUNK_SIZE):
+    if idx:
+      fd.write(' ')
+    with tapstats.STATS.phase('format', offset = idx):
+      code = ' '.join(map(codes.__getitem__, bytes[idx : idx + CHUNK_SIZE]))
+    with tapstats.STATS.phase('write', offset = idx):
+      fd.write(code)
+
+
+def optimized_code(bytes, is_decimal):
+  """Returns the Forth for bytes as a list of items, each one or more words.
+
+  Byte pairs are compiled as cells with , and runs of a repeated byte or
+  cell use the BYTE_RUN_WORD and CELL_RUN_WORD helpers, which must be
+  defined before the items are interpreted. DO ... LOOP is compile only
+  on the Ace, so the loops live in these helpers.
+  """
+  number = (lambda n: '%d' % n) if is_decimal else (lambda n: '%X' % n)
+  cell = lambda v: number(v - 0x10000 if v > 0x7fff else v)
+  items = list()
+  idx = 0
+  length = len(bytes)
+  while idx < length:
+    b = bytes[idx]
+    run = idx + 1
+    while run < length and bytes[run] == b:
+      run += 1
+    if run - idx >= BYTE_RUN_MIN:
+      items.append('%s %s %s' % (number(b), number(run - idx), BYTE_RUN_WORD))
+      idx = run
+      continue
+    if idx + 1 < length:
+      pair = bytes[idx : idx + 2]
+      run = idx + 2
+      while bytes[run : run + 2] == pair:
+        run += 2
+      no_cells = (run - idx) // 2
+      value = int.from_bytes(pair, 'little')
+      if no_cells >= CELL_RUN_MIN:
+        items.append('%s %s %s' % (cell(value), number(no_cells), CELL_RUN_WORD))
+      else:
+        items.append('%s ,' % cell(value))
+        no_cells = 1
+      idx += 2 * no_cells
+    else:
+      items.append((DECIMAL_CODES if is_decimal else HEX_CODES)[b])
+      idx += 1
+  return items
+
+
+def size_report(word_name, bytes, naive_length, items):
+  naive_tokens = 2 * len(bytes)
+  tokens = sum(map(lambda item: item.count(' ') + 1, items))
+  length = sum(map(len, items)) + len(items) - 1 if items else 0
+  print("%s: %d bytes, %d words (%d characters) reduced to %d words (%d characters), %d%%" % \
+        (word_name, len(bytes), naive_tokens, naive_length, tokens, length,
+         100 * length // naive_length if naive_length else 100),
+        file = sys.stderr)
+
+
+def write_items(items, fd = sys.stdout):
+  for idx in range(0, len(items), CHUNK_SIZE):
+    if idx:
+      fd.write(' ')
+    with tapstats.STATS.phase('write', item = idx):
+      fd.write(' '.join(items[idx : idx + CHUNK_SIZE]))
 
 
-def convert(file_names, code_word_name, is_decimal, is_executable, is_definer_output):
+def convert_tap(file_names, directory, force, origin):
+  for file_name in file_names:
+    bytes = get_file_bytes(file_name)
+    word_name = get_word_name(file_name)
+    if origin + len(bytes) > 0x10000:
+      print("[%s] of length %d does not fit in memory at address %d" % (file_name, len(bytes), origin),
+            file = sys.stderr)
+      sys.exit(1)
+    tap_filename = os.path.join(directory, "%s.tap" % word_name.lower()[:8])
+    if not force and os.path.exists(tap_filename):
+      print("TAP file [%s] exists. Ignoring [%s]..." % (tap_filename, file_name), file = sys.stderr)
+      continue
+    with tapstats.STATS.phase('format', file = tap_filename):
+      hdr_block = tapautorun.HeaderTapBlock(word_name[:10], origin)
+      data_block = tapautorun.BytesTapBlock(bytes)
+    with tapstats.STATS.phase('write', file = tap_filename), open(tap_filename, 'wb') as tap_fd:
+      hdr_block.write_data(tap_fd, data_block)
+      data_block.write_data(tap_fd)
+    tapstats.STATS.count(blocks = 2)
+
+
+def convert(file_names, code_word_name, is_decimal, is_executable, is_definer_output, is_optimized = False):
   bytes_word_name_pairs = map(lambda fn: (get_file_bytes(fn), get_word_name(fn)), file_names)
+  if is_optimized:
+    codes = DECIMAL_CODES if is_decimal else HEX_CODES
+    with tapstats.STATS.phase('format'):
+      bytes_word_name_pairs = list(map(lambda bw: (bw[0], bw[1], optimized_code(bw[0], is_decimal)),
+                                       bytes_word_name_pairs))
+    for bytes, word_name, items in bytes_word_name_pairs:
+      size_report(word_name, bytes, sum(map(lambda b: len(codes[b]) + 1, bytes)) - 1, items)
+    all_items = [item for _, _, items in bytes_word_name_pairs for item in items]
+    if any(map(lambda item: item.endswith(' ' + BYTE_RUN_WORD), all_items)):
+      print(': %s 0 DO DUP C, LOOP DROP ;\n' % BYTE_RUN_WORD)
+    if any(map(lambda item: item.endswith(' ' + CELL_RUN_WORD), all_items)):
+      print(': %s 0 DO DUP , LOOP DROP ;\n' % CELL_RUN_WORD)
   if is_definer_output and not is_executable:
     print('DEFINER %s\nDOES>\n\tCALL\n;\n' % code_word_name)
   if not is_decimal:
     print('16 BASE C!\n')
 
-  for bytes, word_name in bytes_word_name_pairs:
+  for bytes, word_name, *items in bytes_word_name_pairs:
     if is_executable:
       print("CREATE %s " % word_name, end = '')
     else:
       print("%s %s " % (code_word_name, word_name), end = '')
-    format = ('%d' if is_decimal else '%02X') + ' C,'
-    code = ' '.join(map(lambda b: format  % b, bytes))
-    print(code, end = '')
+    if is_optimized:
+      write_items(items[0])
+    else:
+      write_code(bytes, DECIMAL_CODES if is_decimal else HEX_CODES)
     if is_executable:
       print(" %s DUP 2- !" % word_name, end = '\n\n')
     else:
@@ -70,12 +190,14 @@ def convert(file_names, code_word_name, is_decimal, is_executable, is_definer_ou
     print('DECIMAL\n')
 
 
-if __name__ == '__main__':
+def main(argv = None, prog = "bin2forth.py"):
+  import argparse
+
   __VERSION = '1.0.0'
 
   code_word_default = 'CODE'
   
-  parser = argparse.ArgumentParser(prog = "bin2foth.py",
+  parser = argparse.ArgumentParser(prog = prog,
                                    description = "Create Forth words from machine code binary files (v%s)." % __VERSION)
   parser.add_argument('-c', '--codeword',
                       type = str,
@@ -94,10 +216,43 @@ if __name__ == '__main__':
                       action = 'store_true',
                       dest = 'is_definer_output',
                       help = 'Output the DEFINER code word')
+  parser.add_argument('-O', '--optimize',
+                      action = 'store_true',
+                      dest = 'is_optimized',
+                      help = 'Minimise the number of Forth words the Ace interprets, reporting the saving')
+  parser.add_argument('-t', '--tap',
+                      action = 'store_true',
+                      dest = 'is_tap_output',
+                      help = 'Write a bytes TAP file for each binary file instead of Forth source')
+  parser.add_argument('-a', '--address',
+                      type = lambda s: int(s, 0),
+                      dest = 'origin',
+                      default = DEFAULT_ORIGIN,
+                      help = 'Address at which a bytes TAP file is loaded (default: %d)' % DEFAULT_ORIGIN)
+  parser.add_argument('--directory',
+                      type = str,
+                      dest = 'directory',
+                      default = os.path.curdir,
+                      help = 'Directory to which TAP files are written (default: %s)' % os.path.curdir)
+  parser.add_argument('-f', '--force',
+                      action = 'store_true',
+                      dest = 'force',
+                      help = 'Overwrite TAP files that exist')
   parser.add_argument('bin_file',
                       nargs = '+',
                       type = str,
                       help = 'Z80 binary file')
-  args = parser.parse_args()
+  tapstats.add_arguments(parser)
+  args = parser.parse_args(argv)
+  tapstats.start(args)
+
+  if args.is_tap_output:
+    convert_tap(args.bin_file, args.directory, args.force, args.origin)
+  else:
+    convert(args.bin_file, args.code_word_name, args.is_decimal, args.is_executable, args.is_definer_output,
+            args.is_optimized)
+  return True
+
 
-  convert(args.bin_file, args.code_word_name, args.is_decimal, args.is_executable, args.is_definer_output)
+if __name__ == '__main__':
+  sys.exit(not main())
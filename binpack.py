@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import array
+import os
+import sys
+
+import tapautorun
+
+
+MIN_MATCH = 3
+MAX_MATCH = 0x7f + MIN_MATCH
+MAX_LITERALS = 0x7f
+MAX_OFFSET = 0xffff
+MAX_CHAIN = 64
+DEFAULT_ORIGIN = 0x4000
+
+# Packed stream, read by DEPACKER:
+#   0x00                       end of stream
+#   0x01-0x7f, bytes           literal run of 1 to 127 bytes
+#   0x80-0xff, offset (16 bit) copy (n & 0x7f) + 3 bytes from offset bytes back
+DEPACKER = bytes([0x7e,              # loop:  ld a,(hl)
+                  0x23,              #        inc hl
+                  0x87,              #        add a,a
+                  0x38, 0x09,        #        jr c,match
+                  0xc8,              #        ret z
+                  0x0f,              #        rrca
+                  0x4f,              #        ld c,a
+                  0x06, 0x00,        #        ld b,0
+                  0xed, 0xb0,        #        ldir
+                  0x18, 0xf2,        #        jr loop
+                  0x0f,              # match: rrca
+                  0xc6, MIN_MATCH,   #        add a,3
+                  0x4f,              #        ld c,a
+                  0x06, 0x00,        #        ld b,0
+                  0x7e,              #        ld a,(hl)
+                  0x23,              #        inc hl
+                  0xe5,              #        push hl
+                  0x66,              #        ld h,(hl)
+                  0x6f,              #        ld l,a
+                  0xd5,              #        push de
+                  0xeb,              #        ex de,hl
+                  0xb7,              #        or a
+                  0xed, 0x52,        #        sbc hl,de
+                  0xd1,              #        pop de
+                  0xed, 0xb0,        #        ldir
+                  0xe1,              #        pop hl
+                  0x23,              #        inc hl
+                  0x18, 0xdb])       #        jr loop
+STUB_LENGTH = 12
+
+
+class PackException(Exception):
+  pass
+
+
+def compress(data):
+  """LZ compresses data, returning the packed stream and the minimum gap.
+
+  The gap is how far the packed stream must start above the unpacked data
+  for the depacker to unpack in place without overwriting unread input.
+  """
+  length = len(data)
+  head = dict()
+  prev = array.array('l', [-1]) * length
+  packed = bytearray()
+  literals = bytearray()
+  gap = 0
+
+  def insert(pos):
+    key = data[pos : pos + MIN_MATCH]
+    prev[pos] = head.get(key, -1)
+    head[key] = pos
+
+  def flush_literals():
+    nonlocal literals
+    for idx in range(0, len(literals), MAX_LITERALS):
+      run = literals[idx : idx + MAX_LITERALS]
+      packed.append(len(run))
+      packed.extend(run)
+    literals = bytearray()
+
+  idx = 0
+  while idx < length:
+    best_length = 0
+    best_offset = 0
+    if idx + MIN_MATCH <= length:
+      max_length = min(MAX_MATCH, length - idx)
+      candidate = head.get(data[idx : idx + MIN_MATCH], -1)
+      chain = MAX_CHAIN
+      while candidate >= 0 and idx - candidate <= MAX_OFFSET and chain:
+        if data[candidate + best_length : candidate + best_length + 1] == data[idx + best_length : idx + best_length + 1]:
+          match_length = MIN_MATCH
+          while match_length < max_length and data[candidate + match_length] == data[idx + match_length]:
+            match_length += 1
+          if match_length > best_length:
+            best_length = match_length
+            best_offset = idx - candidate
+            if match_length == max_length:
+              break
+        candidate = prev[candidate]
+        chain -= 1
+    if best_length >= MIN_MATCH:
+      flush_literals()
+      packed.append(0x80 | (best_length - MIN_MATCH))
+      packed.extend(best_offset.to_bytes(2, 'little'))
+      for pos in range(idx, min(idx + best_length, length - MIN_MATCH + 1)):
+        insert(pos)
+      idx += best_length
+    else:
+      if idx + MIN_MATCH <= length:
+        insert(idx)
+      literals.append(data[idx])
+      idx += 1
+      if len(literals) < MAX_LITERALS:
+        continue
+    # Both pointers are at token boundaries, the output must not pass the input
+    flush_literals()
+    gap = max(gap, idx - len(packed))
+  flush_literals()
+  packed.append(0x00)
+  gap = max(gap, length - len(packed))
+  return bytes(packed), gap
+
+
+def pack(data, origin, exec_addr):
+  """Returns the load address, the call address and the bytes to load.
+
+  The bytes are the packed stream followed by the stub, which unpacks the
+  stream to origin and jumps to exec_addr, or returns to Forth if
+  exec_addr is None.
+  """
+  packed, gap = compress(data)
+  load_addr = origin + gap
+  stub_addr = load_addr + len(packed)
+  depacker_addr = stub_addr + STUB_LENGTH
+  code = bytes([0x21]) + load_addr.to_bytes(2, 'little') + \
+    bytes([0x11]) + origin.to_bytes(2, 'little') + \
+    bytes([0xcd]) + depacker_addr.to_bytes(2, 'little')
+  if exec_addr is None:
+    code += bytes([0xfd, 0xe9, 0x00])
+  else:
+    code += bytes([0xc3]) + exec_addr.to_bytes(2, 'little')
+  code += DEPACKER
+  if stub_addr + len(code) > 0x10000:
+    raise PackException("Packed code does not fit in memory, it needs %d bytes from address %d" % \
+                        (stub_addr + len(code) - load_addr, load_addr))
+  return load_addr, stub_addr, packed + code
+
+
+def binpack(bin_file, tap_dir, force, origin, exec_addr, autorun_name):
+  with open(bin_file, 'rb') as bin_fd:
+    data = bin_fd.read()
+  name = os.path.splitext(os.path.basename(bin_file))[0].lower()[:8]
+  tap_filename = os.path.join(tap_dir, "%s.tap" % name)
+  if os.path.exists(tap_filename) and not force:
+    print("TAP file [%s] exists" % tap_filename, file = sys.stderr)
+    sys.exit(1)
+
+  try:
+    load_addr, call_addr, code = pack(data, origin, exec_addr)
+  except PackException as ex:
+    print("%s: %s" % (bin_file, ex), file = sys.stderr)
+    sys.exit(1)
+  print("%s: %d bytes packed to %d bytes, loaded at %d, unpacked to %d" % \
+        (bin_file, len(data), len(code), load_addr, origin), file = sys.stderr)
+
+  hdr_block = tapautorun.HeaderTapBlock(name, load_addr)
+  data_block = tapautorun.BytesTapBlock(code)
+  with open(tap_filename, 'wb') as tap_fd:
+    hdr_block.write_data(tap_fd, data_block)
+    data_block.write_data(tap_fd)
+
+  if autorun_name:
+    tapautorun.autorun(autorun_name, tap_dir, force, "0 0 bload %s %d call" % (name, call_addr))
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_autorun_name = "exec"
+
+  parser = argparse.ArgumentParser(prog = "binpack.py",
+                                   description = "Create a compressed, self unpacking, machine code TAP file (v%s)." % __VERSION)
+  parser.add_argument('-a', '--address',
+                      type = lambda s: int(s, 0),
+                      dest = 'origin',
+                      default = DEFAULT_ORIGIN,
+                      help = 'Address to which the machine code is unpacked (default: %d)' % DEFAULT_ORIGIN)
+  parser.add_argument('-e', '--exec',
+                      type = lambda s: int(s, 0),
+                      dest = 'exec_addr',
+                      help = 'Address jumped to once unpacked (default: the unpack address)')
+  parser.add_argument('-n', '--noexec',
+                      dest = 'is_no_exec',
+                      action = 'store_true',
+                      help = 'Return to Forth once unpacked')
+  parser.add_argument('-t', '--tapname',
+                      type = str,
+                      dest = 'autorun_name',
+                      default = default_autorun_name,
+                      help = 'Name of the generated auto-run TAP file (default: %s)' % default_autorun_name)
+  parser.add_argument('--noautorun',
+                      dest = 'is_no_autorun',
+                      action = 'store_true',
+                      help = 'Do not generate an auto-run TAP file')
+  parser.add_argument('-d', '--directory',
+                      type = str,
+                      dest = 'tap_dir',
+                      default = os.path.curdir,
+                      help = 'Directory that the TAP files are written (default: %s)' % os.path.curdir)
+  parser.add_argument('-f', '--force',
+                      dest = 'force',
+                      action = 'store_true',
+                      help = 'Overwrite generated TAP files if they exist')
+  parser.add_argument('bin_file',
+                      type = str,
+                      help = 'Z80 binary file')
+  args = parser.parse_args()
+
+  exec_addr = None if args.is_no_exec else (args.exec_addr if args.exec_addr is not None else args.origin)
+  binpack(args.bin_file, args.tap_dir, args.force, args.origin, exec_addr,
+          None if args.is_no_autorun else args.autorun_name)
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# A batch file has a command per line, as it would follow jesterace.py on
+# the command line. Blank lines and lines starting with # are ignored:
+#
+#   tzx2tap -d card -f FireOne-091.tzx
+#   forth -d src card/FIREONE-/FIRE.TAP
+#   autorun -d card/FIREONE- -f load fire
+#
+########################################################################
+import importlib
+import shlex
+import sys
+
+
+# Subcommand: (module, description). Modules are imported when their
+# subcommand is run, so each run only pays for the utilities it uses.
+COMMANDS = {
+  'tzx2tap': ('tzx2tap', "Convert TZX files to TAP files"),
+  'split': ('tapsplit', "Split multi-program TAP files"),
+  'tzx': ('tap2tzx', "Convert TAP files to a TZX file"),
+  'ls': ('tapls', "List the contents of TAP files"),
+  'forth': ('tap2forth', "Decompile Forth TAP files"),
+  'autorun': ('tapautorun', "Create auto-run TAP files"),
+  'bin2forth': ('bin2forth', "Create Forth words from machine code binary files"),
+}
+
+
+class CommandException(Exception):
+  pass
+
+
+def run(argv):
+  """Runs a subcommand and its arguments, returns True if it succeeded."""
+  if not argv:
+    raise CommandException("No command")
+  try:
+    module_name = COMMANDS[argv[0]][0]
+  except KeyError:
+    raise CommandException("Unknown command [%s], one of: %s" % (argv[0], ', '.join(COMMANDS)))
+  module = importlib.import_module(module_name)
+  return module.main(argv[1:], "jesterace.py %s" % argv[0])
+
+
+def batch_commands(batch_file):
+  """Yields (line number, argv) for the commands in a batch file."""
+  with open(batch_file, 'r') as batch_fd:
+    for line_no, line in enumerate(batch_fd, 1):
+      argv = shlex.split(line, comments = True)
+      if argv:
+        yield (line_no, argv)
+
+
+def run_batch(batch_file):
+  """Runs every command in a batch file in this process, returns True if all succeeded."""
+  no_commands = 0
+  no_failed = 0
+  for line_no, argv in batch_commands(batch_file):
+    no_commands += 1
+    try:
+      rc = run(argv)
+    except SystemExit as ex:
+      # argparse, and some of the utilities, exit on an error
+      rc = ex.code in (None, 0, False)
+    except Exception as ex:
+      print("[%s] line %d: %s" % (batch_file, line_no, ex), file = sys.stderr)
+      rc = False
+    finally:
+      # Words decompiled by one command must not be found by the next
+      tap2forth = sys.modules.get('tap2forth')
+      if tap2forth:
+        tap2forth.FORTH_WORDS.reset()
+    if not rc:
+      print("[%s] line %d failed: %s" % (batch_file, line_no, shlex.join(argv)), file = sys.stderr)
+      no_failed += 1
+  print("%d commands, %d failed" % (no_commands, no_failed), file = sys.stderr)
+  return no_failed == 0
+
+
+if __name__ == '__main__':
+  import argparse
+
+  import tapstats
+
+  __VERSION = "1.0.0"
+
+  parser = argparse.ArgumentParser(prog = "jesterace.py",
+                                   description = "Jester Ace utilities, run as subcommands or from a batch file (v%s)." % __VERSION,
+                                   epilog = "Commands: %s" % '; '.join("%s: %s" % (command, description) \
+                                                                       for command, (_, description) in COMMANDS.items()))
+  parser.add_argument('-b', '--batch',
+                      type = str,
+                      dest = 'batch_file',
+                      help = "Run the commands in a batch file, one per line, in a single process")
+  tapstats.add_arguments(parser)
+  parser.add_argument('command',
+                      nargs = '?',
+                      choices = COMMANDS.keys(),
+                      help = "Command to run")
+  parser.add_argument('arguments',
+                      nargs = argparse.REMAINDER,
+                      help = "Arguments of the command, see jesterace.py COMMAND -h")
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  if args.batch_file:
+    if args.command:
+      parser.error("a command cannot be given with --batch")
+    try:
+      rc = run_batch(args.batch_file)
+    except (CommandException, OSError, ValueError) as ex:
+      print("Batch [%s]: %s" % (args.batch_file, ex), file = sys.stderr)
+      rc = False
+  elif args.command:
+    rc = run([args.command] + args.arguments)
+  else:
+    parser.error("a command or --batch is required")
+  sys.exit(not rc)
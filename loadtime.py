@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import os
+import sys
+
+import acetape
+import tap2tzx
+import tapfiles
+import tapprogram
+import tapstats
+import tzx2tap
+
+
+def tzx_block_seconds(block):
+  """Returns the time to load a TZX data block, its pause included."""
+  if isinstance(block, tzx2tap.TZXTurboSpeedDataBlock):
+    timings = acetape.Timings(block.pilot_pulse, block.sync1_pulse, block.sync2_pulse,
+                              block.zero_pulse, block.one_pulse)
+    tstates = timings.block_tstates(block.block_data, block.pilot_pulses, block.used_bits)
+  else:
+    tstates = acetape.STANDARD_TIMINGS.block_tstates(block.block_data)
+  return acetape.tstates_to_seconds(tstates + acetape.pause_tstates(block.pause))
+
+
+def tap_load_times(tap_fd, block_delay):
+  """Yields (name, header seconds, data seconds) for each program in a TAP stream.
+
+  TAP files hold no timings, they are loaded at standard speed with a pause
+  of block_delay ms after each block.
+  """
+  for program in tap2tzx.tap_programs(tap_fd):
+    yield (program.name,) + tuple(tap2tzx.program_load_seconds(program, block_delay))
+
+
+def tzx_load_times(tzx_fd, tzx_file = None):
+  """Yields (name, header seconds, data seconds) for each program in a TZX stream."""
+  for tzx_hdr, tzx_data in tzx2tap.tzx_block_pairs(tzx_fd, tzx_file):
+    yield (tapprogram.Program(tzx_hdr.block_data, tzx_data.block_data).name,
+           tzx_block_seconds(tzx_hdr), tzx_block_seconds(tzx_data))
+
+
+def file_load_times(tape_file, block_delay):
+  """Returns [(name, header seconds, data seconds), ...] for the programs in a TAP or TZX file."""
+  with tapstats.STATS.phase('file', file = tape_file), open(tape_file, 'rb') as tape_fd:
+    if os.path.splitext(tape_file)[1].lower() == '.tzx':
+      load_times = list(tzx_load_times(tape_fd, tape_file))
+    else:
+      load_times = list(tap_load_times(tape_fd, block_delay))
+    tapstats.STATS.count(bytes = tape_fd.tell(), blocks = 2 * len(load_times), files = 1)
+  return load_times
+
+
+def format_seconds(seconds):
+  return "%d:%05.2f" % (seconds // 60, seconds % 60)
+
+
+def load_time_report(paths, block_delay, no_slowest, fd = sys.stdout):
+  rc = True
+  programs = list()
+  total_seconds = 0
+  no_files = 0
+  for tape_file in tapfiles.tape_files(paths):
+    try:
+      load_times = file_load_times(tape_file, block_delay)
+    except (tzx2tap.TZXFileException, OSError) as ex:
+      print(ex, file = sys.stderr)
+      rc = False
+      continue
+    except tap2tzx.BlockDataExhausted:
+      print("Missing data block in %s" % tape_file, file = sys.stderr)
+      rc = False
+      continue
+    except (tapprogram.BlockDataTruncated, tap2tzx.BlockDataCorruption) as ex:
+      print("%s: %s" % (tape_file, ex), file = sys.stderr)
+      rc = False
+      continue
+    no_files += 1
+    file_seconds = 0
+    print(tape_file, file = fd)
+    for name, hdr_seconds, data_seconds in load_times:
+      print("  %-10s  header %s  data %s  total %s" % (name, format_seconds(hdr_seconds),
+                                                       format_seconds(data_seconds),
+                                                       format_seconds(hdr_seconds + data_seconds)),
+            file = fd)
+      file_seconds += hdr_seconds + data_seconds
+      programs.append((hdr_seconds + data_seconds, name, tape_file))
+    print("  %d programs, %s" % (len(load_times), format_seconds(file_seconds)), file = fd)
+    total_seconds += file_seconds
+
+  print("%d files, %d programs, total load time %s" % (no_files, len(programs), format_seconds(total_seconds)),
+        file = fd)
+  if no_slowest and programs:
+    print("Slowest programs:", file = fd)
+    for seconds, name, tape_file in sorted(programs, reverse = True)[:no_slowest]:
+      print("  %s  %-10s  %s" % (format_seconds(seconds), name, tape_file), file = fd)
+  return rc
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_delay_ms = 100
+  default_slowest = 10
+
+  parser = argparse.ArgumentParser(prog = "loadtime.py",
+                                   description = "Estimate the time a Jupiter Ace takes to load TAP and TZX files (v%s)." % __VERSION)
+  parser.add_argument('-d', '--delay',
+                      type = int,
+                      dest = 'delay',
+                      default = default_delay_ms,
+                      help = "Pause, in ms, after each TAP file block (default: %dms)" % default_delay_ms)
+  parser.add_argument('-s', '--slowest',
+                      type = int,
+                      dest = 'slowest',
+                      default = default_slowest,
+                      help = "Number of slowest programs to list, 0 for none (default: %d)" % default_slowest)
+  parser.add_argument('paths',
+                      nargs = '+',
+                      type = str,
+                      help = "TAP and TZX files, or directories to search for them")
+  tapstats.add_arguments(parser)
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  rc = load_time_report(args.paths, args.delay, args.slowest)
+  sys.exit(not rc)
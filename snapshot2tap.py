@@ -0,0 +1,190 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import mmap
+import os
+import sys
+
+import tapprogram
+import tapstats
+
+
+# .ace snapshots are a run length encoded dump of memory from 0x2000. A run
+# is written as ED, count, byte and the dump ends with ED 00.
+SNAPSHOT_ORIGIN = 0x2000
+MEMORY_SIZE = 0x10000
+RLE_MARKER = 0xed
+
+# System variables
+CURRENT = 0x3c31
+CONTEXT = 0x3c33
+VOCLNK = 0x3c35
+STKBOT = 0x3c37
+# The FORTH vocabulary, its name length field and the link to its newest word
+FORTH_NAME_LENGTH = 0x3c49
+FORTH_LATEST = tapprogram.FORTH_LATEST
+DICTIONARY_ORIGIN = tapprogram.DICTIONARY_ORIGIN
+
+
+class SnapshotFormatException(Exception):
+  def __init__(self, ace_file, reason):
+    super(SnapshotFormatException, self).__init__()
+    self.ace_file = os.path.realpath(ace_file)
+    self.reason = reason
+
+  def __str__(self):
+    return "[%s] %s" % (self.ace_file, self.reason)
+
+
+def rle_decode(snapshot, ace_file = "<memory>"):
+  """Returns the 64K memory image held in a .ace snapshot."""
+  memory = bytearray(MEMORY_SIZE)
+  addr = SNAPSHOT_ORIGIN
+  idx = 0
+  end = len(snapshot)
+  while idx < end:
+    # Copy the literal bytes up to the next marker in one go
+    marker = snapshot.find(b'\xed', idx)
+    if marker < 0:
+      marker = end
+    if marker > idx:
+      if addr + marker - idx > MEMORY_SIZE:
+        raise SnapshotFormatException(ace_file, "decompresses to more than 64K at offset %d" % idx)
+      memory[addr : addr + marker - idx] = snapshot[idx : marker]
+      addr += marker - idx
+      idx = marker
+    if idx == end:
+      break
+    if idx + 1 >= end:
+      raise SnapshotFormatException(ace_file, "is truncated at offset %d" % idx)
+    count = snapshot[idx + 1]
+    if count == 0:
+      return memory
+    if idx + 2 >= end:
+      raise SnapshotFormatException(ace_file, "is truncated at offset %d" % idx)
+    if addr + count > MEMORY_SIZE:
+      raise SnapshotFormatException(ace_file, "decompresses to more than 64K at offset %d" % idx)
+    memory[addr : addr + count] = bytes([snapshot[idx + 2]]) * count
+    addr += count
+    idx += 3
+  return memory
+
+
+def word16(memory, addr):
+  return memory[addr] | (memory[addr + 1] << 8)
+
+
+def dictionary_words(memory, ace_file = "<memory>"):
+  """Returns the name length field addresses of the FORTH vocabulary words, newest first."""
+  dictionary_end = word16(memory, STKBOT)
+  words = list()
+  link = word16(memory, FORTH_LATEST)
+  while link != FORTH_NAME_LENGTH:
+    # Words are linked to older words, so links always go down in memory
+    if not DICTIONARY_ORIGIN <= link < dictionary_end or (words and link >= words[-1]):
+      raise SnapshotFormatException(ace_file, "has a corrupt dictionary link 0x%.4x" % link)
+    words.append(link)
+    link = word16(memory, link - 2)
+  return words
+
+
+def snapshot_program(name, memory, ace_file = "<memory>"):
+  """Returns the user dictionary of a memory image as a v2 Forth TAP program."""
+  dictionary_end = word16(memory, STKBOT)
+  if not DICTIONARY_ORIGIN < dictionary_end <= MEMORY_SIZE:
+    raise SnapshotFormatException(ace_file, "has an invalid dictionary end 0x%.4x" % dictionary_end)
+  if not dictionary_words(memory, ace_file):
+    raise SnapshotFormatException(ace_file, "has no user dictionary")
+  return tapprogram.dictionary_program(name, bytes(memory[DICTIONARY_ORIGIN : dictionary_end]),
+                                       *[word16(memory, addr) for addr in (FORTH_LATEST, CURRENT, CONTEXT, VOCLNK)])
+
+
+def snapshot_tap_bytes(name, snapshot, ace_file = "<memory>"):
+  """Returns the user dictionary of the .ace snapshot bytes as a TAP file."""
+  with tapstats.STATS.phase('parse', file = ace_file):
+    memory = rle_decode(snapshot, ace_file)
+  with tapstats.STATS.phase('format', file = ace_file):
+    return snapshot_program(name, memory, ace_file).tap_bytes
+
+
+def snapshot_to_tap(ace_file, tap_dir, force):
+  tap_name = os.path.splitext(os.path.basename(ace_file))[0].lower()
+  tap_file = os.path.join(tap_dir, tap_name + '.tap')
+  if not force and os.path.exists(tap_file):
+    print("TAP file [%s] exists. Ignoring [%s]..." % (tap_file, ace_file), file = sys.stderr)
+    return True
+
+  with tapstats.STATS.phase('file', file = ace_file), open(ace_file, 'rb') as ace_fd:
+    if os.fstat(ace_fd.fileno()).st_size == 0:
+      raise SnapshotFormatException(ace_file, "is empty")
+    with mmap.mmap(ace_fd.fileno(), 0, access = mmap.ACCESS_READ) as snapshot:
+      tap_bytes = snapshot_tap_bytes(tap_name, snapshot, ace_file)
+      tapstats.STATS.count(bytes = len(snapshot), blocks = 2, files = 1)
+  with tapstats.STATS.phase('write', file = tap_file), open(tap_file, 'wb') as tap_fd:
+    tap_fd.write(tap_bytes)
+  return True
+
+
+def snapshots_to_tap(ace_files, tap_dir, force):
+  if not os.path.exists(tap_dir):
+    print("Directory [%s] does not exist" % tap_dir, file = sys.stderr)
+    return False
+
+  rc = True
+  for ace_file in ace_files:
+    try:
+      snapshot_to_tap(ace_file, tap_dir, force)
+    except (SnapshotFormatException, OSError) as ex:
+      print(ex, file = sys.stderr)
+      rc = False
+  return rc
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_tap_dir = os.path.curdir
+
+  parser = argparse.ArgumentParser(prog = "snapshot2tap.py",
+                                   description = "Extract the Forth dictionary from Jupiter Ace .ace snapshots (v%s)." % __VERSION)
+  parser.add_argument('-d', '--directory',
+                      type = str,
+                      dest = 'directory',
+                      default = default_tap_dir,
+                      help = "Directory to which TAP files are written (default: %s)" % default_tap_dir)
+  parser.add_argument('-f', '--force',
+                      dest = 'force',
+                      action = 'store_true',
+                      help = "Overwrite TAP files if they exist")
+  parser.add_argument('ace_files',
+                      nargs = '+',
+                      type = str,
+                      help = ".ace snapshot files")
+  tapstats.add_arguments(parser)
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  rc = snapshots_to_tap(args.ace_files, os.path.realpath(args.directory), args.force)
+  sys.exit(not rc)
@@ -22,12 +22,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 ########################################################################
+import array
 import functools
 import os
 import sys
 
-
-FORTH_WORDS = dict()
+import tapprogram
+import tapstats
+import z80dis
 
 
 class Formatter(object):
@@ -45,7 +47,8 @@ class Formatter(object):
       self.flush()
 
   def flush(self, end = ''):
-    print(self.__buffer, end = end, file = self.__fd)
+    with tapstats.STATS.phase('write'):
+      print(self.__buffer, end = end, file = self.__fd)
     self.__buffer = ""
 
   def __enter__(self):
@@ -55,7 +58,29 @@ class Formatter(object):
     self.flush()
 
 
+def block_cells(data):
+  """Returns (even, odd) arrays of the 16 bit little endian values at the even and odd offsets of data.
+
+  The value at offset is cells[offset & 1][offset >> 1], read without a
+  slice or a new int for each value.
+  """
+  even = array.array('H', data[: len(data) & ~1])
+  odd = array.array('H', data[1 : 1 + ((len(data) - 1) & ~1)])
+  if sys.byteorder == 'big':
+    even.byteswap()
+    odd.byteswap()
+  return (even, odd)
+
+
+def next_cell(word_parameters, idx):
+  return idx + 2
+
+
 class Word(object):
+  # Dictionaries have thousands of words, slots keep each one small
+  __slots__ = ('name', 'exec_addr', 'code_addr', 'parameters', 'length', '__is_immediate', '__processor',
+               '__new_idx', '__cells', '__offset')
+
   def __init__(self,
                name_field,
                name_length,
@@ -64,7 +89,9 @@ class Word(object):
                code_addr_field,
                parameters,
                processor = None,
-               new_idx = None):
+               new_idx = None,
+               cells = None,
+               offset = 0):
     self.name = name_field
     self.exec_addr = word_exec_addr
     self.code_addr = code_addr_field
@@ -72,7 +99,22 @@ class Word(object):
     self.length = word_length
     self.__is_immediate = (name_length & 0x40) == 0x40
     self.__processor = processor
-    self.__new_idx = new_idx if new_idx else lambda _, idx: idx + 2
+    self.__new_idx = new_idx if new_idx else next_cell
+    # block_cells() of the block holding the parameters, at offset in it
+    self.__cells = cells
+    self.__offset = offset
+
+  @property
+  def cells(self):
+    """Returns (block_cells() of the block holding the parameters, offset of the parameters in it)."""
+    return (self.__cells, self.__offset)
+
+  def cell(self, idx):
+    """Returns the 16 bit value at a parameter offset."""
+    if self.__cells is None:
+      return int.from_bytes(self.parameters[idx : idx + 2], "little")
+    offset = self.__offset + idx
+    return self.__cells[offset & 1][offset >> 1]
 
   @property
   def has_processor(self):
@@ -92,15 +134,20 @@ class Word(object):
     return self.name
 
   def __repr__(self):
-    return "<Word: %s, 0x%.4x, %s>" % (self.name, self.code_addr, self.parameters)
+    return "<Word: %s, 0x%.4x, %s>" % (self.name, self.code_addr,
+                                       bytes(self.parameters) if self.parameters is not None else None)
 
 
 class InternalWord(Word):
+  __slots__ = ()
+
   def __init__(self, name = None, processor = None, new_idx = None):
     super(InternalWord, self).__init__(name, 0, 0, None, None, None, processor, new_idx)
 
 
 class DefinitionWord(InternalWord):
+  __slots__ = ('__definition',)
+
   def __init__(self, definition):
     super(DefinitionWord, self).__init__()
     self.__definition = definition
@@ -110,42 +157,41 @@ class DefinitionWord(InternalWord):
 
 
 # Words that don't need a processor
-for addr, word_name in [(0x0099, "QUIT"), (0x00ab, "ABORT"), (0x0460, "HERE"), (0x0473, "CONTEXT"),
-                        (0x0480, "CURRENT"), (0x048a, "BASE"), (0x0499, "PAD"), (0x4b6, "\n;\n"),
-                        (0x0506, "LINE"), (0x058c, "QUERY"), (0x0578, "RETYPE"), (0x05ab, "WORD"),
-                        (0x062d, "VLIST"), (0x063d, "FIND"), (0x069a, "EXECUTE"), (0x098d, "<#"),
-                        (0x09f7, "#"), (0x06a9, "NUMBER"), (0x078a, "CONVERT"), (0x0818, "VIS"),
-                        (0x0828, "INVIS"), (0x0837, "FAST"), (0x0846, "SLOW"), (0x086b, "DUP"),
-                        (0x0879, "DROP"), (0x0885, "SWAP"), (0x0896, "C@"), (0x08a5, "C!"),
-                        (0x08b3, "@"), (0x08c1, "!"), (0x08d2, ">R"), (0x08df, "R>"),
-                        (0x08ee, "?DUP"), (0x08ff, "ROT"), (0x0912, "OVER"), (0x0925, "PICK"),
-                        (0x0933, "ROLL"), (0x096e, "TYPE"), (0x098D, "<#"), (0x099c, "#>"),
-                        (0x0a4a, "SIGN"), (0x09b3, "."), (0x09d0, "U."), (0x09e1, "#S"),
-                        (0x09f7, "#"), (0x0a1d, "CLS"), (0x0a5c, "HOLD"), (0x0a73, "SPACE"),
-                        (0x0a83, "SPACES"), (0x0a95, "CR"), (0x0aa3, "EMIT"), (0x0aaf, "F."),
-                        (0x0b19, "AT"), (0x0b4a, "PLOT"), (0x0b98, "BEEP"), (0x0bdb, "INKEY"),
-                        (0x0beb, "IN"), (0x0bfd, "OUT"), (0x0c0d, "ABS"), (0x0c1a, "0="),
-                        (0x0c2e, "0<"), (0x0c3a, "0>"), (0x0c4a, "="), (0x0c56, ">"),
-                        (0x0c65, "<"), (0x0c72, "U<"), (0x0c83, "D<"), (0x0ca8, "U*"),
-                        (0x0d00, "/MOD"), (0x0d31, "*/MOD"), (0x0d51, "/"), (0x0d61, "MOD"),
-                        (0x0d6d, "*"), (0x0d7a, "*/"), (0x0d8c, "U/MOD"), (0x0da9, "NEGATE"),
-                        (0x0dba, "DNEGATE"), (0x0dd2, "+"), (0x0de1, "-"), (0x0dee, "D+"),
-                        (0x0e09, "1+"), (0x0e13, "2+"), (0x0e1f, "1-"), (0x0e29, "2-"),
-                        (0x0e36, "OR"), (0x0e4b, "AND"), (0x0e60, "XOR"), (0x0e75, "MAX"),
-                        (0x0e87, "MIN"), (0x0ea3, "DECIMAL"), (0x0ed0, "CREATE"),
-                        (0x0f4e, ","), (0x0f5f, "C,"), (0x0f76, "ALLOT"),
-                        (0x0fcf, "VARIABLE"), (0x0fe2, "CONSTANT"), (0x10a7, "CALL"),
-                        (0x117d, "VOCABULARY"), (0x11ab, "DEFINITIONS"), (0x12e9, "I"),
-                        (0x12f7, "I'"), (0x1302, "J"), (0x1316, "LEAVE"),
-                        (0x12a4, "\nTHEN\n"), (0x129f, "\nBEGIN\n"),
-                        (0x1323, "\nDO\n"),
-                        (0x1361, "("), (0x13f0, "EXIT"),
-                        (0x13fd, "REDEFINE"), (0x1638, "FORGET"), (0x165e, "EDIT"), (0x1670, "LIST"),
-                        (0x1934, "SAVE"), (0x1944, "BSAVE"), (0x1954, "BLOAD"), (0x1967, "VERIFY"),
-                        (0x1979, "BVERIFY"), (0x198a, "LOAD"), (0x1ba4, "F-"), (0x1bb1, "F+"),
-                        (0x1c4b, "F*"), (0x1c7b, "F/"), (0x1d0f, "FNEGATE"), (0x1d22, "INT"),
-                        (0x1d59, "UFLOAT"), (0x3c4a, "FORTH")]:
-  FORTH_WORDS[addr] = InternalWord(word_name)
+ROM_WORD_NAMES = [(0x0099, "QUIT"), (0x00ab, "ABORT"), (0x0460, "HERE"), (0x0473, "CONTEXT"),
+                  (0x0480, "CURRENT"), (0x048a, "BASE"), (0x0499, "PAD"), (0x4b6, "\n;\n"),
+                  (0x0506, "LINE"), (0x058c, "QUERY"), (0x0578, "RETYPE"), (0x05ab, "WORD"),
+                  (0x062d, "VLIST"), (0x063d, "FIND"), (0x069a, "EXECUTE"), (0x098d, "<#"),
+                  (0x09f7, "#"), (0x06a9, "NUMBER"), (0x078a, "CONVERT"), (0x0818, "VIS"),
+                  (0x0828, "INVIS"), (0x0837, "FAST"), (0x0846, "SLOW"), (0x086b, "DUP"),
+                  (0x0879, "DROP"), (0x0885, "SWAP"), (0x0896, "C@"), (0x08a5, "C!"),
+                  (0x08b3, "@"), (0x08c1, "!"), (0x08d2, ">R"), (0x08df, "R>"),
+                  (0x08ee, "?DUP"), (0x08ff, "ROT"), (0x0912, "OVER"), (0x0925, "PICK"),
+                  (0x0933, "ROLL"), (0x096e, "TYPE"), (0x098D, "<#"), (0x099c, "#>"),
+                  (0x0a4a, "SIGN"), (0x09b3, "."), (0x09d0, "U."), (0x09e1, "#S"),
+                  (0x09f7, "#"), (0x0a1d, "CLS"), (0x0a5c, "HOLD"), (0x0a73, "SPACE"),
+                  (0x0a83, "SPACES"), (0x0a95, "CR"), (0x0aa3, "EMIT"), (0x0aaf, "F."),
+                  (0x0b19, "AT"), (0x0b4a, "PLOT"), (0x0b98, "BEEP"), (0x0bdb, "INKEY"),
+                  (0x0beb, "IN"), (0x0bfd, "OUT"), (0x0c0d, "ABS"), (0x0c1a, "0="),
+                  (0x0c2e, "0<"), (0x0c3a, "0>"), (0x0c4a, "="), (0x0c56, ">"),
+                  (0x0c65, "<"), (0x0c72, "U<"), (0x0c83, "D<"), (0x0ca8, "U*"),
+                  (0x0d00, "/MOD"), (0x0d31, "*/MOD"), (0x0d51, "/"), (0x0d61, "MOD"),
+                  (0x0d6d, "*"), (0x0d7a, "*/"), (0x0d8c, "U/MOD"), (0x0da9, "NEGATE"),
+                  (0x0dba, "DNEGATE"), (0x0dd2, "+"), (0x0de1, "-"), (0x0dee, "D+"),
+                  (0x0e09, "1+"), (0x0e13, "2+"), (0x0e1f, "1-"), (0x0e29, "2-"),
+                  (0x0e36, "OR"), (0x0e4b, "AND"), (0x0e60, "XOR"), (0x0e75, "MAX"),
+                  (0x0e87, "MIN"), (0x0ea3, "DECIMAL"), (0x0ed0, "CREATE"),
+                  (0x0f4e, ","), (0x0f5f, "C,"), (0x0f76, "ALLOT"),
+                  (0x0fcf, "VARIABLE"), (0x0fe2, "CONSTANT"), (0x10a7, "CALL"),
+                  (0x117d, "VOCABULARY"), (0x11ab, "DEFINITIONS"), (0x12e9, "I"),
+                  (0x12f7, "I'"), (0x1302, "J"), (0x1316, "LEAVE"),
+                  (0x12a4, "\nTHEN\n"), (0x129f, "\nBEGIN\n"),
+                  (0x1323, "\nDO\n"),
+                  (0x1361, "("), (0x13f0, "EXIT"),
+                  (0x13fd, "REDEFINE"), (0x1638, "FORGET"), (0x165e, "EDIT"), (0x1670, "LIST"),
+                  (0x1934, "SAVE"), (0x1944, "BSAVE"), (0x1954, "BLOAD"), (0x1967, "VERIFY"),
+                  (0x1979, "BVERIFY"), (0x198a, "LOAD"), (0x1ba4, "F-"), (0x1bb1, "F+"),
+                  (0x1c4b, "F*"), (0x1c7b, "F/"), (0x1d0f, "FNEGATE"), (0x1d22, "INT"),
+                  (0x1d59, "UFLOAT"), (0x3c4a, "FORTH")]
 
 def sixteen_bit_integer_processor(number_bytes):
   orig_num = int.from_bytes(number_bytes, "little")
@@ -157,24 +203,28 @@ def sixteen_bit_integer_processor(number_bytes):
     return "%d" % orig_num
 
 # Definition words
-FORTH_WORDS[0x0ec3] = DefinitionWord(lambda wn, _, wp: (": %s" % wn, 0))
-FORTH_WORDS[0x0fec] = DefinitionWord(lambda wn, _, wp: ("CREATE %s %d ALLOT" % (wn, len(wp)),
-                                                        len(wp)) if len(wp) > 152 else \
-                                     ("( May be CREATE %s %d ALLOT )\nCREATE %s %s" % \
-                                      (wn, len(wp), wn, ' '.join(map(lambda b: '%d c,' % b, wp))), len(wp)))
-FORTH_WORDS[0x0ff0] = DefinitionWord(lambda wn, _, wp: ("%s VARIABLE %s" % (sixteen_bit_integer_processor(wp[0 : 2]), wn), len(wp)))
-FORTH_WORDS[0x0ff5] = DefinitionWord(lambda wn, _, wp: ("%s CONSTANT %s" % (sixteen_bit_integer_processor(wp[0 : 2]) , wn), len(wp)))
+CREATE_WORD = DefinitionWord(lambda wn, _, wp: ("CREATE %s %d ALLOT" % (wn, len(wp)),
+                                                len(wp)) if len(wp) > 152 else \
+                             ("( May be CREATE %s %d ALLOT )\nCREATE %s %s" % \
+                              (wn, len(wp), wn, ' '.join(map(lambda b: '%d c,' % b, wp))), len(wp)))
 def definer_definition(word_name, _, word_parameters):
   def_word = DefinitionWord(lambda wn, _, wp: ('%s %s %s' % (word_name, wn, ' '.join(map(lambda b: '%d c,' % b, wp))), len(wp)))
   FORTH_WORDS[int.from_bytes(word_parameters[0 : 2], "little")] = def_word
   return ("DEFINER %s" % word_name, 2)
-FORTH_WORDS[0x1085] = DefinitionWord(definer_definition)
 def compiler_definition(word_name, word_addr, word_parameters):
   first_runs_word_addr = int.from_bytes(word_parameters[0 : 2], "little")
   offset = first_runs_word_addr - (word_addr + len(word_name) + 10)
   no_words = word_parameters[offset]
   return ("%d COMPILER %s" % (no_words, word_name), 2)
-FORTH_WORDS[0x1108] = DefinitionWord(compiler_definition)
+# Words created with CREATE whose code field points at their own parameter field
+MACHINE_CODE_WORD = DefinitionWord(lambda wn, _, wp: ("CREATE %s %s %s DUP 2- !" % \
+                                                      (wn, ' '.join(map(lambda b: '%d c,' % b, wp)), wn), len(wp)))
+
+# Z80 disassembly as Forth comments, which cannot contain parentheses
+DISASSEMBLY_BRACKETS = str.maketrans("()", "[]")
+def disassembly_comment(code, addr):
+  return ''.join("( %.4x %s )\n" % (instruction_addr, text.translate(DISASSEMBLY_BRACKETS)) \
+                 for instruction_addr, _, text in z80dis.disassemble(code, addr))
 
 def char_processor(b):
   if (b >= 0x01 and b <= 0x0c) or (b >= 0x0e and b <= 0x0f) or \
@@ -188,12 +238,6 @@ def char_processor(b):
   else:
     return "%c" % (b & 0x7f)
 
-# Stack next 16 bit word
-FORTH_WORDS[0x1011] = InternalWord(processor = lambda wp, idx: sixteen_bit_integer_processor(wp[idx + 2 : idx + 4]),
-                                   new_idx = lambda p, idx: idx + 4)
-FORTH_WORDS[0x104b] = InternalWord("ASCII",
-                                   lambda p, idx: char_processor(p[idx + 2]),
-                                   lambda p, idx: idx + 3)
 # Floating point numbers
 def floating_point_processor(word_parameters, idx):
   high_nibble = lambda b: (b & 0xf0) >> 4
@@ -209,31 +253,90 @@ def floating_point_processor(word_parameters, idx):
                                     high_nibble(one[0]), low_nibble(one[0]),
                                     exp_str))
   return str(fp)
-FORTH_WORDS[0x1064] = InternalWord(processor = floating_point_processor, new_idx = lambda p, idx: idx + 6)
-FORTH_WORDS[0x10e8] = InternalWord("DOES>\n", new_idx = lambda p, idx: idx + 7)
-FORTH_WORDS[0x1140] = InternalWord("\nRUNS>\n",new_idx = lambda p, idx: idx + 7)
-FORTH_WORDS[0x1271] = InternalWord("\nELSE\n", new_idx = lambda p, idx: idx + 4)
-FORTH_WORDS[0x1276] = InternalWord("REPEAT\n", new_idx = lambda p, idx: idx + 4)
-FORTH_WORDS[0x1283] = InternalWord("IF\n", new_idx = lambda p, idx: idx + 4)
-FORTH_WORDS[0x1288] = InternalWord("\nWHILE\n", new_idx = lambda p, idx: idx + 4)
-FORTH_WORDS[0x128d] = InternalWord("\nUNTIL\n", new_idx = lambda p, idx: idx + 4)
-FORTH_WORDS[0x1332] = InternalWord("\nLOOP\n", new_idx = lambda p, idx: idx + 4)
-FORTH_WORDS[0x133c] = InternalWord("\n+LOOP\n", new_idx = lambda p, idx: idx + 4)
 def comment_processor(word_parameters, idx):
   comment_length = int.from_bytes(word_parameters[idx + 2 : idx + 4], "little")
   comment_bytes = word_parameters[idx + 4 : idx + 4 + comment_length]
   comment_string = functools.reduce(lambda acc, b: acc + ("%c" % (b & 0x7f)), comment_bytes, "")
   return "( %s )\n" % comment_string
-FORTH_WORDS[0x1379] = InternalWord(processor = comment_processor,
-                                   new_idx = lambda p, idx: idx + 4 + int.from_bytes(p[idx + 2 : idx + 4], "little"))
 def string_processor(word_parameters, idx):
   string_length = int.from_bytes(word_parameters[idx + 2 : idx + 4], "little")
   string_bytes = word_parameters[idx + 4 : idx + 4 + string_length]
   string = functools.reduce(lambda acc, b: acc + char_processor(b), string_bytes, "")
   return string + '"'
-FORTH_WORDS[0x1396] = InternalWord('."',
-                                   string_processor,
-                                   lambda p, idx: idx + 4 + int.from_bytes(p[idx + 2 : idx + 4], "little"))
+
+def rom_words():
+  """Returns the words of the ROM by execution address."""
+  words = {addr: InternalWord(word_name) for addr, word_name in ROM_WORD_NAMES}
+  # Definition words
+  words[0x0ec3] = DefinitionWord(lambda wn, _, wp: (": %s" % wn, 0))
+  words[0x0fec] = CREATE_WORD
+  words[0x0ff0] = DefinitionWord(lambda wn, _, wp: ("%s VARIABLE %s" % (sixteen_bit_integer_processor(wp[0 : 2]), wn), len(wp)))
+  words[0x0ff5] = DefinitionWord(lambda wn, _, wp: ("%s CONSTANT %s" % (sixteen_bit_integer_processor(wp[0 : 2]) , wn), len(wp)))
+  words[0x1085] = DefinitionWord(definer_definition)
+  words[0x1108] = DefinitionWord(compiler_definition)
+  # Stack next 16 bit word
+  words[0x1011] = InternalWord(processor = lambda wp, idx: sixteen_bit_integer_processor(wp[idx + 2 : idx + 4]),
+                               new_idx = lambda p, idx: idx + 4)
+  words[0x104b] = InternalWord("ASCII",
+                               lambda p, idx: char_processor(p[idx + 2]),
+                               lambda p, idx: idx + 3)
+  words[0x1064] = InternalWord(processor = floating_point_processor, new_idx = lambda p, idx: idx + 6)
+  words[0x10e8] = InternalWord("DOES>\n", new_idx = lambda p, idx: idx + 7)
+  words[0x1140] = InternalWord("\nRUNS>\n",new_idx = lambda p, idx: idx + 7)
+  words[0x1271] = InternalWord("\nELSE\n", new_idx = lambda p, idx: idx + 4)
+  words[0x1276] = InternalWord("REPEAT\n", new_idx = lambda p, idx: idx + 4)
+  words[0x1283] = InternalWord("IF\n", new_idx = lambda p, idx: idx + 4)
+  words[0x1288] = InternalWord("\nWHILE\n", new_idx = lambda p, idx: idx + 4)
+  words[0x128d] = InternalWord("\nUNTIL\n", new_idx = lambda p, idx: idx + 4)
+  words[0x1332] = InternalWord("\nLOOP\n", new_idx = lambda p, idx: idx + 4)
+  words[0x133c] = InternalWord("\n+LOOP\n", new_idx = lambda p, idx: idx + 4)
+  words[0x1379] = InternalWord(processor = comment_processor,
+                               new_idx = lambda p, idx: idx + 4 + int.from_bytes(p[idx + 2 : idx + 4], "little"))
+  words[0x1396] = InternalWord('."',
+                               string_processor,
+                               lambda p, idx: idx + 4 + int.from_bytes(p[idx + 2 : idx + 4], "little"))
+  return words
+
+
+class ForthWords(dict):
+  """The words known to the decompiler by execution address.
+
+  The ROM words are only built on the first lookup of a word that is not
+  known, so importing the module, for --help or another utility, does not
+  build them.
+  """
+  def __init__(self):
+    super(ForthWords, self).__init__()
+    self.__is_rom_loaded = False
+
+  def __missing__(self, addr):
+    if self.__is_rom_loaded:
+      raise KeyError(addr)
+    self.__is_rom_loaded = True
+    for rom_addr, word in rom_words().items():
+      self.setdefault(rom_addr, word)
+    return self[addr]
+
+  def reset(self):
+    """Forgets the words of the dictionaries decompiled so far."""
+    self.clear()
+    self.__is_rom_loaded = False
+
+
+FORTH_WORDS = ForthWords()
+
+# Definitions whose parameters are compiled words, and the offset of the first word
+THREAD_OFFSETS = {0x0ec3: 0, 0x1085: 2, 0x1108: 2}
+def thread_cells(word_parameters, idx = 0):
+  """Yields the parameter offset of each compiled word of a definition."""
+  while idx < len(word_parameters):
+    yield idx
+    command = int.from_bytes(word_parameters[idx : idx + 2], "little")
+    try:
+      command_word = FORTH_WORDS[command]
+    except KeyError as ex:
+      raise KeyError("Unknown word 0x%.4x at parameter offset %d" % (command, idx))
+    idx = command_word.get_new_idx(word_parameters, idx)
 
 
 class BlockDataExhausted(Exception):
@@ -250,11 +353,17 @@ class BlockDataNotSupportedType(Exception):
 
 class TapBlock(object):
   def __init__(self, tap_file):
+    pos = tap_file.tell()
     block_length_bytes = tap_file.read(2)
     self.__block_length = int.from_bytes(block_length_bytes, "little")
-    self._data = tap_file.read(self.__block_length)
-    if not self._data or len(self._data) != self.__block_length:
+    if not self.__block_length:
       raise BlockDataExhausted
+    remaining = tapprogram.remaining_length(tap_file)
+    if len(block_length_bytes) != 2 or (remaining is not None and self.__block_length > remaining):
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, remaining if remaining is not None else 0)
+    self._data = tap_file.read(self.__block_length)
+    if len(self._data) != self.__block_length:
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, len(self._data))
 
   @property
   def length(self):
@@ -262,7 +371,8 @@ class TapBlock(object):
 
   def verify_checksum(self, is_v2):
     slice = self._data[1:-1] if is_v2 else self._data[:-1]
-    self._checksum = functools.reduce(lambda acc, b: acc ^ b, slice, 0)
+    with tapstats.STATS.phase('checksum'):
+      self._checksum = functools.reduce(lambda acc, b: acc ^ b, slice, 0)
     if self._checksum != self._data[-1]:
       raise BlockDataCorruption("Block checksum 0x%x, expected 0x%x" % (self._data[-1], self._checksum))
 
@@ -279,11 +389,30 @@ class HeaderBlock(TapBlock):
   def is_v2_tap_file(self):
     return self.__is_v2_tap
 
+  def __field(self, offset):
+    # offset is that of a v2 header, v1 headers have no flag byte
+    offset = offset if self.is_v2_tap_file else offset - 1
+    return int.from_bytes(self._data[offset : offset + 2], "little")
+
   @property
   def origin(self):
-    slice = self._data[14:16] if self.is_v2_tap_file else self._data[13:15]
-    origin = int.from_bytes(slice, "little")
-    return origin
+    return self.__field(14)
+
+  @property
+  def latest(self):
+    return self.__field(16)
+
+  @property
+  def current(self):
+    return self.__field(18)
+
+  @property
+  def context(self):
+    return self.__field(20)
+
+  @property
+  def voclnk(self):
+    return self.__field(22)
 
 
 class DataBlock(TapBlock):
@@ -292,53 +421,79 @@ class DataBlock(TapBlock):
     self.__is_v2_tap = is_v2
     self.verify_checksum(self.__is_v2_tap)
 
-  def decompile(self, origin, formatter = None):
+  @property
+  def contents(self):
+    return self._data[1:-1] if self.__is_v2_tap else self._data[:-1]
+
+  def decompile(self, origin, formatter = None, is_disassembled = False):
+    with tapstats.STATS.phase('decompile'):
+      words = self.words(origin)
+    with tapstats.STATS.phase('format'):
+      self.format(words, origin, formatter, is_disassembled)
+
+  def words(self, origin):
     words = list()
+    # The words' parameters are views of the block, and their cells are
+    # read from arrays of the whole block, rather than copied word by word
+    data = memoryview(self._data)
+    cells = block_cells(self._data)
+    even, odd = cells
     idx = 1 if self.__is_v2_tap else 0
-    while idx < len(self._data) - 1:
+    while idx < len(data) - 1:
       # Extract name
-      name = ''
-      b = self._data[idx]
-      while True:
+      name_start = idx
+      while data[idx] < 128:
         idx += 1
-        name += '%c' % (b & 0x7f)
-        if b >= 128:
-          break
-        b = self._data[idx]
+      idx += 1
+      name = bytes(b & 0x7f for b in data[name_start : idx]).decode('ascii')
       # Word length
-      word_length = int.from_bytes(self._data[idx : idx + 2], "little")
+      word_length = (odd if idx & 1 else even)[idx >> 1]
+      if word_length < 7 or idx + word_length > len(data) - 1:
+        raise BlockDataCorruption("Word [%s] at offset %d has invalid length %d" % (name, idx, word_length))
       idx += 2
       word_exec_addr = origin + idx + 1
       # Previous word
-      link_addr = int.from_bytes(self._data[idx : idx + 2], "little")
       idx += 2
-      word_name_length = self._data[idx]
+      word_name_length = data[idx]
       idx += 1
-      code_addr_field = int.from_bytes(self._data[idx : idx + 2], "little")
+      code_addr_field = (odd if idx & 1 else even)[idx >> 1]
       idx += 2
-      parameters = self._data[idx : idx + (word_length - 7)]
-      idx += (word_length - 7)
+      parameters = data[idx : idx + (word_length - 7)]
       word_exec_addr = word_exec_addr + 1 if self.__is_v2_tap else word_exec_addr + 2
-      word = Word(name, word_name_length, word_length, word_exec_addr, code_addr_field, parameters)
+      word = Word(name, word_name_length, word_length, word_exec_addr, code_addr_field, parameters,
+                  cells = cells, offset = idx)
+      idx += (word_length - 7)
       FORTH_WORDS[word.exec_addr] = word
       words.append(word)
+    return words
 
+  def format(self, words, origin, formatter, is_disassembled = False):
     with formatter:
       addr = origin
       for word in words:
         idx = 0
         parameters = word.parameters
 
-        try:
-          code_word = FORTH_WORDS[word.code_addr]
-        except KeyError as ex:
-          raise KeyError("Unknown word 0x%.4x at offset %d" % (word.code_addr, addr - origin))
+        if word.code_addr == word.exec_addr + 2:
+          code_word = MACHINE_CODE_WORD
+        else:
+          try:
+            code_word = FORTH_WORDS[word.code_addr]
+          except KeyError as ex:
+            raise KeyError("Unknown word 0x%.4x at offset %d" % (word.code_addr, addr - origin))
         assert isinstance(code_word, DefinitionWord) == True, "Word [%s] is not a defintion" % code_word
         definition, idx = code_word.definition(word.name, addr, word.parameters)
         formatter.add("\n%s\n" % definition)
-
-        while idx < len(word.parameters):
-          command = int.from_bytes(parameters[idx : idx + 2], "little")
+        if is_disassembled and (code_word is MACHINE_CODE_WORD or \
+                                (code_word is CREATE_WORD and not definition.startswith("CREATE"))):
+          with tapstats.STATS.phase('disassemble'):
+            formatter.add(disassembly_comment(word.parameters, word.exec_addr + 2))
+
+        (even, odd), offset = word.cells
+        parameters_length = len(parameters)
+        while idx < parameters_length:
+          cell_offset = offset + idx
+          command = (odd if cell_offset & 1 else even)[cell_offset >> 1]
           try:
             command_word = FORTH_WORDS[command]
           except KeyError as ex:
@@ -357,25 +512,27 @@ class DataBlock(TapBlock):
         addr += word.length + len(word.name)
 
 
-def decompile(directory, force, tap_files, max_line_size):
+def decompile(directory, force, tap_files, max_line_size, is_disassembled = False):
   if not os.path.exists(directory):
     print("Directory [%s] does not exist" % directory)
     sys.exit(1)
 
   for tap_file in tap_files:
-    with open(tap_file, "rb") as forth_tap_fd:
-      hdr = HeaderBlock(forth_tap_fd)
-      data = DataBlock(forth_tap_fd, hdr.is_v2_tap_file)
+    with tapstats.STATS.phase('file', file = tap_file), open(tap_file, "rb") as forth_tap_fd:
+      with tapstats.STATS.phase('parse', file = tap_file):
+        hdr = HeaderBlock(forth_tap_fd)
+        data = DataBlock(forth_tap_fd, hdr.is_v2_tap_file)
+      tapstats.STATS.count(bytes = hdr.length + data.length + 4, blocks = 2, files = 1)
       forth_name = os.path.splitext(os.path.basename(tap_file))[0].lower()
       forth_filename = os.path.join(directory, forth_name + '.fs')
       if not force and os.path.exists(forth_filename):
         print("Forth file [%s] exists. Ignoring [%s]..." % (forth_filename, tap_file), file = sys.stderr)
         continue
       with open(forth_filename, "w") as forth_fd:
-        data.decompile(hdr.origin, Formatter(max_line_size, forth_fd))
+        data.decompile(hdr.origin, Formatter(max_line_size, forth_fd), is_disassembled)
 
 
-if __name__ == '__main__':
+def main(argv = None, prog = "tap2forth.py"):
   import argparse
 
   __VERSION = "1.0.3"
@@ -384,7 +541,7 @@ if __name__ == '__main__':
   default_tap_dir = os.path.curdir
   default_max_line_size = 80
 
-  parser = argparse.ArgumentParser(prog = "tap2forth.py",
+  parser = argparse.ArgumentParser(prog = prog,
                                    description = "Decompile a Forth TAP file (v%s)." % __VERSION)
   parser.add_argument('-d', '--directory',
                       type = str,
@@ -400,10 +557,21 @@ if __name__ == '__main__':
                       dest = 'max_line_size',
                       default = default_max_line_size,
                       help = 'Maximum number of character per Forth line (default: %d)' % default_max_line_size)
+  parser.add_argument('--disassemble',
+                      dest = 'is_disassembled',
+                      action = 'store_true',
+                      help = 'Add a Z80 disassembly of CREATE and machine code words as comments')
   parser.add_argument('tap_file',
                       nargs = '+',
                       type = str,
                       help = 'Command to autorun')
-  args = parser.parse_args()
+  tapstats.add_arguments(parser)
+  args = parser.parse_args(argv)
+  tapstats.start(args)
+
+  decompile(os.path.realpath(args.directory), args.force, args.tap_file, args.max_line_size, args.is_disassembled)
+  return True
 
-  decompile(os.path.realpath(args.directory), args.force, args.tap_file, args.max_line_size)
+
+if __name__ == '__main__':
+  sys.exit(not main())
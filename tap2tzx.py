@@ -23,24 +23,36 @@
 # SOFTWARE.
 ########################################################################
 import functools
+import io
 import os
 import sys
 
+import acetape
+import tapprogram
+import tapstats
+
 
 class BlockDataExhausted(Exception):
   pass
 
+
 class BlockDataCorruption(Exception):
   pass
 
 
 class TapBlock(object):
   def __init__(self, tap_file):
+    pos = tap_file.tell()
     block_length_bytes = tap_file.read(2)
     self.__block_length = int.from_bytes(block_length_bytes, "little")
-    self.__data = tap_file.read(self.__block_length)
-    if not self.__data or len(self.__data) != self.__block_length:
+    if not self.__block_length:
       raise BlockDataExhausted
+    remaining = tapprogram.remaining_length(tap_file)
+    if len(block_length_bytes) != 2 or (remaining is not None and self.__block_length > remaining):
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, remaining if remaining is not None else 0)
+    self.__data = tap_file.read(self.__block_length)
+    if len(self.__data) != self.__block_length:
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, len(self.__data))
 
   @property
   def length(self):
@@ -55,83 +67,164 @@ class TapBlock(object):
     checksum = functools.reduce(lambda acc, b: acc ^ b, slice, 0)
     return (True, checksum) if checksum == self.__data[-1] else (False, checksum, self.__data[-1])
 
+  @property
+  def data(self):
+    return self.__data
+
   def write_data(self, fd):
     fd.write(self.__data)
 
 
+def tzx_header():
+  return bytes(bytearray("ZXTape!", "utf-8") + bytearray.fromhex("1a0114"))
+
+
 def tzx_header_write(tzx_file):
-  hdr = bytearray("ZXTape!", "utf-8") + bytearray.fromhex("1a0114")
-  tzx_file.write(hdr)
+  tzx_file.write(tzx_header())
+
+
+def tap_programs(tap_file):
+  """Yields a tapprogram.Program for each header/data block pair in a TAP stream."""
+  while(True):
+    try:
+      hdr_block = TapBlock(tap_file)
+    except BlockDataExhausted:
+      break
+    data_block = TapBlock(tap_file)
+    yield tapprogram.Program(hdr_block.data, data_block.data, hdr_block.is_v2_header_block)
+
+
+def program_blocks(program):
+  # Ensure block ID bytes are present in header and data blocks
+  if program.is_v2:
+    return (program.header, program.data)
+  return (bytes([acetape.HEADER_FLAG]) + program.header, bytes([acetape.DATA_FLAG]) + program.data)
+
+
+def block_pauses(block_delay, timings):
+  # Turbo blocks only pause after the header for as long as the ROM needs
+  return (acetape.min_header_pause_ms() if timings else block_delay, block_delay)
+
+
+def tzx_program_bytes(program, block_delay, timings = None):
+  tzx_bytes = bytearray()
+  for block, pause in zip(program_blocks(program), block_pauses(block_delay, timings)):
+    if timings is None:
+      # Standard speed data block
+      tzx_bytes += bytearray.fromhex("10") + int(pause).to_bytes(2, 'little') + len(block).to_bytes(2, 'little')
+    else:
+      # Turbo speed data block
+      tzx_bytes += bytearray.fromhex("11")
+      for value in (timings.pilot, timings.sync1, timings.sync2, timings.zero, timings.one, timings.pilot_pulses(block)):
+        tzx_bytes += int(value).to_bytes(2, 'little')
+      tzx_bytes += bytes([8]) + int(pause).to_bytes(2, 'little') + len(block).to_bytes(3, 'little')
+    tzx_bytes += block
+  return bytes(tzx_bytes)
+
 
+def program_load_seconds(program, block_delay, timings = None):
+  """Returns the time to load the header and data blocks of a program, pauses included."""
+  # Pauses depend on whether the blocks are turbo speed, None is standard speed
+  pauses = block_pauses(block_delay, timings)
+  timings = timings if timings else acetape.STANDARD_TIMINGS
+  return [acetape.tstates_to_seconds(timings.block_tstates(block) + acetape.pause_tstates(pause)) \
+          for block, pause in zip(program_blocks(program), pauses)]
 
-def tap_to_tzx(tap_filenames, tzx_filename, block_delay):
+
+def tap_to_tzx_bytes(taps_bytes, block_delay, timings = None):
+  """Converts the contents of TAP files to the contents of a single TZX file."""
+  tzx = bytearray(tzx_header())
+  for tap_bytes in taps_bytes:
+    for program in tap_programs(io.BytesIO(tap_bytes)):
+      tzx += tzx_program_bytes(program, block_delay, timings)
+  return bytes(tzx)
+
+
+def tap_to_tzx(tap_filenames, tzx_filename, block_delay, timings = None):
+  """Writes the programs of TAP files to a TZX file, returns False if a TAP file is truncated or corrupt."""
+  rc = True
+  load_seconds = [0, 0]
   with open(tzx_filename, 'wb') as tzx_file:
     # Write TZX header
     tzx_header_write(tzx_file)
     # Foreach TAP file...
     for tap_filename in [item for sublist in tap_filenames for item in sublist]:
-      with open(tap_filename, 'rb') as tap_file:
+      with tapstats.STATS.phase('file', file = tap_filename), open(tap_filename, 'rb') as tap_file:
         print(os.path.basename(tap_filename), file = sys.stderr)
-        # Foreach block in the TAP...
+        # Foreach program in the TAP...
+        programs = tap_programs(tap_file)
         while(True):
-          # Header block
           try:
-            hdr_block = TapBlock(tap_file)
+            with tapstats.STATS.phase('parse', file = tap_filename):
+              program = next(programs)
+          except StopIteration:
+            break
           except BlockDataExhausted:
+            print("%s: Missing data block" % tap_filename, file = sys.stderr)
+            rc = False
+            break
+          except tapprogram.BlockDataTruncated as ex:
+            # The programs before the truncated block have been written
+            print("%s: %s" % (tap_filename, ex), file = sys.stderr)
+            rc = False
             break
-          print("  +--> Found header block of length %d bytes" % hdr_block.length,
+
+          if timings:
+            turbo_seconds = program_load_seconds(program, block_delay, timings)
+            standard_seconds = program_load_seconds(program, block_delay)
+          print("  +--> Found header block of length %d bytes" % len(program.header),
                 file = sys.stderr,
                 end = "")
-          is_v2_tap_file = hdr_block.is_v2_header_block
-          valid_chksum = hdr_block.valid_checksum(is_v2_tap_file)
+          with tapstats.STATS.phase('checksum', block = 'header'):
+            valid_chksum = program.header_checksum
           if not valid_chksum[0]:
             print(", CRC ERROR (checksum [%.2x], expected [%.2x])" % (valid_chksum[1], valid_chksum[2]),
                   file = sys.stderr,
                   end = "")
+          if timings:
+            print(", loads in %.2fs (%.2fs at standard speed)" % (turbo_seconds[0], standard_seconds[0]),
+                  file = sys.stderr,
+                  end = "")
           print(file = sys.stderr)
 
-          # Data block expected
-          try:
-            data_block = TapBlock(tap_file)
-          except BlockDataExhausted as ex:
-            print("Missing data block in %s" % tap_filename)
-            raise ex
-          print("  +--> Found data block of length %d bytes" % data_block.length,
+          print("  +--> Found data block of length %d bytes" % len(program.data),
                 file = sys.stderr,
                 end = "")
-          valid_chksum = data_block.valid_checksum(is_v2_tap_file)
+          with tapstats.STATS.phase('checksum', block = 'data'):
+            valid_chksum = program.data_checksum
           if not valid_chksum[0]:
             print(", CRC ERROR (checksum [%.2x], expected [%.2x])" % (valid_chksum[1], valid_chksum[2]),
                   file = sys.stderr,
                   end = "")
+          if timings:
+            print(", loads in %.2fs (%.2fs at standard speed)" % (turbo_seconds[1], standard_seconds[1]),
+                  file = sys.stderr,
+                  end = "")
+            load_seconds[0] += sum(turbo_seconds)
+            load_seconds[1] += sum(standard_seconds)
           print(file = sys.stderr)
 
-          # Ensure block ID bytes are present in header and data blocks
-          hdr_length = hdr_block.length if is_v2_tap_file else hdr_block.length + 1
-          ssdb_hdr = bytearray.fromhex("10") + int(block_delay).to_bytes(2, 'little') + int(hdr_length).to_bytes(2, 'little')
-          if not is_v2_tap_file:
-            ssdb_hdr += bytearray.fromhex("00")
-
-          data_length = data_block.length if is_v2_tap_file else data_block.length + 1
-          ssdb_data = bytearray.fromhex("10") + int(block_delay).to_bytes(2, 'little') + int(data_length).to_bytes(2, 'little')
-          if not is_v2_tap_file:
-            ssdb_data += bytearray.fromhex("ff")
-
           # Write TZX blocks
-          tzx_file.write(ssdb_hdr)
-          hdr_block.write_data(tzx_file)
-          tzx_file.write(ssdb_data)
-          data_block.write_data(tzx_file)
-          
+          with tapstats.STATS.phase('format', program = program.name):
+            tzx_bytes = tzx_program_bytes(program, block_delay, timings)
+          with tapstats.STATS.phase('write', program = program.name):
+            tzx_file.write(tzx_bytes)
+          tapstats.STATS.count(bytes = len(tzx_bytes), blocks = 2)
+        tapstats.STATS.count(files = 1)
+  if timings and load_seconds[0]:
+    print("Total load time %.2fs (%.2fs at standard speed, %.1fx faster)" % \
+          (load_seconds[0], load_seconds[1], load_seconds[1] / load_seconds[0]),
+          file = sys.stderr)
+  return rc
 
 
-if __name__ == '__main__':
+def main(argv = None, prog = "tap2tzx.py"):
   import argparse
 
   __VERSION = "2.0.0"
   default_delay_ms = 100
 
-  parser = argparse.ArgumentParser(prog = "tap2tzx.py",
+  parser = argparse.ArgumentParser(prog = prog,
                                    description = "Converts TAP files to TZX files (v%s)." % __VERSION)
   parser.add_argument('-d', '--delay',
                       type = int,
@@ -143,11 +236,25 @@ if __name__ == '__main__':
                       required = True,
                       dest = 'tzx_output',
                       help = "Output TZX file")
+  parser.add_argument('-t', '--turbo',
+                      type = float,
+                      dest = 'turbo',
+                      help = "Write turbo speed blocks with pulses and pilot tones shortened by this factor, e.g. 2")
   parser.add_argument('tap_file',
                       type = str,
                       action = 'append',
                       nargs = '+',
                       help = "TAP file to add to the TZX file")
-  args = parser.parse_args()
+  tapstats.add_arguments(parser)
+  args = parser.parse_args(argv)
+  tapstats.start(args)
+
+  if args.turbo is not None and args.turbo < 1:
+    print("Turbo factor must be at least 1", file = sys.stderr)
+    return False
+  timings = acetape.STANDARD_TIMINGS.scaled(args.turbo) if args.turbo else None
+  return tap_to_tzx(args.tap_file, args.tzx_output, args.delay, timings)
 
-  tap_to_tzx(args.tap_file, args.tzx_output, args.delay)
+
+if __name__ == '__main__':
+  sys.exit(not main())
@@ -22,12 +22,31 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 ########################################################################
+import csv
 import functools
+import io
+import json
 import os
+import re
 import sys
 
+import tapstats
+
 
 MAX_COMMAND_LEN = 31
+AUTORUN_ORIGIN = 0x22e0
+MAX_TAP_NAME_LEN = 10
+# Words that read the word after them, a file name, from the input buffer
+FILE_NAME_WORDS = ('LOAD', 'BLOAD', 'VERIFY', 'BVERIFY')
+# Words that read text up to a delimiter from the input buffer, and the delimiter
+TEXT_WORDS = {'."': '"', '(': ')', '.(': ')'}
+WORD = re.compile(r'\S+')
+# Ends a chained command, loading the next command into the input buffer
+CHAIN_COMMAND = " 0 0 bload %s"
+
+
+class AutorunException(Exception):
+  pass
 
 
 class TapBlock(object):
@@ -49,12 +68,12 @@ class TapBlock(object):
 
 
 class HeaderTapBlock(TapBlock):
-  def __init__(self, name):
+  def __init__(self, name, origin = AUTORUN_ORIGIN):
     super(HeaderTapBlock, self).__init__()
     self._data += bytes([0x00, 0x20])
     self._data += name.ljust(10).encode('utf-8')
     self._data += bytes([0x00, 0x00])
-    self._data += bytes([0xe0, 0x22])
+    self._data += origin.to_bytes(2, 'little')
     self._data += bytes([0x20, 0x20, 0x20, 0x20, 0x20, 0x20, 0x20, 0x20, 0x20, 0x20])
 
   def write_data(self, fd, data_block):
@@ -75,40 +94,170 @@ class DataTapBlock(TapBlock):
   @property
   def content_length(self):
     return len(self._data) - 2
-    
 
-def autorun(tap_name, tap_dir, force, command):
-  if not os.path.exists(tap_dir):
-    print("Directory [%s] does not exist" % tap_dir, file = sys.stderr)
-    sys.exit(1)
 
-  tap_filename = os.path.join(tap_dir, "%s.tap" % tap_name)
-  if os.path.exists(tap_filename) and not force:
-    print("TAP file [%s] exists" % tap_filename, file = sys.stderr)
-    sys.exit(1)
+class BytesTapBlock(TapBlock):
+  def __init__(self, code):
+    super(BytesTapBlock, self).__init__()
+    self._data += bytes([0xff])
+    self._data += code
+    self._data += self.checksum
+
+  @property
+  def content_length(self):
+    return len(self._data) - 2
+    
 
+def autorun_bytes(tap_name, command):
+  """Returns the contents of an auto-run TAP file."""
   if len(command) > MAX_COMMAND_LEN:
-    print("Command, of length %d, [%s] is too long, %d characters maximum" % \
-          (len(command), command, MAX_COMMAND_LEN))
-    sys.exit(1)
+    raise AutorunException("Command, of length %d, [%s] is too long, %d characters maximum, use -c to chain it" % \
+                           (len(command), command, MAX_COMMAND_LEN))
 
-  hdr_block = HeaderTapBlock(tap_name)
-  data_block = DataTapBlock(command)
+  with tapstats.STATS.phase('format', tap = tap_name):
+    hdr_block = HeaderTapBlock(tap_name)
+    data_block = DataTapBlock(command)
 
-  with open(tap_filename, 'wb') as tap_fd:
+    tap_fd = io.BytesIO()
     hdr_block.write_data(tap_fd, data_block)
     data_block.write_data(tap_fd)
+    return tap_fd.getvalue()
 
 
-if __name__ == '__main__':
+def command_parts(command):
+  """Returns the words of a command that must be in the same chained command.
+
+  A word that reads a file name is kept with the name, and a word that
+  reads text, such as ." or (, is kept with the text up to its delimiter.
+  """
+  parts = list()
+  word = WORD.search(command)
+  while word:
+    end = word.end()
+    if word.group() in TEXT_WORDS:
+      # The text starts after the space that ends the word
+      delimiter = command.find(TEXT_WORDS[word.group()], end + 1)
+      end = len(command) if delimiter < 0 else delimiter + 1
+    elif word.group().upper() in FILE_NAME_WORDS:
+      file_name = WORD.search(command, end)
+      end = file_name.end() if file_name else end
+    parts.append(command[word.start() : end])
+    word = WORD.search(command, end)
+  return parts
+
+
+def chain_tap_name(tap_name, link):
+  suffix = "%d" % link
+  return tap_name[:MAX_TAP_NAME_LEN - len(suffix)] + suffix
+
+
+def chained_commands(tap_name, command):
+  """Returns [(TAP name, command), ...] of auto-run TAP files that together run a command of any length.
+
+  Each command but the last ends by loading the next one into the input
+  buffer, where it is run as if it had been typed. The data stack is kept
+  from one to the next.
+  """
+  parts = command_parts(command)
+  links = list()
+  while True:
+    link_tap_name = chain_tap_name(tap_name, len(links)) if links else tap_name
+    if len(' '.join(parts)) <= MAX_COMMAND_LEN:
+      links.append((link_tap_name, ' '.join(parts)))
+      return links
+    next_command = CHAIN_COMMAND % chain_tap_name(tap_name, len(links) + 1)
+    link_parts = list()
+    while parts and len(' '.join(link_parts + parts[:1])) + len(next_command) <= MAX_COMMAND_LEN:
+      link_parts.append(parts.pop(0))
+    if not link_parts:
+      raise AutorunException("[%s] is too long to chain, %d characters maximum" % \
+                             (parts[0], MAX_COMMAND_LEN - len(next_command)))
+    links.append((link_tap_name, ' '.join(link_parts) + next_command))
+
+
+def autorun_write(tap_name, tap_dir, force, command, is_chained = False):
+  if not os.path.exists(tap_dir):
+    raise AutorunException("Directory [%s] does not exist" % tap_dir)
+
+  links = chained_commands(tap_name, command) if is_chained else [(tap_name, command)]
+  tap_filenames = [os.path.join(tap_dir, "%s.tap" % link_tap_name) for link_tap_name, _ in links]
+  for tap_filename in tap_filenames:
+    if os.path.exists(tap_filename) and not force:
+      raise AutorunException("TAP file [%s] exists" % tap_filename)
+
+  # Every command is checked before any file is written
+  tap_files = [autorun_bytes(link_tap_name, link_command) for link_tap_name, link_command in links]
+  for tap_filename, tap_bytes in zip(tap_filenames, tap_files):
+    with tapstats.STATS.phase('write', file = tap_filename), open(tap_filename, 'wb') as tap_fd:
+      tap_fd.write(tap_bytes)
+    tapstats.STATS.count(bytes = len(tap_bytes), blocks = 2, files = 1)
+
+
+def autorun(tap_name, tap_dir, force, command, is_chained = False):
+  try:
+    autorun_write(tap_name, tap_dir, force, command, is_chained)
+  except AutorunException as ex:
+    print(ex, file = sys.stderr)
+    sys.exit(1)
+
+
+def manifest_entry(entry, default_tap_name):
+  if not isinstance(entry, dict):
+    raise AutorunException("Manifest entry %s is not an object" % json.dumps(entry))
+  for key in ('directory', 'command'):
+    if not isinstance(entry.get(key), str):
+      raise AutorunException("Manifest entry %s does not have a \"%s\"" % (json.dumps(entry), key))
+  return (entry['directory'], entry.get('tapname') or default_tap_name, entry['command'])
+
+
+def manifest_entries(manifest_file, default_tap_name):
+  """Yields (location, entry) from a CSV or JSON manifest.
+
+  The entry is (directory, TAP name, command), or an AutorunException for an
+  entry that cannot be read, so one bad entry does not stop the others.
+  """
+  with open(manifest_file, 'r', newline = '') as manifest_fd:
+    if os.path.splitext(manifest_file)[1].lower() == '.json':
+      for idx, entry in enumerate(json.load(manifest_fd), 1):
+        try:
+          yield ("%s entry %d" % (manifest_file, idx), manifest_entry(entry, default_tap_name))
+        except AutorunException as ex:
+          yield ("%s entry %d" % (manifest_file, idx), ex)
+    else:
+      manifest_csv = csv.reader(manifest_fd)
+      for row in manifest_csv:
+        if not row or row[0].startswith('#') or [c.strip().lower() for c in row] == ['directory', 'tapname', 'command']:
+          continue
+        location = "%s line %d" % (manifest_file, manifest_csv.line_num)
+        if len(row) != 3:
+          yield (location, AutorunException("Manifest row %s does not have 3 columns" % row))
+        else:
+          yield (location, (row[0].strip(), row[1].strip() or default_tap_name, row[2].strip()))
+
+
+def autorun_manifest(manifest_file, default_tap_name, force, is_chained = False):
+  """Writes every auto-run TAP file in a manifest, returns a list of (location, error)."""
+  errors = list()
+  for location, entry in manifest_entries(manifest_file, default_tap_name):
+    if isinstance(entry, AutorunException):
+      errors.append((location, entry))
+      continue
+    try:
+      autorun_write(entry[1], entry[0], force, entry[2], is_chained)
+    except (AutorunException, OSError) as ex:
+      errors.append((os.path.join(entry[0], "%s.tap" % entry[1]), ex))
+  return errors
+
+
+def main(argv = None, prog = "tapautorun.py"):
   import argparse
 
-  __VERSION = "1.0.3"
+  __VERSION = "1.1.0"
 
   default_tap_name = "exec"
   default_tap_dir = os.path.curdir
 
-  parser = argparse.ArgumentParser(prog = "tapautorun.py",
+  parser = argparse.ArgumentParser(prog = prog,
                                    description = "Create autorun TAP file (v%s)." % __VERSION)
   parser.add_argument('-t', '--tapname',
                       type = str,
@@ -124,11 +273,38 @@ if __name__ == '__main__':
                       dest = 'force',
                       action = 'store_true',
                       help = 'Overwrite generated TAP file if it exists')
+  parser.add_argument('-c', '--chain',
+                      dest = 'is_chained',
+                      action = 'store_true',
+                      help = 'Split commands longer than %d characters across auto-run TAP files that load each other' % \
+                             MAX_COMMAND_LEN)
+  parser.add_argument('-m', '--manifest',
+                      type = str,
+                      dest = 'manifest',
+                      help = 'CSV (directory, TAP name, command) or JSON manifest of auto-run TAP files to create')
   parser.add_argument('command',
-                      nargs = '+',
+                      nargs = '*',
                       type = str,
                       help = 'Command to autorun')
-  args = parser.parse_args()
+  tapstats.add_arguments(parser)
+  args = parser.parse_args(argv)
+  tapstats.start(args)
+
+  if args.manifest:
+    try:
+      errors = autorun_manifest(args.manifest, args.tap_name, args.force, args.is_chained)
+    except (AutorunException, OSError, ValueError) as ex:
+      print("Manifest [%s]: %s" % (args.manifest, ex), file = sys.stderr)
+      return False
+    for location, error in errors:
+      print("%s: %s" % (location, error), file = sys.stderr)
+    return not errors
+  elif not args.command:
+    parser.error("a command or a manifest is required")
+
+  autorun(args.tap_name, args.tap_dir, args.force, ' '.join(args.command), args.is_chained)
+  return True
 
-  autorun(args.tap_name, args.tap_dir, args.force, ' '.join(args.command))
-          
+
+if __name__ == '__main__':
+  sys.exit(not main())
@@ -0,0 +1,316 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# The catalog is an SQLite database with a row per TZX file holding its
+# archive info, text descriptions, hardware types, program names and the
+# TAP files tzx2tap.py writes for it. A full text index, using the trigram
+# tokenizer, finds any part of a word in any of them. The index only finds
+# exact text, titles that are misspelt are found by the share of their
+# trigrams they have in common with the title searched for.
+#
+########################################################################
+import os
+import sqlite3
+import sys
+
+import tapfiles
+import tapstats
+import tzx2tap
+
+
+# TZX archive info text identities
+ARCHIVE_FIELDS = {0x00: 'title', 0x01: 'publisher', 0x02: 'author', 0x03: 'year', 0x04: 'language',
+                  0x05: 'type', 0x06: 'price', 0x07: 'loader', 0x08: 'origin', 0xff: 'comment'}
+COLUMNS = ('title', 'publisher', 'author', 'year', 'language', 'type', 'price', 'loader', 'origin', 'comment',
+           'description', 'hardware', 'programs', 'tap_files')
+SEARCH_FIELDS = ('title', 'publisher', 'author', 'year', 'type', 'hardware', 'programs')
+
+HARDWARE_TYPES = {0x00: "computer", 0x01: "storage", 0x02: "ROM/RAM add-on", 0x03: "sound device",
+                  0x04: "joystick", 0x05: "mouse", 0x06: "controller", 0x07: "serial port",
+                  0x08: "parallel port", 0x09: "printer", 0x0a: "modem", 0x0b: "digitizer",
+                  0x0c: "network adapter", 0x0d: "keyboard", 0x0e: "AD/DA converter",
+                  0x0f: "EPROM programmer", 0x10: "graphics"}
+HARDWARE_INFORMATION = {0x00: "runs on", 0x01: "uses", 0x02: "runs on, does not use", 0x03: "does not run on"}
+COMPUTERS = {0x1a: "Jupiter ACE"}
+
+# The trigram tokenizer matches text of at least 3 characters
+MIN_MATCH_LENGTH = 3
+# Share of their trigrams a title and a misspelt title have in common
+MIN_SIMILARITY = 0.3
+
+
+def trigrams(text):
+  """Returns the set of trigrams of the words in text, ignoring case.
+
+  Words are padded with two spaces before and one after, so a short word
+  still has trigrams and the start of a word counts for more than its end.
+  """
+  text_trigrams = set()
+  for word in text.lower().split():
+    word = "  %s " % word
+    text_trigrams.update(word[idx : idx + 3] for idx in range(len(word) - 2))
+  return text_trigrams
+
+
+def similarity(text_trigrams, other_text):
+  """Returns the trigrams two texts have in common as a share, 0 to 1, of all their trigrams."""
+  other_trigrams = trigrams(other_text)
+  union = len(text_trigrams | other_trigrams)
+  return len(text_trigrams & other_trigrams) / union if union else 0
+
+
+def hardware_text(hardware_info):
+  if hardware_info.type == 0x00 and hardware_info.identifier in COMPUTERS:
+    hardware = COMPUTERS[hardware_info.identifier]
+  else:
+    hardware = "%s 0x%.2x" % (HARDWARE_TYPES.get(hardware_info.type, "type 0x%.2x" % hardware_info.type),
+                              hardware_info.identifier)
+  return "%s %s" % (HARDWARE_INFORMATION.get(hardware_info.information, "?"), hardware)
+
+
+def tzx_metadata(tzx_file):
+  """Returns a dictionary of the catalog columns of a TZX file."""
+  tap_dirname = os.path.splitext(os.path.basename(tzx_file))[0][:8].upper()
+  fields = {column: list() for column in COLUMNS}
+  info_blocks = list()
+  tap_names = dict()
+  with open(tzx_file, 'rb') as tzx_fd:
+    with tapstats.STATS.phase('parse', file = tzx_file):
+      for program in tzx2tap.tzx_programs(tzx_fd, tzx_file, info_blocks):
+        fields['programs'].append(program.name)
+        fields['tap_files'].append(tap_dirname + '/' + tzx2tap.tap_filename(tap_names, program))
+    tapstats.STATS.count(bytes = tzx_fd.tell(), blocks = 2 * len(fields['programs']), files = 1)
+
+  for block in info_blocks:
+    if isinstance(block, tzx2tap.TZXArchiveInfoBlock):
+      for text in block.text:
+        fields[ARCHIVE_FIELDS.get(text.identity, 'comment')].append(text.text.strip())
+    elif isinstance(block, tzx2tap.TZXTextDescription):
+      fields['description'].append(block.description.strip())
+    elif isinstance(block, tzx2tap.TZXHardwareTypeBlock):
+      fields['hardware'].extend(hardware_text(hardware_info) for hardware_info in block.hardware_info)
+  return {column: '\n'.join(values) for column, values in fields.items()}
+
+
+class Catalog(object):
+  """A catalog database, searched with the full text index if SQLite has one."""
+  def __init__(self, catalog_file):
+    self.__db = sqlite3.connect(catalog_file)
+    self.__db.row_factory = sqlite3.Row
+    self.__db.execute("CREATE TABLE IF NOT EXISTS tzx_files (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, "
+                      "size INTEGER, mtime REAL, %s)" % ', '.join("%s TEXT" % column for column in COLUMNS))
+    try:
+      self.__db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS catalog USING fts5(path, %s, tokenize = 'trigram')" % \
+                        ', '.join(COLUMNS))
+      self.__is_fts = True
+    except sqlite3.OperationalError:
+      # No FTS5, or a version without the trigram tokenizer, search with LIKE
+      self.__is_fts = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception_value, exception_traceback):
+    self.close()
+
+  def close(self):
+    self.__db.close()
+
+  @property
+  def is_fts(self):
+    return self.__is_fts
+
+  def is_current(self, path, size, mtime):
+    row = self.__db.execute("SELECT size, mtime FROM tzx_files WHERE path = ?", (path,)).fetchone()
+    return row is not None and row['size'] == size and row['mtime'] == mtime
+
+  def add(self, path, size, mtime, metadata):
+    values = [metadata[column] for column in COLUMNS]
+    self.remove(path)
+    cursor = self.__db.execute("INSERT INTO tzx_files (path, size, mtime, %s) VALUES (?, ?, ?, %s)" % \
+                               (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                               [path, size, mtime] + values)
+    if self.__is_fts:
+      self.__db.execute("INSERT INTO catalog (rowid, path, %s) VALUES (?, ?, %s)" % \
+                        (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                        [cursor.lastrowid, path] + values)
+
+  def remove(self, path):
+    row = self.__db.execute("SELECT id FROM tzx_files WHERE path = ?", (path,)).fetchone()
+    if row is not None:
+      self.__db.execute("DELETE FROM tzx_files WHERE id = ?", (row['id'],))
+      if self.__is_fts:
+        self.__db.execute("DELETE FROM catalog WHERE rowid = ?", (row['id'],))
+
+  def commit(self):
+    self.__db.commit()
+
+  def search(self, words = (), fields = ()):
+    """Returns the rows with each word in any column and each (column, text) in its column.
+
+    Matches are of any part of a word, ignoring case. Rows are returned best
+    match first when the full text index is used.
+    """
+    matches = list()
+    likes = list()
+    params = list()
+    criteria = [(None, word) for word in words] + list(fields)
+    for column, text in criteria:
+      if self.__is_fts and len(text) >= MIN_MATCH_LENGTH:
+        phrase = '"%s"' % text.replace('"', '""')
+        matches.append("%s : %s" % (column, phrase) if column else phrase)
+      else:
+        columns = [column] if column else ('path',) + COLUMNS
+        likes.append('(%s)' % ' OR '.join("f.%s LIKE ?" % c for c in columns))
+        params.extend(['%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'] * len(columns))
+    likes = [like.replace("LIKE ?", "LIKE ? ESCAPE '\\'") for like in likes]
+
+    if matches:
+      sql = "SELECT f.* FROM tzx_files f JOIN catalog ON catalog.rowid = f.id WHERE catalog MATCH ?"
+      params.insert(0, ' AND '.join(matches))
+      order = "catalog.rank"
+    else:
+      sql = "SELECT f.* FROM tzx_files f WHERE 1"
+      order = "f.path"
+    if likes:
+      sql += " AND " + " AND ".join(likes)
+    return self.__db.execute(sql + " ORDER BY " + order, params).fetchall()
+
+  def search_similar_title(self, title, words = (), fields = (), min_similarity = MIN_SIMILARITY):
+    """Returns [(similarity, row), ...] of the rows matching words and fields with a title like title.
+
+    Rows are returned most similar first, each line of a row's titles is
+    compared. Every row matching words and fields is read, so this is for
+    when the full text index finds no exact match.
+    """
+    title_trigrams = trigrams(title)
+    similar = list()
+    for row in self.search(words, fields):
+      row_similarity = max([similarity(title_trigrams, line) for line in (row['title'] or '').split('\n')])
+      if row_similarity >= min_similarity:
+        similar.append((row_similarity, row))
+    similar.sort(key = lambda entry: (-entry[0], entry[1]['path']))
+    return similar
+
+
+def catalog_index(catalog_file, paths):
+  """Adds the TZX files in paths, directories are searched recursively, to a catalog."""
+  rc = True
+  no_indexed = 0
+  no_current = 0
+  with Catalog(catalog_file) as catalog:
+    for tzx_file in tapfiles.tape_files(paths):
+      if os.path.splitext(tzx_file)[1].lower() != '.tzx':
+        continue
+      path = os.path.realpath(tzx_file)
+      try:
+        stat = os.stat(path)
+        if catalog.is_current(path, stat.st_size, stat.st_mtime):
+          no_current += 1
+          continue
+        with tapstats.STATS.phase('file', file = tzx_file):
+          metadata = tzx_metadata(tzx_file)
+      except (tzx2tap.TZXFileException, OSError) as ex:
+        print(ex, file = sys.stderr)
+        rc = False
+        continue
+      with tapstats.STATS.phase('index', file = tzx_file):
+        catalog.add(path, stat.st_size, stat.st_mtime, metadata)
+      no_indexed += 1
+    with tapstats.STATS.phase('commit'):
+      catalog.commit()
+  print("Indexed %d TZX files, %d unchanged" % (no_indexed, no_current), file = sys.stderr)
+  return rc
+
+
+def print_row(row, fd):
+  print(row['path'], file = fd)
+  for column in ('title', 'publisher', 'author', 'year', 'type', 'hardware'):
+    if row[column]:
+      print("  %-10s %s" % (column.capitalize() + ':', row[column].replace('\n', '; ')), file = fd)
+  if row['tap_files']:
+    print("  %-10s %s" % ('TAP files:', row['tap_files'].replace('\n', ' ')), file = fd)
+
+
+def catalog_search(catalog_file, words, fields, fd = sys.stdout):
+  with Catalog(catalog_file) as catalog:
+    with tapstats.STATS.phase('search'):
+      rows = catalog.search(words, fields)
+    titles = [text for column, text in fields if column == 'title']
+    if rows or not titles:
+      for row in rows:
+        print_row(row, fd)
+      print("%d TZX files" % len(rows), file = sys.stderr)
+      return True
+
+    # No title has the text, list the titles most like it
+    with tapstats.STATS.phase('search'):
+      similar = catalog.search_similar_title(titles[0], words, [field for field in fields if field[0] != 'title'])
+    for row_similarity, row in similar:
+      print_row(row, fd)
+      print("  %-10s %.0f%%" % ('Similar:', 100 * row_similarity), file = fd)
+  print("%d TZX files with a title like \"%s\"" % (len(similar), titles[0]), file = sys.stderr)
+  return True
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+
+  parser = argparse.ArgumentParser(prog = "tapcatalog.py",
+                                   description = "Index and search the archive info of TZX files (v%s)." % __VERSION)
+  parser.add_argument('-i', '--index',
+                      dest = 'is_index',
+                      action = 'store_true',
+                      help = "Add TZX files, or the TZX files in directories, to the catalog")
+  for field in SEARCH_FIELDS:
+    parser.add_argument('--%s' % field,
+                        type = str,
+                        dest = field,
+                        help = "Search for %s containing the text" % field)
+  parser.add_argument('catalog_file',
+                      type = str,
+                      help = "Catalog database file")
+  parser.add_argument('arguments',
+                      nargs = '*',
+                      type = str,
+                      help = "With --index TZX files and directories, otherwise words to search for in any field")
+  tapstats.add_arguments(parser)
+  args = parser.parse_intermixed_args()
+  tapstats.start(args)
+
+  try:
+    if args.is_index:
+      if not args.arguments:
+        parser.error("TZX files or directories to index are required")
+      rc = catalog_index(args.catalog_file, args.arguments)
+    else:
+      fields = [(field, getattr(args, field)) for field in SEARCH_FIELDS if getattr(args, field)]
+      rc = catalog_search(args.catalog_file, args.arguments, fields)
+  except sqlite3.Error as ex:
+    print("Catalog [%s]: %s" % (args.catalog_file, ex), file = sys.stderr)
+    rc = False
+  sys.exit(not rc)
@@ -0,0 +1,75 @@
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# Helpers shared by the utilities that work on many tape files: finding
+# TAP and TZX files in directories, and converting TZX, TAP and ZIP input
+# files to the single program TAP files written to an SD card.
+#
+########################################################################
+import os
+import zipfile
+
+import tapsplit
+import tzx2tap
+
+
+TAPE_EXTENSIONS = ('.tap', '.tzx')
+INPUT_EXTENSIONS = TAPE_EXTENSIONS + ('.zip',)
+
+CONVERTERS = {'.tzx': tzx2tap.tzx_convert_bytes,
+              '.tap': tapsplit.tap_split_bytes}
+
+
+def tape_files(paths):
+  """Yields the TAP and TZX files in paths, directories are searched recursively."""
+  for path in paths:
+    if os.path.isdir(path):
+      for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+          if os.path.splitext(file_name)[1].lower() in TAPE_EXTENSIONS:
+            yield os.path.join(dir_path, file_name)
+    else:
+      yield path
+
+
+def tap_dirname(filename):
+  dirname, _ = os.path.splitext(os.path.basename(filename))
+  return dirname[:8].upper()
+
+
+def input_conversions(pathname):
+  """Yields (TAP directory name, [(TAP filename, TAP bytes), ...]) for an input file."""
+  _, ext = os.path.splitext(pathname)
+  ext = ext.lower()
+  if ext == '.zip':
+    with zipfile.ZipFile(pathname) as zip_file:
+      for member in zip_file.infolist():
+        _, member_ext = os.path.splitext(member.filename)
+        converter = CONVERTERS.get(member_ext.lower())
+        if converter and not member.is_dir():
+          yield tap_dirname(member.filename), converter(zip_file.read(member))
+  else:
+    with open(pathname, 'rb') as fd:
+      yield tap_dirname(pathname), CONVERTERS[ext](fd.read())
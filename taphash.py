@@ -0,0 +1,340 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# Reference hashes are read from a Logiqx XML DAT file:
+#
+#   <datafile>
+#     <game name="Fire One">
+#       <rom name="FireOne-091.tzx" size="13420" crc="..." md5="..." sha1="..."/>
+#     </game>
+#   </datafile>
+#
+# or from a CSV file with a header line naming its columns, of which
+# name and at least one of crc, md5 and sha1 are required:
+#
+#   name,size,crc,md5,sha1,status
+#
+# A status of baddump marks the hashes of a known bad dump.
+#
+# Each file is hashed, then each of its programs as the single program TAP
+# file tzx2tap.py or tapsplit.py would write for it. A file is:
+#
+#   match    it, or each of its programs, has the hashes of a good dump
+#   bad      it, or one of its programs, has the hashes of a bad dump, or
+#            it has the name of a DAT entry but not its hashes
+#   unknown  anything else
+#
+########################################################################
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import itertools
+import os
+import sys
+import xml.etree.ElementTree
+import zlib
+
+import tapfiles
+import tapls
+import tapprogram
+import tapstats
+import tzx2tap
+
+
+MATCH = 'match'
+BAD = 'bad'
+UNKNOWN = 'unknown'
+
+# Hash types, strongest first
+HASH_TYPES = ('sha1', 'md5', 'crc')
+BAD_DUMP = 'baddump'
+CHUNK_SIZE = 1 << 16
+
+
+class DatException(Exception):
+  pass
+
+
+DatEntry = collections.namedtuple('DatEntry', ['name', 'size', 'is_bad_dump'])
+
+
+class Crc32(object):
+  """zlib.crc32 with the update() and hexdigest() of a hashlib hash."""
+  def __init__(self):
+    self.__crc = 0
+
+  def update(self, data):
+    self.__crc = zlib.crc32(data, self.__crc)
+
+  def hexdigest(self):
+    return "%.8x" % self.__crc
+
+
+def new_hashes(hash_types):
+  return {hash_type: Crc32() if hash_type == 'crc' else hashlib.new(hash_type) for hash_type in hash_types}
+
+
+def hex_digests(hashes):
+  return {hash_type: hash_value.hexdigest() for hash_type, hash_value in hashes.items()}
+
+
+class HashIndex(object):
+  """The entries of DAT files, by hash and by file name."""
+  def __init__(self):
+    self.__entries = dict()
+    self.__names = dict()
+    self.__hash_types = set()
+    self.__no_entries = 0
+
+  @property
+  def hash_types(self):
+    """The hash types of the entries, strongest first; only these need to be computed."""
+    return tuple(hash_type for hash_type in HASH_TYPES if hash_type in self.__hash_types)
+
+  def __len__(self):
+    return self.__no_entries
+
+  def add(self, name, size, digests, is_bad_dump = False):
+    digests = {hash_type: digest.strip().lower() for hash_type, digest in digests.items() \
+               if hash_type in HASH_TYPES and digest and digest.strip()}
+    if not digests:
+      raise DatException("Entry [%s] has no crc, md5 or sha1" % name)
+    entry = DatEntry(name, size, is_bad_dump)
+    for hash_type, digest in digests.items():
+      self.__entries.setdefault((hash_type, digest), list()).append(entry)
+      self.__hash_types.add(hash_type)
+    self.__names.setdefault(os.path.basename(name).lower(), entry)
+    self.__no_entries += 1
+
+  def find(self, digests, size):
+    """Returns the entry with the digests, compared on the strongest hash type both have, or None."""
+    for hash_type in self.hash_types:
+      if hash_type in digests:
+        for entry in self.__entries.get((hash_type, digests[hash_type]), ()):
+          if entry.size is None or entry.size == size:
+            return entry
+    return None
+
+  def find_name(self, file_name):
+    return self.__names.get(os.path.basename(file_name).lower())
+
+
+def dat_size(size):
+  try:
+    return int(size) if size else None
+  except ValueError:
+    return None
+
+
+def load_xml_dat(dat_fd, index):
+  game_name = None
+  for event, element in xml.etree.ElementTree.iterparse(dat_fd, events = ('start', 'end')):
+    if event == 'start':
+      if element.tag in ('game', 'machine', 'software'):
+        game_name = element.get('name')
+    elif element.tag == 'rom':
+      name = element.get('name') or game_name
+      index.add(name, dat_size(element.get('size')),
+                {hash_type: element.get(hash_type) for hash_type in HASH_TYPES},
+                element.get('status') == BAD_DUMP)
+    elif element.tag in ('game', 'machine', 'software'):
+      # Entries are indexed as they are read, their elements are not needed
+      element.clear()
+
+
+def load_csv_dat(dat_fd, index):
+  reader = csv.DictReader(dat_fd)
+  columns = [column.strip().lower() for column in reader.fieldnames or ()]
+  if 'name' not in columns or not any(hash_type in columns for hash_type in HASH_TYPES):
+    raise DatException("CSV columns [%s] need name and one of %s" % (', '.join(columns), ', '.join(HASH_TYPES)))
+  reader.fieldnames = columns
+  for row in reader:
+    index.add(row['name'], dat_size(row.get('size')), {hash_type: row.get(hash_type) for hash_type in HASH_TYPES},
+              (row.get('status') or '').strip().lower() == BAD_DUMP)
+
+
+def load_dat(dat_file, index = None):
+  """Returns a HashIndex of the entries of a Logiqx XML or CSV DAT file, added to index if given."""
+  index = index if index is not None else HashIndex()
+  with open(dat_file, 'rb') as dat_fd:
+    is_xml = dat_fd.read(256).lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<')
+  try:
+    if is_xml:
+      # The parser reads the encoding from the XML declaration
+      with open(dat_file, 'rb') as dat_fd:
+        load_xml_dat(dat_fd, index)
+    else:
+      with open(dat_file, 'r', encoding = 'utf-8-sig', errors = 'replace', newline = '') as dat_fd:
+        load_csv_dat(dat_fd, index)
+  except (xml.etree.ElementTree.ParseError, csv.Error) as ex:
+    raise DatException("DAT file [%s]: %s" % (dat_file, ex))
+  return index
+
+
+def file_programs(tape_fd, tape_file):
+  if os.path.splitext(tape_file)[1].lower() == '.tzx':
+    return tzx2tap.tzx_programs(tape_fd, tape_file)
+  return tapls.tap_programs(tape_fd)
+
+
+def hash_file(tape_file, hash_types):
+  """Returns the hashes of a file and of each of its programs, run in a worker thread.
+
+  The file is hashed as it is read, then read again by the block walkers
+  of tapls.py or tzx2tap.py, so neither holds more than a block.
+  """
+  result = dict(file = tape_file, size = 0, programs = list())
+  try:
+    with open(tape_file, 'rb') as tape_fd:
+      hashes = new_hashes(hash_types)
+      for chunk in iter(lambda: tape_fd.read(CHUNK_SIZE), b''):
+        for hash_value in hashes.values():
+          hash_value.update(chunk)
+        result['size'] += len(chunk)
+      result['digests'] = hex_digests(hashes)
+
+      tape_fd.seek(0)
+      try:
+        for program in file_programs(tape_fd, tape_file):
+          tap_bytes = program.tap_bytes
+          hashes = new_hashes(hash_types)
+          for hash_value in hashes.values():
+            hash_value.update(tap_bytes)
+          result['programs'].append((program.name, len(tap_bytes), hex_digests(hashes)))
+      except (tapprogram.BlockDataTruncated, tzx2tap.TZXFileException) as ex:
+        # The whole file can still match, as a known bad dump
+        result['program_exception'] = str(ex)
+  except OSError as ex:
+    result['exception'] = str(ex)
+  return result
+
+
+def classify(index, result):
+  """Returns (status, [text, ...]) for the hashes of a file."""
+  entry = index.find(result['digests'], result['size'])
+  if entry is not None:
+    return (BAD if entry.is_bad_dump else MATCH, ["%s%s" % (entry.name, ", bad dump" if entry.is_bad_dump else '')])
+
+  texts = list()
+  statuses = set()
+  for name, size, digests in result['programs']:
+    entry = index.find(digests, size)
+    if entry is None:
+      statuses.add(UNKNOWN)
+      texts.append("%s: unknown" % name)
+    elif entry.is_bad_dump:
+      statuses.add(BAD)
+      texts.append("%s: %s, bad dump" % (name, entry.name))
+    else:
+      statuses.add(MATCH)
+      texts.append("%s: %s" % (name, entry.name))
+  if 'program_exception' in result:
+    statuses.add(UNKNOWN)
+    texts.append(result['program_exception'])
+
+  named_entry = index.find_name(result['file'])
+  if named_entry is not None and not named_entry.is_bad_dump:
+    statuses.add(BAD)
+    texts.insert(0, "hashes differ from %s" % named_entry.name)
+  if BAD in statuses:
+    return (BAD, texts)
+  if statuses == {MATCH}:
+    return (MATCH, texts)
+  return (UNKNOWN, texts)
+
+
+def verify(dat_files, paths, workers, is_quiet, fd = sys.stdout):
+  """Hashes the TAP and TZX files in paths on a thread pool, returns True if none are bad."""
+  with tapstats.STATS.phase('dat'):
+    index = HashIndex()
+    for dat_file in dat_files:
+      load_dat(dat_file, index)
+  hash_types = index.hash_types
+  print("%d DAT entries, compared by %s" % (len(index), hash_types[0] if hash_types else '-'), file = sys.stderr)
+  if not hash_types:
+    return False
+
+  counts = dict.fromkeys((MATCH, UNKNOWN, BAD), 0)
+  no_unreadable = 0
+  with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+    files = tapfiles.tape_files(paths)
+    for result in executor.map(hash_file, files, itertools.repeat(hash_types)):
+      if 'exception' in result:
+        print(result['exception'], file = sys.stderr)
+        no_unreadable += 1
+        continue
+      with tapstats.STATS.phase('report', file = result['file']):
+        status, texts = classify(index, result)
+        counts[status] += 1
+        if not is_quiet or status != MATCH:
+          print("%-7s %s" % (status.upper(), result['file']), file = fd)
+          for text in texts:
+            print("\t%s" % text, file = fd)
+      tapstats.STATS.count(bytes = result['size'], blocks = 2 * len(result['programs']), files = 1)
+
+  print("%d files, %d matched, %d unknown, %d bad, %d unreadable" % \
+        (sum(counts.values()) + no_unreadable, counts[MATCH], counts[UNKNOWN], counts[BAD], no_unreadable),
+        file = sys.stderr)
+  return counts[BAD] == 0 and no_unreadable == 0
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_workers = min(32, (os.cpu_count() or 1) + 4)
+
+  parser = argparse.ArgumentParser(prog = "taphash.py",
+                                   description = "Check TAP and TZX files against the hashes of a DAT file (v%s)." % __VERSION)
+  parser.add_argument('-d', '--dat',
+                      type = str,
+                      action = 'append',
+                      required = True,
+                      dest = 'dat_files',
+                      help = "Logiqx XML or CSV DAT file, may be repeated")
+  parser.add_argument('-j', '--jobs',
+                      type = int,
+                      dest = 'workers',
+                      default = default_workers,
+                      help = "Number of hashing threads (default: %d)" % default_workers)
+  parser.add_argument('-q', '--quiet',
+                      dest = 'is_quiet',
+                      action = 'store_true',
+                      help = "Only list unknown and bad files")
+  parser.add_argument('paths',
+                      nargs = '+',
+                      type = str,
+                      help = "TAP and TZX files, or directories to search for them")
+  tapstats.add_arguments(parser)
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  try:
+    rc = verify(args.dat_files, args.paths, max(1, args.workers), args.is_quiet)
+  except (DatException, OSError) as ex:
+    print(ex, file = sys.stderr)
+    rc = False
+  sys.exit(not rc)
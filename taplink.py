@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import bisect
+import os
+import sys
+
+import tap2forth
+import tapprogram
+import tapstats
+
+
+# The name length field of the FORTH vocabulary, the oldest word links to it
+FORTH_NAME_LENGTH = 0x3c49
+MEMORY_END = 0x10000
+DEFINER = 0x1085
+COMPILER = 0x1108
+
+
+class LinkException(Exception):
+  pass
+
+
+class AddressMap(object):
+  """Maps addresses in a dictionary to their addresses in a relinked dictionary.
+
+  Ranges of old addresses are added with the new address of their start.
+  Addresses outside [low, high) that are not in a range, such as ROM
+  words, are left as they are. Addresses inside it that are not in a
+  range belong to words that have been removed and cannot be mapped.
+  """
+  def __init__(self, low, high):
+    self.__low = low
+    self.__high = high
+    self.__starts = list()
+    self.__ranges = list()
+
+  def add(self, old_start, old_end, new_start):
+    idx = bisect.bisect_right(self.__starts, old_start)
+    self.__starts.insert(idx, old_start)
+    self.__ranges.insert(idx, (old_end, new_start))
+
+  def map(self, addr):
+    idx = bisect.bisect_right(self.__starts, addr) - 1
+    if idx >= 0:
+      old_end, new_start = self.__ranges[idx]
+      if addr < old_end:
+        return new_start + addr - self.__starts[idx]
+    if self.__low <= addr < self.__high:
+      raise LinkException("Address 0x%.4x is not in the linked dictionary" % addr)
+    return addr
+
+
+class Dictionary(object):
+  """The Forth dictionary of a TAP file."""
+  def __init__(self, tap_file):
+    self.__tap_file = tap_file
+    with open(tap_file, 'rb') as tap_fd:
+      self.__header = tap2forth.HeaderBlock(tap_fd)
+      self.__data = tap2forth.DataBlock(tap_fd, self.__header.is_v2_tap_file)
+
+  @property
+  def tap_file(self):
+    return self.__tap_file
+
+  @property
+  def header(self):
+    return self.__header
+
+  @property
+  def contents(self):
+    return self.__data.contents
+
+  @property
+  def origin(self):
+    return self.__header.origin
+
+  @property
+  def end(self):
+    return self.__header.origin + len(self.__data.contents)
+
+  def words(self):
+    # Also registers the words with tap2forth, so their threads can be walked
+    return self.__data.words(self.origin)
+
+
+def word_start(word):
+  """Returns the address of the name field of a word."""
+  return word.exec_addr - len(word.name) - 5
+
+
+def relocate_word(word, contents, origin, address_map):
+  """Returns the bytes of a word with its addresses mapped by address_map.
+
+  The link and code fields are mapped, as are the compiled words of colon,
+  DEFINER and COMPILER definitions and the address of the DOES> or RUNS>
+  code of DEFINER and COMPILER definitions. Other parameters are data
+  and are copied as they are.
+  """
+  name_length = len(word.name)
+  start = word_start(word) - origin
+  word_bytes = bytearray(contents[start : start + name_length + word.length])
+  relocate_word_bytes(word_bytes, name_length, word.code_addr, address_map)
+  return word_bytes
+
+
+def relocate_word_bytes(word_bytes, name_length, code_addr, address_map):
+  """Maps the addresses in the bytes of a word, in place, as relocate_word does."""
+  def relocate(offset):
+    addr = int.from_bytes(word_bytes[offset : offset + 2], "little")
+    word_bytes[offset : offset + 2] = address_map.map(addr).to_bytes(2, "little")
+
+  relocate(name_length + 2)
+  relocate(name_length + 5)
+  if code_addr == DEFINER or code_addr == COMPILER:
+    relocate(name_length + 7)
+  thread_offset = tap2forth.THREAD_OFFSETS.get(code_addr)
+  if thread_offset is not None:
+    for idx in tap2forth.thread_cells(word_bytes[name_length + 7:], thread_offset):
+      relocate(name_length + 7 + idx)
+
+
+def link(dictionaries, name):
+  """Returns a program with the dictionaries linked, in order, into one."""
+  contents = bytearray()
+  latest = FORTH_NAME_LENGTH
+  names = set()
+  for dictionary in dictionaries:
+    with tapstats.STATS.phase('parse', file = dictionary.tap_file):
+      words = dictionary.words()
+    with tapstats.STATS.phase('relocate', file = dictionary.tap_file):
+      address_map = AddressMap(dictionary.origin, dictionary.end)
+      address_map.add(dictionary.origin, dictionary.end, tapprogram.DICTIONARY_ORIGIN + len(contents))
+      # The oldest word now follows the newest word of the previous dictionary
+      address_map.add(FORTH_NAME_LENGTH, FORTH_NAME_LENGTH + 1, latest)
+      for word in words:
+        if word.name in names:
+          print("Word [%s] in [%s] redefines an earlier word" % (word.name, dictionary.tap_file), file = sys.stderr)
+        names.add(word.name)
+        try:
+          contents += relocate_word(word, dictionary.contents, dictionary.origin, address_map)
+        except (KeyError, LinkException) as ex:
+          raise LinkException("[%s] word [%s]: %s" % (dictionary.tap_file, word.name, ex))
+      latest = address_map.map(dictionary.header.latest)
+      header = dictionary.header
+      current, context, voclnk = [address_map.map(addr) for addr in (header.current, header.context, header.voclnk)]
+  if tapprogram.DICTIONARY_ORIGIN + len(contents) > MEMORY_END:
+    raise LinkException("Linked dictionary of %d bytes does not fit in memory" % len(contents))
+  return tapprogram.dictionary_program(name, bytes(contents), latest, current, context, voclnk)
+
+
+def tap_link(tap_files, tap_output, tap_name, force):
+  if not force and os.path.exists(tap_output):
+    print("TAP file [%s] exists. Use -f to overwrite it" % tap_output, file = sys.stderr)
+    return False
+
+  try:
+    dictionaries = list()
+    for tap_file in tap_files:
+      with tapstats.STATS.phase('read', file = tap_file):
+        dictionaries.append(Dictionary(tap_file))
+    program = link(dictionaries, tap_name)
+  except (tap2forth.BlockDataExhausted, tapprogram.BlockDataTruncated, tap2forth.BlockDataCorruption,
+          tap2forth.BlockDataNotSupportedType, LinkException, OSError) as ex:
+    print(ex, file = sys.stderr)
+    return False
+  tapstats.STATS.count(bytes = sum(len(d.contents) for d in dictionaries), blocks = 2 * len(dictionaries),
+                       files = len(dictionaries))
+
+  with tapstats.STATS.phase('write', file = tap_output), open(tap_output, 'wb') as tap_fd:
+    tap_fd.write(program.tap_bytes)
+  print("Linked %d dictionaries, %d bytes, into [%s]" % (len(dictionaries), len(program.data) - 2, tap_output),
+        file = sys.stderr)
+  return True
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+
+  parser = argparse.ArgumentParser(prog = "taplink.py",
+                                   description = "Link Forth TAP files into a single dictionary TAP file (v%s)." % __VERSION)
+  parser.add_argument('-o', '--output',
+                      type = str,
+                      required = True,
+                      dest = 'tap_output',
+                      help = "Output TAP file")
+  parser.add_argument('-t', '--tapname',
+                      type = str,
+                      dest = 'tap_name',
+                      help = "Name of the linked program (default: output file name)")
+  parser.add_argument('-f', '--force',
+                      dest = 'force',
+                      action = 'store_true',
+                      help = "Overwrite the output TAP file if it exists")
+  parser.add_argument('tap_files',
+                      nargs = '+',
+                      type = str,
+                      help = "Forth TAP files, in the order they would be loaded")
+  tapstats.add_arguments(parser)
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  tap_name = args.tap_name if args.tap_name else os.path.splitext(os.path.basename(args.tap_output))[0].lower()
+  rc = tap_link(args.tap_files, args.tap_output, tap_name, args.force)
+  sys.exit(not rc)
@@ -26,6 +26,9 @@ import functools
 import os
 import sys
 
+import tapprogram
+import tapstats
+
 
 class BlockDataExhausted(Exception):
   pass
@@ -36,9 +39,14 @@ class Block(object):
     pos = tap_file.tell()
     block_length_bytes = tap_file.read(2)
     self.__block_length = int.from_bytes(block_length_bytes, "little")
-    self.__data = tap_file.read(self.__block_length)
-    if not self.__data or len(self.__data) != self.__block_length:
+    if not self.__block_length:
       raise BlockDataExhausted
+    remaining = tapprogram.remaining_length(tap_file)
+    if len(block_length_bytes) != 2 or (remaining is not None and self.__block_length > remaining):
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, remaining if remaining is not None else 0)
+    self.__data = tap_file.read(self.__block_length)
+    if len(self.__data) != self.__block_length:
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, len(self.__data))
 
   @property
   def block_length(self):
@@ -53,6 +61,10 @@ class Block(object):
     checksum = functools.reduce(lambda acc, b: acc ^ b, slice, 0)
     return (True, checksum) if checksum == self.__data[-1] else (False, checksum, self.__data[-1])
 
+  @property
+  def contents(self):
+    return self.__data
+
   def data(self, *slice_idxs):
     idx_len = len(slice_idxs)
     if idx_len == 0:
@@ -62,34 +74,57 @@ class Block(object):
     return self.__data[slice_idxs[0]:slice_idxs[1]]
 
 
+def tap_programs(tap_fd, is_v2_verification = False):
+  """Yields a tapprogram.Program for each header/data block pair in a TAP stream."""
+  while True:
+    try:
+      hdr_block = Block(tap_fd)
+      data_block = Block(tap_fd)
+    except BlockDataExhausted:
+      break
+    is_v2_file = True if is_v2_verification else hdr_block.is_v2_header_block
+    yield tapprogram.Program(hdr_block.contents, data_block.contents, is_v2_file)
+
+
 def tap_list(tap_filenames, is_v2_verification):
-  def tap_crc_error(block, is_v2):
-    vcsd = block.valid_checksum(is_v2)
+  """Lists the programs of TAP files, returns False if a TAP file is truncated."""
+  rc = True
+  def tap_crc_error(vcsd):
     if not vcsd[0]:
       return ", CRC ERROR (checksum [%.2x], expected [%.2x])" % (vcsd[1], vcsd[2])
     return ""
   for tap_filename in map(lambda fn: os.path.relpath(fn), tap_filenames):
-    with open(tap_filename, 'rb') as tap_fd:
-      try:
-        print(tap_filename)
-        while True:
-          hdr_block = Block(tap_fd)
-          data_block = Block(tap_fd)
-          is_v2_file = True if is_v2_verification else hdr_block.is_v2_header_block
-          filename = hdr_block.data(2, 12).decode('utf-8') if hdr_block.is_v2_header_block else hdr_block.data(1,11).decode('utf-8')
-          print("\t%s" % filename)
-          print("\t\tHeader Block: %d bytes%s" % (hdr_block.block_length, tap_crc_error(hdr_block, is_v2_file)))
-          print("\t\t  Data Block: %d bytes%s" % (data_block.block_length, tap_crc_error(data_block, is_v2_file)))
-      except BlockDataExhausted:
-        pass
+    with tapstats.STATS.phase('file', file = tap_filename), open(tap_filename, 'rb') as tap_fd:
+      print(tap_filename)
+      programs = tap_programs(tap_fd, is_v2_verification)
+      while True:
+        try:
+          with tapstats.STATS.phase('parse', file = tap_filename):
+            program = next(programs, None)
+        except tapprogram.BlockDataTruncated as ex:
+          print("%s: %s" % (tap_filename, ex), file = sys.stderr)
+          rc = False
+          break
+        if program is None:
+          break
+        with tapstats.STATS.phase('checksum', program = program.name):
+          hdr_crc_error = tap_crc_error(program.header_checksum)
+          data_crc_error = tap_crc_error(program.data_checksum)
+        with tapstats.STATS.phase('format', program = program.name):
+          print("\t%s" % program.name)
+          print("\t\tHeader Block: %d bytes%s" % (len(program.header), hdr_crc_error))
+          print("\t\t  Data Block: %d bytes%s" % (len(program.data), data_crc_error))
+        tapstats.STATS.count(bytes = len(program.header) + len(program.data), blocks = 2)
+      tapstats.STATS.count(files = 1)
+  return rc
 
 
-if __name__ == '__main__':
+def main(argv = None, prog = "tapls.py"):
   import argparse
 
   __VERSION = "1.1.0"
 
-  parser = argparse.ArgumentParser(prog = "tapls.py",
+  parser = argparse.ArgumentParser(prog = prog,
                                    description = "List the contents of a TAP file (v%s)." % __VERSION)
   parser.add_argument('--v2',
                       dest = 'is_v2_verification',
@@ -99,6 +134,12 @@ if __name__ == '__main__':
                       nargs = '+',
                       type = str,
                       help = 'TAP filename')
-  args = parser.parse_args()
+  tapstats.add_arguments(parser)
+  args = parser.parse_args(argv)
+  tapstats.start(args)
+
+  return tap_list(args.tap_file, args.is_v2_verification)
 
-  tap_list(args.tap_file, args.is_v2_verification)
+
+if __name__ == '__main__':
+  sys.exit(not main())
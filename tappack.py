@@ -0,0 +1,321 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# A pack holds the TAP files of a collection in a single file:
+#
+#   header        magic, version, number of entries, index offsets
+#   TAP files     one after another
+#   name index    a record per TAP file sorted by name: name, offset,
+#                 length and SHA-256 digest of the TAP file
+#   hash index    digest and record number, sorted by digest
+#
+# Names are the card path of the TAP file, DIRNAME/FILENAME.TAP.
+#
+########################################################################
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import zipfile
+
+import tapfiles
+import tapprogram
+import tapsplit
+import tapstats
+import tzx2tap
+
+
+MAGIC = b'TAPPACK\x1a'
+VERSION = 1
+HEADER = struct.Struct('<8sHIQQ')
+RECORD = struct.Struct('<24sQI32s')
+HASH_ENTRY = struct.Struct('<32sI')
+NAME_LENGTH = 24
+
+
+class PackException(Exception):
+  pass
+
+
+def pack_name(name):
+  """Returns the index key of a TAP file name."""
+  key = name.replace(os.sep, '/').upper().encode('utf-8')
+  if len(key) > NAME_LENGTH:
+    raise PackException("Name [%s] is longer than %d characters" % (name, NAME_LENGTH))
+  return key.ljust(NAME_LENGTH, b'\0')
+
+
+def pack_write(entries, pack_file):
+  """Writes (name, TAP bytes) entries to a pack file, returns the number written.
+
+  TAP files are written as they are produced, only the index records are
+  held in memory. Entries with a name already in the pack are skipped.
+  """
+  records = dict()
+  with open(pack_file, 'wb') as pack_fd:
+    pack_fd.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+    for name, tap_bytes in entries:
+      key = pack_name(name)
+      if key in records:
+        print("Duplicate TAP file [%s] ignored" % name, file = sys.stderr)
+        continue
+      with tapstats.STATS.phase('checksum', tap = name):
+        digest = hashlib.sha256(tap_bytes).digest()
+      records[key] = (pack_fd.tell(), len(tap_bytes), digest)
+      with tapstats.STATS.phase('write', tap = name):
+        pack_fd.write(tap_bytes)
+
+    with tapstats.STATS.phase('index'):
+      names = sorted(records)
+      records_offset = pack_fd.tell()
+      pack_fd.write(b''.join(RECORD.pack(key, *records[key]) for key in names))
+      hashes_offset = pack_fd.tell()
+      pack_fd.write(b''.join(HASH_ENTRY.pack(digest, idx) \
+                             for digest, idx in sorted((records[key][2], idx) for idx, key in enumerate(names))))
+      pack_fd.seek(0)
+      pack_fd.write(HEADER.pack(MAGIC, VERSION, len(names), records_offset, hashes_offset))
+  return len(names)
+
+
+class _Keys(object):
+  # A sequence of the keys of a sorted index in a pack, for bisect
+  def __init__(self, pack, offset, stride, length, count):
+    self.__pack = pack
+    self.__offset = offset
+    self.__stride = stride
+    self.__length = length
+    self.__count = count
+
+  def __len__(self):
+    return self.__count
+
+  def __getitem__(self, idx):
+    start = self.__offset + idx * self.__stride
+    return self.__pack[start : start + self.__length]
+
+
+class TapPack(object):
+  """A pack file opened for reading.
+
+  TAP files are returned as memoryviews of the memory mapped pack, they
+  must be released before the pack is closed.
+  """
+  def __init__(self, pack_file):
+    self.__pack_file = pack_file
+    with open(pack_file, 'rb') as pack_fd:
+      try:
+        self.__mmap = mmap.mmap(pack_fd.fileno(), 0, access = mmap.ACCESS_READ)
+      except ValueError:
+        raise PackException("[%s] is not a pack file" % pack_file)
+    if len(self.__mmap) < HEADER.size:
+      self.__mmap.close()
+      raise PackException("[%s] is not a pack file" % pack_file)
+    magic, version, self.__count, self.__records_offset, self.__hashes_offset = HEADER.unpack_from(self.__mmap)
+    if magic != MAGIC or version != VERSION or \
+       self.__records_offset + self.__count * RECORD.size > len(self.__mmap) or \
+       self.__hashes_offset + self.__count * HASH_ENTRY.size > len(self.__mmap):
+      self.__mmap.close()
+      raise PackException("[%s] is not a version %d pack file" % (pack_file, VERSION))
+    self.__view = memoryview(self.__mmap)
+    self.__names = _Keys(self.__mmap, self.__records_offset, RECORD.size, NAME_LENGTH, self.__count)
+    self.__hashes = _Keys(self.__mmap, self.__hashes_offset, HASH_ENTRY.size, 32, self.__count)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception_value, exception_traceback):
+    self.close()
+
+  def close(self):
+    self.__view.release()
+    self.__mmap.close()
+
+  def __len__(self):
+    return self.__count
+
+  def __record(self, idx):
+    return RECORD.unpack_from(self.__mmap, self.__records_offset + idx * RECORD.size)
+
+  def __tap_bytes(self, idx):
+    _, offset, length, _ = self.__record(idx)
+    if offset + length > len(self.__mmap):
+      raise PackException("[%s] entry %d is truncated" % (self.__pack_file, idx))
+    return self.__view[offset : offset + length]
+
+  def entries(self):
+    """Yields (name, SHA-256 digest) for each TAP file, in name order."""
+    for idx in range(0, self.__count):
+      name, _, _, digest = self.__record(idx)
+      yield (name.rstrip(b'\0').decode('utf-8'), digest)
+
+  def get(self, name):
+    """Returns the TAP file with the name, None if it is not in the pack."""
+    key = pack_name(name)
+    idx = bisect.bisect_left(self.__names, key)
+    if idx < self.__count and self.__names[idx] == key:
+      return self.__tap_bytes(idx)
+    return None
+
+  def get_by_hash(self, digest):
+    """Returns the TAP file with the SHA-256 digest, bytes or hex, None if it is not in the pack."""
+    digest = bytes.fromhex(digest) if isinstance(digest, str) else bytes(digest)
+    idx = bisect.bisect_left(self.__hashes, digest)
+    if idx < self.__count and self.__hashes[idx] == digest:
+      _, record_idx = HASH_ENTRY.unpack_from(self.__mmap, self.__hashes_offset + idx * HASH_ENTRY.size)
+      return self.__tap_bytes(record_idx)
+    return None
+
+  def __contains__(self, name):
+    key = pack_name(name)
+    idx = bisect.bisect_left(self.__names, key)
+    return idx < self.__count and self.__names[idx] == key
+
+
+# Errors that skip an input file, the rest of the collection is packed
+INPUT_EXCEPTIONS = (PackException, tzx2tap.TZXFileException, tapprogram.BlockDataTruncated,
+                    tapsplit.BlockDataExhausted, tapsplit.BlockUnexpectedTypeException, zipfile.BadZipFile,
+                    OSError)
+
+
+def input_entries(pathnames, errors):
+  """Yields (name, TAP bytes) for the TAP files converted from TZX, TAP and ZIP files.
+
+  An input file that cannot be converted is skipped, and appended to errors
+  as (pathname, exception). Each file is converted before its TAP files are
+  yielded, so none of a bad file's TAP files are packed.
+  """
+  for pathname in pathnames:
+    try:
+      if os.path.splitext(pathname)[1].lower() not in tapfiles.INPUT_EXTENSIONS:
+        raise PackException("[%s] unsupported file type" % pathname)
+      with tapstats.STATS.phase('file', file = pathname):
+        conversions = list(tapfiles.input_conversions(pathname))
+    except INPUT_EXCEPTIONS as ex:
+      errors.append((pathname, ex))
+      continue
+    for dirname, taps in conversions:
+      tapstats.STATS.count(bytes = sum(len(tap_bytes) for _, tap_bytes in taps), blocks = 2 * len(taps), files = 1)
+      for tap_filename, tap_bytes in taps:
+        yield (dirname + '/' + tap_filename, tap_bytes)
+
+
+def pack_create(pack_file, pathnames, force):
+  """Packs the TAP files converted from input files, returns False if any input file was skipped."""
+  if not force and os.path.exists(pack_file):
+    print("Pack file [%s] exists. Use -f to overwrite it" % pack_file, file = sys.stderr)
+    return False
+  errors = list()
+  try:
+    no_entries = pack_write(input_entries(pathnames, errors), pack_file)
+  except (PackException, OSError) as ex:
+    print("%s: %s" % (pack_file, ex), file = sys.stderr)
+    if os.path.exists(pack_file):
+      os.remove(pack_file)
+    return False
+  for pathname, error in errors:
+    print("%s: %s" % (pathname, error), file = sys.stderr)
+  print("Packed %d TAP files into [%s], %d input files skipped" % (no_entries, pack_file, len(errors)),
+        file = sys.stderr)
+  return not errors
+
+
+def pack_list(pack_file):
+  with TapPack(pack_file) as pack:
+    for name, digest in pack.entries():
+      tap_bytes = pack.get(name)
+      print("%-24s %6d %s" % (name, len(tap_bytes), digest.hex()))
+      tap_bytes.release()
+  return True
+
+
+def pack_extract(pack_file, root_dir, force):
+  with TapPack(pack_file) as pack:
+    for name, _ in pack.entries():
+      tap_pathname = os.path.join(root_dir, *name.split('/'))
+      if not force and os.path.exists(tap_pathname):
+        print("TAP file [%s] exists. Ignoring..." % tap_pathname, file = sys.stderr)
+        continue
+      os.makedirs(os.path.dirname(tap_pathname), exist_ok = True)
+      tap_bytes = pack.get(name)
+      with open(tap_pathname, 'wb') as tap_fd:
+        tap_fd.write(tap_bytes)
+      tap_bytes.release()
+  return True
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_root_dir = os.path.curdir
+
+  parser = argparse.ArgumentParser(prog = "tappack.py",
+                                   description = "Packs the TAP files of a collection into a single indexed file (v%s)." % __VERSION)
+  mode = parser.add_mutually_exclusive_group(required = True)
+  mode.add_argument('-c', '--create',
+                    dest = 'is_create',
+                    action = 'store_true',
+                    help = "Create a pack from TZX, TAP and ZIP files")
+  mode.add_argument('-l', '--list',
+                    dest = 'is_list',
+                    action = 'store_true',
+                    help = "List the TAP files in a pack")
+  mode.add_argument('-x', '--extract',
+                    dest = 'is_extract',
+                    action = 'store_true',
+                    help = "Extract the TAP files in a pack to TAP directories")
+  parser.add_argument('-d', '--rootdir',
+                      type = str,
+                      dest = 'root_dir',
+                      default = default_root_dir,
+                      help = "Root directory TAP files are extracted to (default: %s)" % default_root_dir)
+  parser.add_argument('-f', '--force',
+                      dest = 'force',
+                      action = 'store_true',
+                      help = "Overwrite existing files")
+  parser.add_argument('pack_file',
+                      type = str,
+                      help = "Pack file")
+  parser.add_argument('input_files',
+                      nargs = '*',
+                      type = str,
+                      help = "TZX, TAP and ZIP files to pack")
+  tapstats.add_arguments(parser)
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  try:
+    if args.is_create:
+      rc = pack_create(args.pack_file, args.input_files, args.force)
+    elif args.is_list:
+      rc = pack_list(args.pack_file)
+    else:
+      rc = pack_extract(args.pack_file, os.path.realpath(args.root_dir), args.force)
+  except (PackException, OSError) as ex:
+    print(ex, file = sys.stderr)
+    rc = False
+  sys.exit(not rc)
@@ -0,0 +1,75 @@
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import asyncio
+import concurrent.futures
+
+
+async def _pipeline(items, read, convert, write, inflight):
+  loop = asyncio.get_running_loop()
+  items = iter(items)
+  converted = asyncio.Queue(maxsize = inflight)
+  errors = list()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = 2 * inflight) as executor:
+    async def reader():
+      for item in items:
+        try:
+          data = await loop.run_in_executor(executor, read, item)
+          outputs = convert(item, data)
+        except Exception as ex:
+          errors.append((item, ex))
+          continue
+        await converted.put((item, outputs))
+
+    async def writer():
+      while True:
+        job = await converted.get()
+        if job is None:
+          break
+        item, outputs = job
+        try:
+          await asyncio.gather(*[loop.run_in_executor(executor, write, item, output) for output in outputs])
+        except Exception as ex:
+          errors.append((item, ex))
+
+    readers = [asyncio.create_task(reader()) for _ in range(0, inflight)]
+    writers = [asyncio.create_task(writer()) for _ in range(0, inflight)]
+    await asyncio.gather(*readers)
+    for _ in writers:
+      await converted.put(None)
+    await asyncio.gather(*writers)
+
+  return errors
+
+
+def pipeline(items, read, convert, write, inflight):
+  """Reads, converts and writes items, overlapping reads with writes.
+
+  read(item) and write(item, output) run on a thread pool, and
+  convert(item, data) runs on the event loop, returning a list of outputs.
+  At most inflight items are read, and inflight converted items are
+  queued for writing, at once. Returns a list of (item, exception) for
+  the items that failed.
+  """
+  return asyncio.run(_pipeline(items, read, convert, write, max(1, inflight)))
@@ -0,0 +1,153 @@
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import io
+import os
+
+
+def remaining_length(fd):
+  """Returns the number of bytes left to read from a file object, None if unknown.
+
+  Length fields are checked against this before reading, so a corrupt
+  length cannot make a reader allocate more than the file holds.
+  """
+  try:
+    pos = fd.tell()
+    if isinstance(fd, io.BytesIO):
+      return len(fd.getbuffer()) - pos
+    try:
+      return os.fstat(fd.fileno()).st_size - pos
+    except (AttributeError, io.UnsupportedOperation):
+      end = fd.seek(0, io.SEEK_END)
+      fd.seek(pos)
+      return end - pos
+  except (AttributeError, OSError, io.UnsupportedOperation):
+    return None
+
+
+class BlockDataTruncated(Exception):
+  """A block's length is longer than the rest of its file."""
+  def __init__(self, offset, block_length, remaining):
+    super(BlockDataTruncated, self).__init__()
+    self.offset = offset
+    self.block_length = block_length
+    self.remaining = remaining
+
+  def __str__(self):
+    return "Block at offset [%d] of length %d is truncated, %d bytes remaining" % \
+      (self.offset, self.block_length, self.remaining)
+
+
+DICTIONARY_ORIGIN = 0x3c51
+FORTH_LATEST = 0x3c4c
+FORTH_VOCLNK = 0x3c4f
+
+
+def checksum(contents):
+  """Returns the XOR of the bytes of contents."""
+  # Fold the bytes, as one integer, in half until one byte is left, which
+  # is much faster than XORing them one at a time
+  value = int.from_bytes(contents, 'little')
+  size = len(contents)
+  while size > 1:
+    half = (size + 1) // 2
+    value = (value >> (half * 8)) ^ (value & ((1 << (half * 8)) - 1))
+    size = half
+  return value
+
+
+def v2_block(flag, contents):
+  """Returns a v2 block, the flag byte, the contents and their checksum."""
+  return bytes([flag]) + bytes(contents) + bytes([checksum(contents)])
+
+
+def dictionary_program(name, contents, latest, current = FORTH_LATEST, context = FORTH_LATEST,
+                       voclnk = FORTH_VOCLNK, origin = DICTIONARY_ORIGIN):
+  """Returns a v2 Forth dictionary program.
+
+  The header holds the values the Ace restores to its system variables on
+  LOAD, latest is the name length field of the newest FORTH word.
+  """
+  header = bytearray([0x00])
+  header += name[:10].ljust(10).encode('utf-8')
+  for value in (len(contents), origin, latest, current, context, voclnk, origin + len(contents)):
+    header += value.to_bytes(2, 'little')
+  return Program(v2_block(0x00, header), v2_block(0xff, contents), is_v2 = True)
+
+
+def valid_checksum(block, is_v2):
+  block_checksum = checksum(block[1:-1] if is_v2 else block[:-1])
+  return (True, block_checksum) if block_checksum == block[-1] else (False, block_checksum, block[-1])
+
+
+class Program(object):
+  """A TAP program, a header block and its data block.
+
+  Blocks are held without their two byte length prefix. A v2 (Jester Ace)
+  block starts with a flag byte that is not part of the checksum.
+  """
+  def __init__(self, header, data, is_v2 = None):
+    self.__header = bytes(header)
+    self.__data = bytes(data)
+    if is_v2 is None:
+      is_v2 = len(self.__header) == 27 and self.__header[0] == 0x00
+    self.__is_v2 = is_v2
+
+  @property
+  def name(self):
+    has_flag = len(self.__header) == 27 and self.__header[0] == 0x00
+    name = self.__header[2:12] if has_flag else self.__header[1:11]
+    return name.decode('utf-8', 'replace').strip()
+
+  @property
+  def is_v2(self):
+    return self.__is_v2
+
+  @property
+  def header(self):
+    return self.__header
+
+  @property
+  def data(self):
+    return self.__data
+
+  @property
+  def header_checksum(self):
+    return valid_checksum(self.__header, self.__is_v2)
+
+  @property
+  def data_checksum(self):
+    return valid_checksum(self.__data, self.__is_v2)
+
+  @property
+  def is_valid(self):
+    return self.header_checksum[0] and self.data_checksum[0]
+
+  @property
+  def tap_bytes(self):
+    return len(self.__header).to_bytes(2, 'little') + self.__header + \
+      len(self.__data).to_bytes(2, 'little') + self.__data
+
+  def __repr__(self):
+    return "<Program: %s, v%d, %d:%d>" % (self.name, 2 if self.__is_v2 else 1,
+                                          len(self.__header), len(self.__data))
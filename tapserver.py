@@ -0,0 +1,288 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# Endpoints, the uploaded file is the POST request body:
+#
+#   POST /tzx2tap?name=DIR   TZX file to a ZIP of TAP files in DIR
+#   POST /tapsplit?name=DIR  TAP file to a ZIP of single program TAP files
+#   POST /tap2tzx?delay=100&turbo=2
+#                            TAP file to a TZX file
+#   POST /list               TAP or TZX file to a JSON list of programs
+#   POST /decompile          Forth TAP file to Forth source
+#
+########################################################################
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import hashlib
+import http.server
+import io
+import json
+import os
+import sys
+import threading
+import urllib.parse
+import zipfile
+
+import acetape
+import tap2forth
+import tap2tzx
+import tapls
+import tapsplit
+import tzx2tap
+
+
+TZX_SIGNATURE = b'ZXTape!'
+
+
+class RequestException(Exception):
+  pass
+
+
+class LRUCache(object):
+  """A cache of responses, the least recently used are dropped when it exceeds max_bytes."""
+  def __init__(self, max_bytes):
+    self.__max_bytes = max_bytes
+    self.__bytes = 0
+    self.__entries = collections.OrderedDict()
+    self.__lock = threading.Lock()
+
+  def get(self, key):
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if entry is not None:
+        self.__entries.move_to_end(key)
+      return entry
+
+  def put(self, key, entry):
+    size = len(entry[1])
+    if size > self.__max_bytes:
+      return
+    with self.__lock:
+      if key in self.__entries:
+        return
+      self.__entries[key] = entry
+      self.__bytes += size
+      while self.__bytes > self.__max_bytes:
+        _, (_, body) = self.__entries.popitem(last = False)
+        self.__bytes -= len(body)
+
+
+def zip_bytes(dirname, taps):
+  zip_fd = io.BytesIO()
+  with zipfile.ZipFile(zip_fd, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    for tap_filename, tap_bytes in taps:
+      zip_file.writestr(dirname + '/' + tap_filename, tap_bytes)
+  return zip_fd.getvalue()
+
+
+def tap_dirname(params):
+  dirname = params.get('name', 'TAPS')
+  dirname = ''.join(c for c in dirname if c.isalnum() or c in '_-')[:8].upper()
+  return dirname if dirname else 'TAPS'
+
+
+def program_list(body):
+  if body.startswith(TZX_SIGNATURE):
+    programs = tzx2tap.tzx_programs(io.BytesIO(body))
+  else:
+    programs = tapls.tap_programs(io.BytesIO(body))
+  return json.dumps([{'name': program.name,
+                      'v2': program.is_v2,
+                      'header_length': len(program.header),
+                      'data_length': len(program.data),
+                      'valid': program.is_valid} for program in programs], indent = 1).encode('utf-8')
+
+
+def decompile(body, max_line_size = 80):
+  # Workers are long-lived, drop the words of the last dictionary decompiled
+  tap2forth.FORTH_WORDS.reset()
+  tap_fd = io.BytesIO(body)
+  hdr = tap2forth.HeaderBlock(tap_fd)
+  data = tap2forth.DataBlock(tap_fd, hdr.is_v2_tap_file)
+  forth_fd = io.StringIO()
+  data.decompile(hdr.origin, tap2forth.Formatter(max_line_size, forth_fd))
+  return forth_fd.getvalue().encode('utf-8')
+
+
+def convert(endpoint, params, body):
+  """Returns (content type, response body) for a request, run in a worker process."""
+  # The utilities' exceptions cannot all be pickled back to the server, so
+  # they are passed back as their message
+  try:
+    return convert_body(endpoint, params, body)
+  except RequestException:
+    raise
+  except Exception as ex:
+    raise RequestException("%s: %s" % (type(ex).__name__, ex))
+
+
+def convert_body(endpoint, params, body):
+  if endpoint == '/tzx2tap':
+    return ('application/zip', zip_bytes(tap_dirname(params), tzx2tap.tzx_convert_bytes(body)))
+  if endpoint == '/tapsplit':
+    return ('application/zip', zip_bytes(tap_dirname(params), tapsplit.tap_split_bytes(body)))
+  if endpoint == '/tap2tzx':
+    turbo = float(params.get('turbo', 0))
+    timings = acetape.STANDARD_TIMINGS.scaled(turbo) if turbo >= 1 else None
+    return ('application/octet-stream', tap2tzx.tap_to_tzx_bytes([body], int(params.get('delay', 100)), timings))
+  if endpoint == '/list':
+    return ('application/json', program_list(body))
+  if endpoint == '/decompile':
+    return ('text/plain; charset=utf-8', decompile(body))
+  raise RequestException("Unknown endpoint [%s]" % endpoint)
+
+
+ENDPOINTS = ('/tzx2tap', '/tapsplit', '/tap2tzx', '/list', '/decompile')
+
+
+class ConversionHandler(http.server.BaseHTTPRequestHandler):
+  # Set by serve()
+  executor = None
+  workers = 1
+  cache = None
+  max_upload = 0
+  executor_lock = threading.Lock()
+
+  @classmethod
+  def replace_executor(cls, broken):
+    # Only the first request to find the pool broken replaces it
+    with cls.executor_lock:
+      if cls.executor is broken:
+        cls.executor = concurrent.futures.ProcessPoolExecutor(max_workers = cls.workers)
+        broken.shutdown(wait = False)
+
+  def send(self, status, content_type, body, cache_status = None):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    if cache_status:
+      self.send_header('X-Cache', cache_status)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def send_error_text(self, status, message):
+    self.send(status, 'text/plain; charset=utf-8', (message + '\n').encode('utf-8'))
+
+  def do_GET(self):
+    self.send_error_text(405, "POST a file to one of %s" % ', '.join(ENDPOINTS))
+
+  def do_POST(self):
+    url = urllib.parse.urlsplit(self.path)
+    if url.path not in ENDPOINTS:
+      self.send_error_text(404, "Unknown endpoint [%s]" % url.path)
+      return
+    try:
+      length = int(self.headers.get('Content-Length', ''))
+    except ValueError:
+      self.send_error_text(411, "Content-Length required")
+      return
+    if length < 0:
+      self.send_error_text(400, "Content-Length of %d bytes is negative" % length)
+      return
+    if length > self.max_upload:
+      self.send_error_text(413, "Upload of %d bytes is larger than %d bytes" % (length, self.max_upload))
+      return
+    body = self.rfile.read(length)
+    params = dict(urllib.parse.parse_qsl(url.query))
+
+    key = (url.path, tuple(sorted(params.items())), hashlib.sha256(body).digest())
+    entry = self.cache.get(key)
+    if entry is not None:
+      self.send(200, entry[0], entry[1], 'hit')
+      return
+    executor = self.executor
+    try:
+      entry = executor.submit(convert, url.path, params, body).result()
+    except RequestException as ex:
+      self.send_error_text(400, str(ex))
+      return
+    except concurrent.futures.process.BrokenProcessPool:
+      # A worker died, the request is not retried in case it was the cause
+      self.replace_executor(executor)
+      self.send_error_text(503, "Worker process failed, try again")
+      return
+    self.cache.put(key, entry)
+    self.send(200, entry[0], entry[1], 'miss')
+
+
+def serve(address, port, workers, cache_bytes, max_upload):
+  ConversionHandler.cache = LRUCache(cache_bytes)
+  ConversionHandler.max_upload = max_upload
+  ConversionHandler.workers = workers
+  ConversionHandler.executor = concurrent.futures.ProcessPoolExecutor(max_workers = workers)
+  try:
+    with http.server.ThreadingHTTPServer((address, port), ConversionHandler) as server:
+      print("Serving on http://%s:%d/ with %d workers" % (address, server.server_address[1], workers),
+            file = sys.stderr)
+      try:
+        server.serve_forever()
+      except KeyboardInterrupt:
+        pass
+  finally:
+    # The pool may have been replaced after a worker died
+    ConversionHandler.executor.shutdown()
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_address = '127.0.0.1'
+  default_port = 8080
+  default_workers = os.cpu_count() or 1
+  default_cache_mb = 64
+  default_max_upload_kb = 4096
+
+  parser = argparse.ArgumentParser(prog = "tapserver.py",
+                                   description = "HTTP service converting TZX and TAP files (v%s)." % __VERSION)
+  parser.add_argument('-b', '--bind',
+                      type = str,
+                      dest = 'address',
+                      default = default_address,
+                      help = "Address to listen on (default: %s)" % default_address)
+  parser.add_argument('-p', '--port',
+                      type = int,
+                      dest = 'port',
+                      default = default_port,
+                      help = "Port to listen on (default: %d)" % default_port)
+  parser.add_argument('-j', '--jobs',
+                      type = int,
+                      dest = 'workers',
+                      default = default_workers,
+                      help = "Number of worker processes (default: %d)" % default_workers)
+  parser.add_argument('-c', '--cache',
+                      type = int,
+                      dest = 'cache_mb',
+                      default = default_cache_mb,
+                      help = "Size of the result cache in MB (default: %d)" % default_cache_mb)
+  parser.add_argument('-m', '--maxupload',
+                      type = int,
+                      dest = 'max_upload_kb',
+                      default = default_max_upload_kb,
+                      help = "Largest upload accepted in KB (default: %d)" % default_max_upload_kb)
+  args = parser.parse_args()
+
+  serve(args.address, args.port, args.workers, args.cache_mb << 20, args.max_upload_kb << 10)
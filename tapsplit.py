@@ -23,9 +23,14 @@
 # SOFTWARE.
 ########################################################################
 import functools
+import io
 import os
 import sys
 
+import tappipeline
+import tapprogram
+import tapstats
+
 
 class BlockUnexpectedTypeException(Exception):
   def __init__(self, klass, offset, bid):
@@ -48,10 +53,15 @@ class Block(object):
     pos = tap_file.tell()
     block_length_bytes = tap_file.read(2)
     self.__block_length = int.from_bytes(block_length_bytes, "little")
+    if not self.__block_length:
+      raise BlockDataExhausted
+    remaining = tapprogram.remaining_length(tap_file)
+    if len(block_length_bytes) != 2 or (remaining is not None and self.__block_length > remaining):
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, remaining if remaining is not None else 0)
     tap_file.seek(pos)
     self._data = tap_file.read(self.__block_length + 2)
-    if not self._data or len(self._data) != self.__block_length + 2:
-      raise BlockDataExhausted
+    if len(self._data) != self.__block_length + 2:
+      raise tapprogram.BlockDataTruncated(pos, self.__block_length, len(self._data) - 2)
 
   def block_length(self):
     return self.__block_length
@@ -59,12 +69,16 @@ class Block(object):
   def write_data(self, fd):
     fd.write(self._data)
 
+  @property
+  def contents(self):
+    return self._data[2:]
+
 
 class Header(Block):
   def __init__(self, tap_file):
     pos = tap_file.tell()
     super(Header, self).__init__(tap_file)
-    self.__is_v2_tap = True if self.block_length == 27 else False
+    self.__is_v2_tap = True if self.block_length() == 27 else False
     if self.__is_v2_tap and self._data[2] != 0x00:
       raise BlockUnexpectedTypeException("header", pos, self._data[2])
 
@@ -86,65 +100,155 @@ class Data(Block):
       raise BlockUnexpectedTypeException("header", pos, self._data[2])
 
 
+def tap_programs(tap_fd):
+  """Yields a tapprogram.Program for each header/data block pair in a TAP stream."""
+  while(True):
+    try:
+      header = Header(tap_fd)
+    except BlockDataExhausted:
+      break
+    data = Data(tap_fd, header.is_v2_tap_file)
+    yield tapprogram.Program(header.contents, data.contents, header.is_v2_tap_file)
+
+
+def split_filename(tap_names, program):
+  valid_split_filename = program.name[:8]
+  if valid_split_filename in tap_names:
+    tap_idx = tap_names[valid_split_filename]
+    tap_idx += 1
+    tap_names[valid_split_filename] = tap_idx
+    tap_idx_s = "_%d" % tap_idx
+    unique_split_filename = valid_split_filename[0:-len(tap_idx_s)] + tap_idx_s
+  else:
+    tap_names[valid_split_filename] = 1
+    unique_split_filename = valid_split_filename
+  return (unique_split_filename + '.tap').upper()
+
+
+def tap_split_bytes(tap_bytes):
+  """Splits TAP file contents, returns a list of (TAP filename, TAP bytes) pairs."""
+  tap_names = dict()
+  return [(split_filename(tap_names, program), program.tap_bytes) \
+          for program in tap_programs(io.BytesIO(tap_bytes))]
+
+
 def tap_split(tap_file, tap_dir):
-  with open(tap_file, "rb") as tap_file_fd:
+  """Writes each program of a TAP file to its own TAP file, returns False if a block is bad.
+
+  The programs before a bad block are written.
+  """
+  rc = True
+  with tapstats.STATS.phase('file', file = tap_file), open(tap_file, "rb") as tap_file_fd:
     print(tap_file)
     tap_names = dict()
+    programs = tap_programs(tap_file_fd)
     while(True):
       try:
-        header = Header(tap_file_fd)
+        with tapstats.STATS.phase('parse', file = tap_file):
+          program = next(programs)
+      except StopIteration:
+        break
       except BlockDataExhausted:
+        print("%s: Missing data block" % tap_file, file = sys.stderr)
+        rc = False
         break
-      try:
-        data = Data(tap_file_fd, header.is_v2_tap_file)
-      except BlockDataExhausted as ex:
-        print("%s file is corrupt" % header.filename(), file = sys.stderr)
-        raise ex
-      print("\tFound program [%s] (%d:%d)" % (header.filename(), header.block_length(), data.block_length()), end = '')
-      valid_split_filename = header.filename()[:8]
-      if valid_split_filename in tap_names:
-        tap_idx = tap_names[valid_split_filename]
-        tap_idx += 1
-        tap_names[valid_split_filename] = tap_idx
-        tap_idx_s = "_%d" % tap_idx
-        unique_split_filename = valid_split_filename[0:-len(tap_idx_s)] + tap_idx_s
-      else:
-        tap_names[valid_split_filename] = 1
-        unique_split_filename = valid_split_filename
-      split_filename = (unique_split_filename + '.tap').upper()
-      print(", writing split file to [%s]..." % split_filename)
-      with open(os.path.join(tap_dir, split_filename), "wb") as split_tap:
-        header.write_data(split_tap)
-        data.write_data(split_tap)
+      except (tapprogram.BlockDataTruncated, BlockUnexpectedTypeException) as ex:
+        print("%s: %s" % (tap_file, ex), file = sys.stderr)
+        rc = False
+        break
+      print("\tFound program [%s] (%d:%d)" % (program.name, len(program.header), len(program.data)), end = '')
+      split_tap_filename = split_filename(tap_names, program)
+      print(", writing split file to [%s]..." % split_tap_filename)
+      with tapstats.STATS.phase('write', file = split_tap_filename), \
+           open(os.path.join(tap_dir, split_tap_filename), "wb") as split_tap:
+        tap_bytes = program.tap_bytes
+        split_tap.write(tap_bytes)
+      tapstats.STATS.count(bytes = len(tap_bytes), blocks = 2)
+    tapstats.STATS.count(files = 1)
+  return rc
+
+
+def remove_empty_dir(tap_dir):
+  if not os.listdir(tap_dir):
+    os.rmdir(tap_dir)
 
 
 def taps_split(tap_files, root_dir, force):
+  rc = True
   for tap_file in tap_files:
     tap_dirname, _ = os.path.splitext(os.path.basename(tap_file))
     tap_dirname = tap_dirname[:8].upper()
     tap_dir = os.path.realpath(os.path.join(root_dir, tap_dirname))
-    if not force and os.path.exists(tap_dir):
-      print("%s: TAP directory [%s] exists" % (os.path.realpath(tap_file), tap_dir),
-            file = sys.stderr)
-      return False
+    is_new_tap_dir = not os.path.exists(tap_dir)
+    if not is_new_tap_dir:
+      if not force:
+        print("%s: TAP directory [%s] exists" % (os.path.realpath(tap_file), tap_dir),
+              file = sys.stderr)
+        return False
     else:
       os.mkdir(tap_dir)
 
+    # Only a directory this run created, and nothing was written to, is removed
     try:
-      tap_split(tap_file, tap_dir)
+      is_split = tap_split(tap_file, tap_dir)
     except Exception as ex:
-      os.rmdir(tap_dir)
+      if is_new_tap_dir:
+        remove_empty_dir(tap_dir)
       raise ex
+    if not is_split:
+      rc = False
+      if is_new_tap_dir:
+        remove_empty_dir(tap_dir)
+  return rc
 
 
-if __name__ == '__main__':
+def taps_split_pipelined(tap_files, root_dir, force, inflight):
+  def read(tap_file):
+    with open(tap_file, 'rb') as tap_fd:
+      return tap_fd.read()
+
+  def convert(tap_file, tap_bytes):
+    tap_dirname, _ = os.path.splitext(os.path.basename(tap_file))
+    tap_dir = os.path.realpath(os.path.join(root_dir, tap_dirname[:8].upper()))
+    if os.path.exists(tap_dir) and not force:
+      raise FileExistsError("TAP directory [%s] exists" % tap_dir)
+    try:
+      taps = tap_split_bytes(tap_bytes)
+    except BlockDataExhausted:
+      raise BlockDataExhausted("%s file is corrupt" % tap_file)
+    # Files converted at the same time may share a TAP directory name, only
+    # the first to create the directory has it unless forced
+    try:
+      os.mkdir(tap_dir)
+    except FileExistsError:
+      if not force:
+        raise FileExistsError("TAP directory [%s] exists" % tap_dir)
+    print(tap_file)
+    for split_tap_filename, split_tap_bytes in taps:
+      print("\tFound program of length %d bytes, writing split file to [%s]..." % \
+            (len(split_tap_bytes), split_tap_filename))
+    tapstats.STATS.count(bytes = sum(map(lambda tap: len(tap[1]), taps)), blocks = 2 * len(taps), files = 1)
+    return [(os.path.join(tap_dir, split_tap_filename), split_tap_bytes) \
+            for split_tap_filename, split_tap_bytes in taps]
+
+  def write(tap_file, split_tap):
+    with open(split_tap[0], 'wb') as split_tap_fd:
+      split_tap_fd.write(split_tap[1])
+
+  errors = tappipeline.pipeline(tap_files, read, convert, write, inflight)
+  for tap_file, ex in errors:
+    print("%s: %s" % (os.path.realpath(tap_file), ex), file = sys.stderr)
+  return not errors
+
+
+def main(argv = None, prog = "tapsplit.py"):
   import argparse
 
   __VERSION = "1.1.0"
   default_root_dir = os.path.realpath(".")
   default_max_filename_len = 8
 
-  parser = argparse.ArgumentParser(prog = "tapsplit.py",
+  parser = argparse.ArgumentParser(prog = prog,
                                    description = "Creates separate TAP files from a multi-program TAP file (v%s)." % __VERSION)
   parser.add_argument('-f', '--force',
                       dest = 'force',
@@ -155,11 +259,26 @@ if __name__ == '__main__':
                       dest = 'root_dir',
                       default = default_root_dir,
                       help = 'Directory to which the TAP directory structure will be written (default: %s)' % default_root_dir)
+  parser.add_argument('-j', '--inflight',
+                      type = int,
+                      dest = 'inflight',
+                      default = 1,
+                      help = 'Number of TAP files read, split and written concurrently (default: 1)')
   parser.add_argument('tap_file',
                       type = str,
                       nargs = '+',
                       default = '',
                       help = 'TAP file to split')
-  args = parser.parse_args()
+  tapstats.add_arguments(parser)
+  args = parser.parse_args(argv)
+  tapstats.start(args)
+
+  if args.inflight > 1:
+    rc = taps_split_pipelined(args.tap_file, args.root_dir, args.force, args.inflight)
+  else:
+    rc = taps_split(args.tap_file, args.root_dir, args.force)
+  return rc
 
-  taps_split(args.tap_file, args.root_dir, args.force)
+
+if __name__ == '__main__':
+  sys.exit(not main())
@@ -0,0 +1,185 @@
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# Instrumentation shared by the utilities. Tools wrap their work in
+# phases and count the bytes and blocks they process:
+#
+#   with tapstats.STATS.phase('parse', file = tap_file):
+#     ...
+#   tapstats.STATS.count(bytes = len(data), blocks = 2)
+#
+# Phases may nest, the time reported for a phase excludes the time spent
+# in the phases nested within it. When neither --stats nor --trace is
+# given phases cost a method call.
+#
+########################################################################
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+class NullPhase(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception_value, exception_traceback):
+    return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase(object):
+  def __init__(self, stats, name, args):
+    self.__stats = stats
+    self.__name = name
+    self.__args = args
+
+  def __enter__(self):
+    self.__stats._push()
+    self.__start = time.perf_counter()
+    return self
+
+  def __exit__(self, exception_type, exception_value, exception_traceback):
+    end = time.perf_counter()
+    self.__stats._pop(self.__name, self.__start, end, self.__args)
+    return False
+
+
+class Stats(object):
+  def __init__(self):
+    self.__is_enabled = False
+    self.__is_reported = False
+    self.__trace_file = None
+    self.__events = list()
+    self.__phases = dict()
+    self.__nested = list()
+    self.__bytes = 0
+    self.__blocks = 0
+    self.__files = 0
+    self.__start = time.perf_counter()
+
+  @property
+  def is_enabled(self):
+    return self.__is_enabled
+
+  def enable(self, is_reported, trace_file = None):
+    self.__is_enabled = is_reported or trace_file is not None
+    self.__is_reported = is_reported
+    self.__trace_file = trace_file
+    self.__start = time.perf_counter()
+
+  def phase(self, name, **args):
+    return Phase(self, name, args) if self.__is_enabled else NULL_PHASE
+
+  def count(self, bytes = 0, blocks = 0, files = 0):
+    self.__bytes += bytes
+    self.__blocks += blocks
+    self.__files += files
+
+  def _push(self):
+    self.__nested.append(0.0)
+
+  def _pop(self, name, start, end, args):
+    duration = end - start
+    nested = self.__nested.pop()
+    if self.__nested:
+      self.__nested[-1] += duration
+    calls, total = self.__phases.get(name, (0, 0.0))
+    self.__phases[name] = (calls + 1, total + duration - nested)
+    if self.__trace_file:
+      self.__events.append({'name': name,
+                            'cat': 'tap',
+                            'ph': 'X',
+                            'ts': (start - self.__start) * 1e6,
+                            'dur': duration * 1e6,
+                            'pid': os.getpid(),
+                            'tid': threading.get_ident(),
+                            'args': args})
+
+  def peak_memory(self):
+    if resource is None:
+      return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+  def report(self, fd = sys.stderr):
+    elapsed = time.perf_counter() - self.__start
+    print("Phase            Calls    Time (s)", file = fd)
+    for name, (calls, total) in sorted(self.__phases.items(), key = lambda p: -p[1][1]):
+      print("%-15s %6d %11.6f" % (name, calls, total), file = fd)
+    print("Elapsed %.6fs, %d files, %d bytes (%.0f bytes/s), %d blocks (%.0f blocks/s)" % \
+          (elapsed, self.__files, self.__bytes, self.__bytes / elapsed if elapsed else 0,
+           self.__blocks, self.__blocks / elapsed if elapsed else 0),
+          file = fd)
+    peak = self.peak_memory()
+    if peak is not None:
+      print("Peak memory %d KiB" % (peak // 1024), file = fd)
+
+  def write_trace(self):
+    with open(self.__trace_file, 'w') as trace_fd:
+      json.dump({'traceEvents': self.__events, 'displayTimeUnit': 'ms'}, trace_fd)
+
+  def finish(self):
+    if self.__is_reported:
+      self.report()
+      self.__is_reported = False
+    if self.__trace_file:
+      self.write_trace()
+      self.__trace_file = None
+
+
+STATS = Stats()
+
+
+def add_arguments(parser):
+  parser.add_argument('--stats',
+                      dest = 'stats',
+                      action = 'store_true',
+                      help = 'Print time per phase, throughput and peak memory to stderr')
+  parser.add_argument('--trace',
+                      type = str,
+                      dest = 'trace',
+                      metavar = 'TRACE_FILE',
+                      help = 'Write Chrome trace events for each file and block to TRACE_FILE')
+
+
+def start(args):
+  """Enables instrumentation from parsed --stats and --trace arguments.
+
+  Once enabled it is left as it is, so that the commands of a batch are
+  reported together.
+  """
+  if STATS.is_enabled or not (args.stats or args.trace):
+    return
+  STATS.enable(args.stats, args.trace)
+  atexit.register(STATS.finish)
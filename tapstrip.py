@@ -0,0 +1,303 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# A word is kept if it is a root word or is used by a kept word:
+#
+#   compiled in a colon, DEFINER or COMPILER definition
+#   the DEFINER or COMPILER word whose DOES> or RUNS> code it uses
+#   an address, in a literal or constant, that is inside the word
+#
+# Machine code and CREATE words are not searched, words they use must be
+# given as roots. Without roots, every word no other word uses is a root,
+# so only comments are removed.
+#
+########################################################################
+import bisect
+import os
+import sys
+
+import tap2forth
+import taplink
+import tapprogram
+import tapstats
+
+
+COLON = 0x0ec3
+CONSTANT = 0x0ff5
+LITERAL = 0x1011
+COMMENT = 0x1379
+# Words followed by a branch offset, the target is relative to the word
+BRANCHES = (0x1271, 0x1276, 0x1283, 0x1288, 0x128d, 0x1332, 0x133c)
+
+
+class StripException(Exception):
+  pass
+
+
+def cell(parameters, idx):
+  return int.from_bytes(parameters[idx : idx + 2], "little")
+
+
+class WordIndex(object):
+  """Finds the word of a dictionary that holds an address."""
+  def __init__(self, words):
+    self.__words = words
+    self.__starts = [taplink.word_start(word) for word in words]
+
+  def word_at(self, addr):
+    idx = bisect.bisect_right(self.__starts, addr) - 1
+    if idx >= 0:
+      word = self.__words[idx]
+      if addr < self.__starts[idx] + len(word.name) + word.length:
+        return word
+    return None
+
+
+def word_references(word):
+  """Returns the addresses used by a word, any of them may be in other words."""
+  references = [word.code_addr]
+  thread_offset = tap2forth.THREAD_OFFSETS.get(word.code_addr)
+  if thread_offset is not None:
+    for idx in tap2forth.thread_cells(word.parameters, thread_offset):
+      command = cell(word.parameters, idx)
+      references.append(command)
+      if command == LITERAL:
+        references.append(cell(word.parameters, idx + 2))
+  elif word.code_addr == CONSTANT:
+    references.append(cell(word.parameters, 0))
+  return references
+
+
+def reachable_words(words, roots):
+  """Returns the execution addresses of the words used, directly or not, by the roots."""
+  index = WordIndex(words)
+  kept = set()
+  pending = list(roots)
+  while pending:
+    word = pending.pop()
+    if word.exec_addr in kept:
+      continue
+    kept.add(word.exec_addr)
+    for addr in word_references(word):
+      used_word = index.word_at(addr)
+      if used_word is not None and used_word.exec_addr not in kept:
+        pending.append(used_word)
+  return kept
+
+
+def unused_words(words):
+  """Returns the words no other word uses, the words a user could run."""
+  index = WordIndex(words)
+  used = set()
+  for word in words:
+    for addr in word_references(word):
+      used_word = index.word_at(addr)
+      if used_word is not None and used_word is not word:
+        used.add(used_word.exec_addr)
+  return [word for word in words if word.exec_addr not in used]
+
+
+def comment_spans(word):
+  """Returns the (start, end) parameter offsets of the comments of a colon definition."""
+  if word.code_addr != COLON:
+    return []
+  return [(idx, idx + 4 + cell(word.parameters, idx + 2)) \
+          for idx in tap2forth.thread_cells(word.parameters) if cell(word.parameters, idx) == COMMENT]
+
+
+def strip_comments(parameters, spans):
+  """Returns the parameters of a colon definition without comments, with branch offsets adjusted."""
+  def removed_before(offset):
+    return sum(end - start for start, end in spans if end <= offset)
+
+  stripped = bytearray(parameters)
+  for idx in tap2forth.thread_cells(parameters):
+    if cell(parameters, idx) in BRANCHES:
+      branch = int.from_bytes(parameters[idx + 2 : idx + 4], "little", signed = True)
+      target = idx + branch + 1
+      branch -= removed_before(target) - removed_before(idx)
+      stripped[idx + 2 : idx + 4] = branch.to_bytes(2, "little", signed = True)
+  for start, end in reversed(spans):
+    del stripped[start : end]
+  return stripped
+
+
+def strip(dictionary, root_names, is_comment_stripped, name):
+  """Returns (program, removed words, comment bytes removed) for a dictionary with only the reachable words."""
+  origin, end = dictionary.origin, dictionary.end
+  header = dictionary.header
+  for addr in (header.current, header.context, header.voclnk):
+    if origin <= addr < end:
+      raise StripException("Dictionaries with their own vocabularies cannot be stripped")
+
+  with tapstats.STATS.phase('parse', file = dictionary.tap_file):
+    words = dictionary.words()
+  if not words:
+    raise StripException("[%s] has no words" % dictionary.tap_file)
+  index = WordIndex(words)
+  contents = dictionary.contents
+
+  def link_of(word):
+    return cell(contents, word.exec_addr - 3 - origin)
+
+  with tapstats.STATS.phase('reachability', file = dictionary.tap_file):
+    by_name = dict((word.name.upper(), word) for word in words)
+    for root_name in root_names or ():
+      if root_name.upper() not in by_name:
+        raise StripException("Root word [%s] is not in [%s]" % (root_name, dictionary.tap_file))
+    try:
+      roots = [by_name[root_name.upper()] for root_name in root_names] if root_names else \
+              unused_words(words)
+      kept = reachable_words(words, roots)
+    except KeyError as ex:
+      raise StripException("[%s]: %s" % (dictionary.tap_file, ex))
+
+  def kept_link(link):
+    # The newest kept word older than the word linked to
+    while True:
+      word = index.word_at(link)
+      if word is None or word.exec_addr in kept:
+        return link
+      link = link_of(word)
+
+  with tapstats.STATS.phase('relocate', file = dictionary.tap_file):
+    # Lay out the kept words, and the parts of them kept, before any
+    # addresses are mapped
+    address_map = taplink.AddressMap(origin, end)
+    layout = list()
+    new_addr = origin
+    for word in words:
+      if word.exec_addr not in kept:
+        continue
+      spans = comment_spans(word) if is_comment_stripped else []
+      start = taplink.word_start(word)
+      parameters_start = word.exec_addr + 2
+      segment_start = start
+      for span_start, span_end in spans:
+        address_map.add(segment_start, parameters_start + span_start, new_addr)
+        new_addr += parameters_start + span_start - segment_start
+        segment_start = parameters_start + span_end
+      address_map.add(segment_start, start + len(word.name) + word.length, new_addr)
+      new_addr += start + len(word.name) + word.length - segment_start
+      layout.append((word, spans))
+
+    stripped_contents = bytearray()
+    comment_bytes = 0
+    for word, spans in layout:
+      name_length = len(word.name)
+      word_bytes = bytearray(contents[taplink.word_start(word) - origin : \
+                                      taplink.word_start(word) - origin + name_length + word.length])
+      if spans:
+        parameters = strip_comments(word.parameters, spans)
+        removed = len(word.parameters) - len(parameters)
+        word_bytes[name_length + 7:] = parameters
+        word_bytes[name_length : name_length + 2] = (word.length - removed).to_bytes(2, "little")
+        comment_bytes += removed
+      word_bytes[name_length + 2 : name_length + 4] = kept_link(link_of(word)).to_bytes(2, "little")
+      for addr in word_references(word)[1:]:
+        if origin <= addr < end and index.word_at(addr) is not None and \
+           addr != index.word_at(addr).exec_addr:
+          print("Word [%s] uses the address 0x%.4x, inside word [%s], as a number. It is not relocated" % \
+                (word.name, addr, index.word_at(addr).name), file = sys.stderr)
+      try:
+        taplink.relocate_word_bytes(word_bytes, name_length, word.code_addr, address_map)
+      except (KeyError, taplink.LinkException) as ex:
+        raise StripException("[%s] word [%s]: %s" % (dictionary.tap_file, word.name, ex))
+      stripped_contents += word_bytes
+
+    latest = address_map.map(kept_link(header.latest))
+  removed_words = [word.name for word in words if word.exec_addr not in kept]
+  program = tapprogram.dictionary_program(name, bytes(stripped_contents), latest, header.current, header.context,
+                                          header.voclnk, origin)
+  return (program, removed_words, comment_bytes)
+
+
+def tap_strip(tap_file, tap_output, root_names, is_comment_stripped, tap_name, force):
+  if not force and os.path.exists(tap_output):
+    print("TAP file [%s] exists. Use -f to overwrite it" % tap_output, file = sys.stderr)
+    return False
+
+  try:
+    with tapstats.STATS.phase('read', file = tap_file):
+      dictionary = taplink.Dictionary(tap_file)
+    program, removed_words, comment_bytes = strip(dictionary, root_names, is_comment_stripped, tap_name)
+  except (tap2forth.BlockDataExhausted, tapprogram.BlockDataTruncated, tap2forth.BlockDataCorruption,
+          tap2forth.BlockDataNotSupportedType, StripException, taplink.LinkException, OSError) as ex:
+    print(ex, file = sys.stderr)
+    return False
+  tapstats.STATS.count(bytes = len(dictionary.contents), blocks = 2, files = 1)
+
+  with tapstats.STATS.phase('write', file = tap_output), open(tap_output, 'wb') as tap_fd:
+    tap_fd.write(program.tap_bytes)
+  if not root_names:
+    print("No root words given, words no other word uses are kept", file = sys.stderr)
+  if removed_words:
+    print("Removed %d words: %s" % (len(removed_words), ' '.join(removed_words)), file = sys.stderr)
+  if is_comment_stripped:
+    print("Removed %d bytes of comments" % comment_bytes, file = sys.stderr)
+  print("Dictionary of %d bytes stripped to %d bytes in [%s]" % \
+        (len(dictionary.contents), len(program.data) - 2, tap_output), file = sys.stderr)
+  return True
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+
+  parser = argparse.ArgumentParser(prog = "tapstrip.py",
+                                   description = "Remove the words a Forth TAP file does not use (v%s)." % __VERSION)
+  parser.add_argument('-o', '--output',
+                      type = str,
+                      required = True,
+                      dest = 'tap_output',
+                      help = "Output TAP file")
+  parser.add_argument('-r', '--root',
+                      type = str,
+                      action = 'append',
+                      dest = 'root_names',
+                      help = "Word the program runs, may be repeated (default: every word no other word uses)")
+  parser.add_argument('-c', '--comments',
+                      dest = 'is_comment_stripped',
+                      action = 'store_true',
+                      help = "Also remove ( ... ) comments from colon definitions")
+  parser.add_argument('-t', '--tapname',
+                      type = str,
+                      dest = 'tap_name',
+                      help = "Name of the stripped program (default: output file name)")
+  parser.add_argument('-f', '--force',
+                      dest = 'force',
+                      action = 'store_true',
+                      help = "Overwrite the output TAP file if it exists")
+  parser.add_argument('tap_file',
+                      type = str,
+                      help = "Forth TAP file")
+  tapstats.add_arguments(parser)
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  tap_name = args.tap_name if args.tap_name else os.path.splitext(os.path.basename(args.tap_output))[0].lower()
+  rc = tap_strip(args.tap_file, args.tap_output, args.root_names, args.is_comment_stripped, tap_name, args.force)
+  sys.exit(not rc)
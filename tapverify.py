@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# Errors found in TAP files:
+#
+#   checksum      the checksum byte does not match the block
+#   format        the checksum matches a v1 block in a v2 program, or a v2
+#                 block in a v1 program, the flag byte has been included
+#                 in, or left out of, the checksum
+#   truncated     the block is longer than the rest of the file
+#   missing_data  the last header block has no data block
+#
+# Checksum and format errors can be repaired by writing the checksum of
+# the program's format, v2 if its header block is a v2 header.
+#
+########################################################################
+import concurrent.futures
+import json
+import os
+import sys
+
+import tapfiles
+import tapprogram
+import tapstats
+
+
+CHECKSUM = 'checksum'
+FORMAT = 'format'
+TRUNCATED = 'truncated'
+MISSING_DATA = 'missing_data'
+REPAIRABLE = (CHECKSUM, FORMAT)
+
+
+def block_error(error, block, offset, **details):
+  return dict(error = error, block = block, offset = offset, **details)
+
+
+def verify_tap_bytes(tap_bytes):
+  """Returns (number of blocks, [error, ...]) for the contents of a TAP file.
+
+  Errors are dictionaries of the error type, block number and offset of
+  the block's length, with the checksums for checksum and format errors.
+  Blocks are checked to the end of the file, or the first truncated block.
+  """
+  errors = list()
+  offset = 0
+  block = 0
+  is_v2 = False
+  while offset < len(tap_bytes):
+    if offset + 2 > len(tap_bytes):
+      errors.append(block_error(TRUNCATED, block, offset, length = None, remaining = len(tap_bytes) - offset))
+      break
+    length = int.from_bytes(tap_bytes[offset : offset + 2], "little")
+    if not length:
+      break
+    start = offset + 2
+    if start + length > len(tap_bytes):
+      errors.append(block_error(TRUNCATED, block, offset, length = length, remaining = len(tap_bytes) - start))
+      break
+    data = tap_bytes[start : start + length]
+    if block % 2 == 0:
+      is_v2 = length == 27 and data[0] == 0x00
+    # A v2 checksum leaves out the flag byte, a v1 checksum would include it
+    v2_checksum = tapprogram.checksum(data[1:-1])
+    v1_checksum = v2_checksum ^ data[0] if length > 1 else 0
+    expected, other = (v2_checksum, v1_checksum) if is_v2 else (v1_checksum, v2_checksum)
+    if data[-1] != expected:
+      errors.append(block_error(FORMAT if data[-1] == other else CHECKSUM, block, offset,
+                                length = length, version = 2 if is_v2 else 1, checksum = data[-1],
+                                expected = expected))
+    offset = start + length
+    block += 1
+  if block % 2 and not any(error['error'] == TRUNCATED for error in errors):
+    errors.append(block_error(MISSING_DATA, block, offset))
+  return (block, errors)
+
+
+def repair(tap_file, errors):
+  """Writes the expected checksum byte of each repairable error to a TAP file."""
+  with open(tap_file, 'r+b') as tap_fd:
+    for error in errors:
+      if error['error'] in REPAIRABLE:
+        # The checksum is the last byte of the block, after its length
+        tap_fd.seek(error['offset'] + 1 + error['length'])
+        tap_fd.write(bytes([error['expected']]))
+        error['repaired'] = True
+
+
+def verify_file(tap_file, is_repaired = False):
+  """Returns the report of a TAP file, run in a worker process."""
+  report = dict(file = tap_file, blocks = 0, errors = list())
+  try:
+    with open(tap_file, 'rb') as tap_fd:
+      tap_bytes = tap_fd.read()
+    report['size'] = len(tap_bytes)
+    report['blocks'], report['errors'] = verify_tap_bytes(tap_bytes)
+    if is_repaired and any(error['error'] in REPAIRABLE for error in report['errors']):
+      repair(tap_file, report['errors'])
+  except OSError as ex:
+    report['exception'] = str(ex)
+  return report
+
+
+def tap_files(paths):
+  """Yields the TAP files in paths, directories are searched recursively."""
+  for tape_file in tapfiles.tape_files(paths):
+    if os.path.isfile(tape_file) and os.path.splitext(tape_file)[1].lower() == '.tzx':
+      continue
+    yield tape_file
+
+
+def error_text(error):
+  if error['error'] == TRUNCATED:
+    return "block %d at offset %d is truncated, %d bytes remaining" % (error['block'], error['offset'],
+                                                                       error['remaining'])
+  if error['error'] == MISSING_DATA:
+    return "header block %d has no data block" % (error['block'] - 1)
+  if error['error'] == FORMAT:
+    reason = "v%d checksum [%.2x] of a v%d block, expected [%.2x]" % \
+      (3 - error['version'], error['checksum'], error['version'], error['expected'])
+  else:
+    reason = "CRC ERROR (checksum [%.2x], expected [%.2x])" % (error['checksum'], error['expected'])
+  return "block %d at offset %d, %s%s" % (error['block'], error['offset'], reason,
+                                          ", repaired" if error.get('repaired') else '')
+
+
+def verify(paths, is_repaired, workers, report_file = None):
+  """Verifies every TAP file in paths on a process pool, returns True if none have unrepaired errors."""
+  reports = list()
+  with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+    files = list(tap_files(paths))
+    chunk_size = max(1, min(64, len(files) // (4 * workers)))
+    for report in executor.map(verify_file, files, [is_repaired] * len(files), chunksize = chunk_size):
+      with tapstats.STATS.phase('report', file = report['file']):
+        if 'exception' in report:
+          print(report['exception'], file = sys.stderr)
+        for error in report['errors']:
+          print("%s: %s" % (report['file'], error_text(error)), file = sys.stderr)
+      tapstats.STATS.count(bytes = report.get('size', 0), blocks = report['blocks'], files = 1)
+      reports.append(report)
+
+  errors = [error for report in reports for error in report['errors']]
+  summary = {'files': len(reports),
+             'blocks': sum(report['blocks'] for report in reports),
+             'unreadable_files': sum(1 for report in reports if 'exception' in report),
+             'files_with_errors': sum(1 for report in reports if report['errors']),
+             'errors': {error_type: sum(1 for error in errors if error['error'] == error_type) \
+                        for error_type in (CHECKSUM, FORMAT, TRUNCATED, MISSING_DATA)},
+             'repaired': sum(1 for error in errors if error.get('repaired'))}
+  print("%d TAP files, %d blocks, %d errors in %d files, %d repaired" % \
+        (summary['files'], summary['blocks'], len(errors), summary['files_with_errors'], summary['repaired']),
+        file = sys.stderr)
+  if report_file:
+    report = {'summary': summary, 'files': [report for report in reports if report['errors'] or 'exception' in report]}
+    if report_file == '-':
+      json.dump(report, sys.stdout, indent = 1)
+      print()
+    else:
+      with open(report_file, 'w') as report_fd:
+        json.dump(report, report_fd, indent = 1)
+  return summary['unreadable_files'] == 0 and summary['repaired'] == len(errors)
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_workers = os.cpu_count() or 1
+
+  parser = argparse.ArgumentParser(prog = "tapverify.py",
+                                   description = "Verify, and repair, the checksums of every block of TAP files (v%s)." % __VERSION)
+  parser.add_argument('-r', '--repair',
+                      dest = 'is_repaired',
+                      action = 'store_true',
+                      help = "Rewrite the checksum byte of blocks with checksum and format errors")
+  parser.add_argument('-j', '--jobs',
+                      type = int,
+                      dest = 'workers',
+                      default = default_workers,
+                      help = "Number of worker processes (default: %d)" % default_workers)
+  parser.add_argument('-o', '--report',
+                      type = str,
+                      dest = 'report_file',
+                      help = "Write a JSON report of the errors to REPORT_FILE, - for stdout")
+  parser.add_argument('paths',
+                      nargs = '+',
+                      type = str,
+                      help = "TAP files, or directories to search for them")
+  tapstats.add_arguments(parser)
+  args = parser.parse_args()
+  tapstats.start(args)
+
+  rc = verify(args.paths, args.is_repaired, max(1, args.workers), args.report_file)
+  sys.exit(not rc)
@@ -0,0 +1,176 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import concurrent.futures
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import tapfiles
+
+
+def publish(root_dir, dirname, taps, force):
+  # TAP files are written to a temporary directory in the root directory,
+  # which is renamed into place, so the card never sees a partial directory.
+  tap_dir = os.path.join(root_dir, dirname)
+  if os.path.exists(tap_dir) and not force:
+    raise FileExistsError("TAP directory [%s] exists" % tap_dir)
+  tmp_dir = tempfile.mkdtemp(prefix = '.%s-' % dirname, dir = root_dir)
+  try:
+    for tap_filename, tap_bytes in taps:
+      with open(os.path.join(tmp_dir, tap_filename), 'wb') as tap_fd:
+        tap_fd.write(tap_bytes)
+    if os.path.exists(tap_dir):
+      old_dir = tempfile.mkdtemp(prefix = '.%s-' % dirname, dir = root_dir)
+      os.rename(tap_dir, os.path.join(old_dir, dirname))
+      os.rename(tmp_dir, tap_dir)
+      shutil.rmtree(old_dir)
+    else:
+      os.rename(tmp_dir, tap_dir)
+  except Exception as ex:
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+    raise ex
+  return tap_dir
+
+
+def convert(pathname, root_dir, force):
+  published = list()
+  for dirname, taps in tapfiles.input_conversions(pathname):
+    published.append((publish(root_dir, dirname, taps, force), len(taps)))
+  return published
+
+
+class Watcher(object):
+  def __init__(self, watch_dir, settle):
+    self.__watch_dir = watch_dir
+    self.__settle = settle
+    self.__pending = dict()
+    self.__done = dict()
+
+  @property
+  def has_pending(self):
+    return len(self.__pending) > 0
+
+  def scan(self):
+    """Returns the input files that have not changed for the settle time."""
+    now = time.monotonic()
+    ready = list()
+    seen = set()
+    with os.scandir(self.__watch_dir) as entries:
+      for entry in entries:
+        _, ext = os.path.splitext(entry.name)
+        if entry.name.startswith('.') or ext.lower() not in tapfiles.INPUT_EXTENSIONS or \
+           not entry.is_file():
+          continue
+        stat = entry.stat()
+        signature = (stat.st_size, stat.st_mtime_ns)
+        seen.add(entry.path)
+        if self.__done.get(entry.path) == signature:
+          continue
+        pending = self.__pending.get(entry.path)
+        if pending is None or pending[0] != signature:
+          self.__pending[entry.path] = (signature, now)
+        elif now - pending[1] >= self.__settle:
+          del self.__pending[entry.path]
+          self.__done[entry.path] = signature
+          ready.append(entry.path)
+    for pathname in set(self.__pending) - seen:
+      del self.__pending[pathname]
+    for pathname in set(self.__done) - seen:
+      del self.__done[pathname]
+    return ready
+
+
+def watch(watch_dir, root_dir, force, interval, settle, jobs, once):
+  watcher = Watcher(watch_dir, 0 if once else settle)
+  with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) as executor:
+    futures = dict()
+    while True:
+      for pathname in watcher.scan():
+        futures[executor.submit(convert, pathname, root_dir, force)] = pathname
+      if futures:
+        done, _ = concurrent.futures.wait(futures, timeout = 0 if not once else None)
+        for future in done:
+          pathname = futures.pop(future)
+          try:
+            for tap_dir, no_taps in future.result():
+              print("%s: wrote %d TAP files to [%s]" % (pathname, no_taps, tap_dir), file = sys.stderr)
+          except Exception as ex:
+            print("%s: %s" % (pathname, ex), file = sys.stderr)
+      if once and not futures and not watcher.has_pending:
+        break
+      time.sleep(interval)
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_root_dir = os.path.realpath(".")
+  default_interval = 1.0
+  default_settle = 2.0
+  default_jobs = os.cpu_count() or 1
+
+  parser = argparse.ArgumentParser(prog = "tapwatch.py",
+                                   description = "Watches a directory, converting TZX, TAP and ZIP files for use with the Jester Ace (v%s)." % __VERSION)
+  parser.add_argument('-f', '--force',
+                      dest = 'force',
+                      action = 'store_true',
+                      help = 'Replace TAP directories that exist')
+  parser.add_argument('-d', '--rootdir',
+                      type = str,
+                      dest = 'root_dir',
+                      default = default_root_dir,
+                      help = 'Directory to which the TAP directory structure will be written (default: %s)' % default_root_dir)
+  parser.add_argument('-i', '--interval',
+                      type = float,
+                      dest = 'interval',
+                      default = default_interval,
+                      help = 'Seconds between directory scans (default: %.1f)' % default_interval)
+  parser.add_argument('-s', '--settle',
+                      type = float,
+                      dest = 'settle',
+                      default = default_settle,
+                      help = 'Seconds a file must be unchanged before it is converted (default: %.1f)' % default_settle)
+  parser.add_argument('-j', '--jobs',
+                      type = int,
+                      dest = 'jobs',
+                      default = default_jobs,
+                      help = 'Number of conversion processes (default: %d)' % default_jobs)
+  parser.add_argument('-1', '--once',
+                      dest = 'once',
+                      action = 'store_true',
+                      help = 'Convert the files in the directory then exit')
+  parser.add_argument('watch_dir',
+                      type = str,
+                      help = 'Directory to watch')
+  args = parser.parse_args()
+
+  try:
+    watch(args.watch_dir, os.path.realpath(args.root_dir), args.force,
+          args.interval, args.settle, args.jobs, args.once)
+  except KeyboardInterrupt:
+    pass
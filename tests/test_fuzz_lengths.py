@@ -0,0 +1,288 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+#
+# TAP and TZX files with truncated blocks, oversized length fields and
+# flipped bytes are read by each parser, with the peak memory of each read
+# measured by tracemalloc. Run as a script for a longer benchmark:
+#
+#   python tests/test_fuzz_lengths.py -n 20000
+#
+########################################################################
+import collections
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acetape
+import tap2forth
+import tap2tzx
+import tapls
+import tapprogram
+import tapsplit
+import tzx2tap
+
+
+# Peak memory allowed for reading one mutated file, far below what an
+# allocation sized by a corrupt 16 or 24 bit length field would need
+MAX_PEAK_BYTES = 256 << 10
+DEFAULT_ITERATIONS = 300
+DEFAULT_SEED = 36
+
+
+def forth_word(name, link, thread):
+  # name, length, link, name length, code field (colon), parameters
+  parameters = b''.join(addr.to_bytes(2, 'little') for addr in thread)
+  return name[:-1].encode('ascii') + bytes([ord(name[-1]) | 0x80]) + (7 + len(parameters)).to_bytes(2, 'little') + \
+    link.to_bytes(2, 'little') + bytes([len(name)]) + (0x0ec3).to_bytes(2, 'little') + parameters
+
+
+def seed_tap():
+  """Returns a TAP file of a small Forth dictionary and a bytes program."""
+  contents = b''.join(forth_word("W%d" % word, 0x3c49, [0x086b, 0x0dd2, 0x04b6]) for word in range(8))
+  dictionary = tapprogram.dictionary_program("fuzz", contents, tapprogram.DICTIONARY_ORIGIN)
+  code = bytes(range(64))
+  header = bytes([0x20]) + b"code      " + len(code).to_bytes(2, 'little') + (0x4000).to_bytes(2, 'little') + \
+    bytes([0x20] * 10)
+  program = tapprogram.Program(tapprogram.v2_block(0x00, header), tapprogram.v2_block(0xff, code), is_v2 = True)
+  return dictionary.tap_bytes + program.tap_bytes
+
+
+def seed_tzx(tap_bytes):
+  """Returns a TZX file of a TAP file, with standard and turbo speed blocks."""
+  return tap2tzx.tap_to_tzx_bytes([tap_bytes], 100) + \
+    tap2tzx.tap_to_tzx_bytes([tap_bytes], 100, acetape.STANDARD_TIMINGS.scaled(2))[10:]
+
+
+def tap_length_offsets(tap_bytes):
+  offsets = list()
+  offset = 0
+  while offset + 2 <= len(tap_bytes):
+    offsets.append((offset, 2))
+    offset += 2 + int.from_bytes(tap_bytes[offset : offset + 2], 'little')
+  return offsets
+
+
+def tzx_length_offsets(tzx_bytes):
+  # Only the standard (0x10) and turbo (0x11) speed blocks the seeds hold
+  offsets = list()
+  offset = 10
+  while offset < len(tzx_bytes):
+    if tzx_bytes[offset] == 0x10:
+      offsets.append((offset + 3, 2))
+      offset += 5 + int.from_bytes(tzx_bytes[offset + 3 : offset + 5], 'little')
+    else:
+      offsets.append((offset + 16, 3))
+      offset += 19 + int.from_bytes(tzx_bytes[offset + 16 : offset + 19], 'little')
+  return offsets
+
+
+def mutate(rng, seed_bytes, length_offsets):
+  """Returns (mutation, mutated bytes)."""
+  mutated = bytearray(seed_bytes)
+  mutation = rng.choice(('oversized', 'truncated', 'flipped', 'oversized+truncated'))
+  if 'oversized' in mutation:
+    offset, size = rng.choice(length_offsets)
+    value = rng.choice(((1 << (8 * size)) - 1, rng.randrange(len(seed_bytes), 1 << (8 * size))))
+    mutated[offset : offset + size] = value.to_bytes(size, 'little')
+  if 'truncated' in mutation:
+    del mutated[rng.randrange(1, len(mutated)):]
+  if mutation == 'flipped':
+    for _ in range(rng.randint(1, 4)):
+      mutated[rng.randrange(len(mutated))] ^= 1 << rng.randrange(8)
+  return (mutation, bytes(mutated))
+
+
+def read_tap_tapls(tap_bytes):
+  return list(tapls.tap_programs(io.BytesIO(tap_bytes)))
+
+
+def read_tap_tapsplit(tap_bytes):
+  return tapsplit.tap_split_bytes(tap_bytes)
+
+
+def read_tap_tap2tzx(tap_bytes):
+  return tap2tzx.tap_to_tzx_bytes([tap_bytes], 100)
+
+
+def read_tap_tap2forth(tap_bytes):
+  tap_fd = io.BytesIO(tap_bytes)
+  hdr = tap2forth.HeaderBlock(tap_fd)
+  data = tap2forth.DataBlock(tap_fd, hdr.is_v2_tap_file)
+  try:
+    data.decompile(hdr.origin, tap2forth.Formatter(80, io.StringIO()))
+  finally:
+    tap2forth.FORTH_WORDS.reset()
+
+
+def read_tzx_tzx2tap(tzx_bytes):
+  return tzx2tap.tzx_convert_bytes(tzx_bytes)
+
+
+TAP_READERS = (read_tap_tapls, read_tap_tapsplit, read_tap_tap2tzx, read_tap_tap2forth)
+TZX_READERS = (read_tzx_tzx2tap,)
+
+
+def fuzz(iterations, seed):
+  """Returns (peak bytes, {(reader, outcome): count}, seconds) of reading mutated files."""
+  rng = random.Random(seed)
+  tap_bytes = seed_tap()
+  tzx_bytes = seed_tzx(tap_bytes)
+  cases = [(tap_bytes, tap_length_offsets(tap_bytes), TAP_READERS),
+           (tzx_bytes, tzx_length_offsets(tzx_bytes), TZX_READERS)]
+  # The ROM words are built once, outside the measured reads
+  tap2forth.FORTH_WORDS[0x0ec3]
+  outcomes = collections.Counter()
+  peak = 0
+  start = time.perf_counter()
+  tracemalloc.start()
+  try:
+    for iteration in range(iterations):
+      seed_bytes, length_offsets, readers = cases[iteration % len(cases)]
+      mutation, mutated = mutate(rng, seed_bytes, length_offsets)
+      for reader in readers:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        try:
+          reader(mutated)
+          outcome = 'ok'
+        except MemoryError:
+          raise
+        except Exception as ex:
+          outcome = type(ex).__name__
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        outcomes[(reader.__name__, mutation, outcome)] += 1
+  finally:
+    tracemalloc.stop()
+  return (peak, outcomes, time.perf_counter() - start)
+
+
+class FuzzLengthsTest(unittest.TestCase):
+  def test_peak_memory_is_bounded(self):
+    peak, outcomes, _ = fuzz(DEFAULT_ITERATIONS, DEFAULT_SEED)
+    self.assertLess(peak, MAX_PEAK_BYTES)
+    # The corrupt lengths were found, not just the flipped bytes
+    self.assertTrue(any(outcome == 'BlockDataTruncated' for _, _, outcome in outcomes))
+    self.assertTrue(any(outcome == 'TZXBlockTruncatedException' for _, _, outcome in outcomes))
+
+  def test_seeds_are_read(self):
+    tap_bytes = seed_tap()
+    self.assertEqual(len(read_tap_tapls(tap_bytes)), 2)
+    self.assertEqual(len(read_tzx_tzx2tap(seed_tzx(tap_bytes))), 4)
+    read_tap_tap2forth(tap_bytes)
+
+
+class CommandLineTest(unittest.TestCase):
+  """The utilities report files with bad lengths on stderr and return False."""
+  COMMANDS = (('tapls', lambda tap_file, out_dir: tapls.main([tap_file])),
+              ('tap2tzx', lambda tap_file, out_dir: tap2tzx.main(['-o', os.path.join(out_dir, 'out.tzx'), tap_file])),
+              ('tapsplit', lambda tap_file, out_dir: tapsplit.main(['-d', out_dir, tap_file])),
+              ('tapsplit -j', lambda tap_file, out_dir: tapsplit.main(['-j', '2', '-d', out_dir, tap_file])))
+
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def run_command(self, command, tap_bytes, name):
+    tap_file = os.path.join(self.tmp_dir.name, name + '.tap')
+    out_dir = os.path.join(self.tmp_dir.name, name)
+    os.mkdir(out_dir)
+    with open(tap_file, 'wb') as tap_fd:
+      tap_fd.write(tap_bytes)
+    stderr = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr):
+      rc = command(tap_file, out_dir)
+    return (rc, stderr.getvalue(), tap_file, out_dir)
+
+  def test_oversized_second_header(self):
+    tap_bytes = bytearray(seed_tap())
+    offset, _ = tap_length_offsets(tap_bytes)[2]
+    tap_bytes[offset : offset + 2] = b'\xff\xff'
+    for name, command in self.COMMANDS:
+      with self.subTest(command = name):
+        rc, stderr, tap_file, out_dir = self.run_command(command, bytes(tap_bytes), name.replace(' ', ''))
+        self.assertFalse(rc)
+        self.assertIn(os.path.basename(tap_file), stderr)
+        self.assertIn("truncated", stderr)
+        self.assertNotIn("Traceback", stderr)
+
+  def test_header_without_data(self):
+    tap_bytes = seed_tap()
+    offset, _ = tap_length_offsets(tap_bytes)[3]
+    # tapls lists the programs before a header without data
+    for name, command in self.COMMANDS[1:]:
+      with self.subTest(command = name):
+        rc, stderr, tap_file, out_dir = self.run_command(command, tap_bytes[:offset], name.replace(' ', ''))
+        self.assertFalse(rc)
+        self.assertIn(os.path.basename(tap_file), stderr)
+
+  def test_mutated_lengths(self):
+    rng = random.Random(DEFAULT_SEED)
+    tap_bytes = seed_tap()
+    length_offsets = tap_length_offsets(tap_bytes)
+    for idx in range(20):
+      mutation, mutated = mutate(rng, tap_bytes, length_offsets)
+      if mutation == 'flipped':
+        continue
+      for name, command in self.COMMANDS:
+        with self.subTest(command = name, file = idx, mutation = mutation):
+          rc, stderr, tap_file, out_dir = self.run_command(command, mutated, "%s%d" % (name.replace(' ', ''), idx))
+          self.assertIn(rc, (True, False))
+          if not rc:
+            self.assertIn(os.path.basename(tap_file), stderr)
+          # A TAP directory with nothing written to it is not left behind
+          for dir_path, dir_names, file_names in os.walk(out_dir):
+            self.assertTrue(dir_path == out_dir or file_names)
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser(description = "Benchmark the parsers on TAP and TZX files with corrupt lengths.")
+  parser.add_argument('-n', '--iterations',
+                      type = int,
+                      default = 10000,
+                      help = "Number of mutated files (default: 10000)")
+  parser.add_argument('-s', '--seed',
+                      type = int,
+                      default = DEFAULT_SEED,
+                      help = "Random seed (default: %d)" % DEFAULT_SEED)
+  args = parser.parse_args()
+
+  peak, outcomes, seconds = fuzz(args.iterations, args.seed)
+  for (reader, mutation, outcome), count in sorted(outcomes.items()):
+    print("%-20s %-20s %-28s %6d" % (reader, mutation, outcome, count))
+  print("%d files in %.2fs, peak memory of a read %d bytes (limit %d)" % \
+        (args.iterations, seconds, peak, MAX_PEAK_BYTES))
+  sys.exit(peak >= MAX_PEAK_BYTES)
@@ -0,0 +1,60 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tapautorun
+
+
+class CommandPartsTest(unittest.TestCase):
+  def test_file_names_are_kept_with_their_word(self):
+    self.assertEqual(tapautorun.command_parts("load fireone1 0 0 bload firescr 16384 call"),
+                     ["load fireone1", "0", "0", "bload firescr", "16384", "call"])
+
+  def test_text_is_kept_with_its_word(self):
+    self.assertEqual(tapautorun.command_parts('cls ." Fire  One" ( main ) .( x) run'),
+                     ["cls", '." Fire  One"', "( main )", ".( x)", "run"])
+
+  def test_text_ends_at_its_delimiter(self):
+    self.assertEqual(tapautorun.command_parts('." a"b c'), ['." a"', "b", "c"])
+
+  def test_unterminated_text_runs_to_the_end(self):
+    self.assertEqual(tapautorun.command_parts("1 ( no end 2"), ["1", "( no end 2"])
+
+  def test_text_is_not_split_across_links(self):
+    command = 'load fireone1 ." go  go" load fireone2 ( skip it ) 16384 call'
+    links = tapautorun.chained_commands("exec", command)
+    self.assertEqual([link_command for _, link_command in links],
+                     ["load fireone1 0 0 bload exec1", '." go  go" 0 0 bload exec2',
+                      "load fireone2 0 0 bload exec3", "( skip it ) 16384 call"])
+    for _, link_command in links:
+      self.assertLessEqual(len(link_command), tapautorun.MAX_COMMAND_LEN)
+
+
+if __name__ == '__main__':
+  unittest.main()
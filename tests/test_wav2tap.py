@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import os
+import sys
+import tempfile
+import unittest
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acetape
+import tapprogram
+import wav2tap
+
+
+RATE = 44100
+HIGH_SAMPLE = 0xe0
+LOW_SAMPLE = 0x20
+SILENT_SAMPLE = 0x80
+
+
+def block_pulses(block):
+  """Returns the pulse lengths, in T-states, of a block at standard speed."""
+  pulses = [acetape.PILOT_PULSE] * acetape.DATA_PILOT_PULSES + [acetape.SYNC1_PULSE, acetape.SYNC2_PULSE]
+  for byte in block:
+    for bit in range(7, -1, -1):
+      pulses += [acetape.ONE_PULSE if byte & (1 << bit) else acetape.ZERO_PULSE] * 2
+  return pulses
+
+
+def write_wav(wav_file, pulses, trailing_silence):
+  """Writes 8 bit mono samples of alternating levels, one level per pulse."""
+  samples = bytearray()
+  level = HIGH_SAMPLE
+  elapsed = 0
+  for pulse in pulses:
+    start = round(elapsed * RATE / acetape.ACE_CLOCK_HZ)
+    elapsed += pulse
+    samples += bytes([level]) * (round(elapsed * RATE / acetape.ACE_CLOCK_HZ) - start)
+    level = LOW_SAMPLE if level == HIGH_SAMPLE else HIGH_SAMPLE
+  samples += bytes([SILENT_SAMPLE]) * trailing_silence
+  with wave.open(wav_file, 'wb') as wav:
+    wav.setnchannels(1)
+    wav.setsampwidth(1)
+    wav.setframerate(RATE)
+    wav.writeframes(bytes(samples))
+
+
+class LastBitTest(unittest.TestCase):
+  def setUp(self):
+    self.block = tapprogram.v2_block(0xff, bytes([0x01, 0x80, 0x55, 0xff]))
+    self.wav_file = tempfile.NamedTemporaryFile(suffix = '.wav', delete = False).name
+
+  def tearDown(self):
+    os.remove(self.wav_file)
+
+  def check_blocks(self, trailing_silence):
+    write_wav(self.wav_file, block_pulses(self.block), trailing_silence)
+    self.assertEqual(list(wav2tap.wav_blocks(self.wav_file, 10)), [self.block])
+
+  def test_recording_ends_after_last_edge(self):
+    # The last half pulse runs to the end of the recording
+    self.check_blocks(0)
+
+  def test_silence_after_last_edge(self):
+    self.check_blocks(RATE * wav2tap.SILENCE_MS // 500)
+
+  def test_segment_ends_after_last_edge(self):
+    write_wav(self.wav_file, block_pulses(self.block) + [acetape.PILOT_PULSE] * 4, 0)
+    end = round(sum(block_pulses(self.block)) * RATE / acetape.ACE_CLOCK_HZ)
+    self.assertEqual(list(wav2tap.wav_blocks(self.wav_file, 10, 0, end)), [self.block])
+
+
+if __name__ == '__main__':
+  unittest.main()
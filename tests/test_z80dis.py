@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import z80dis
+
+
+# Every opcode is followed by the bytes 34 12, so n is $34, nn is $1234, a
+# displacement is +$34 and a relative jump from address 0 lands on $0036
+OPERANDS = bytes([0x34, 0x12])
+
+# Opcode: (length, instruction) of the unprefixed 00-3F block
+MAIN_00_3F = {
+  0x00: (1, "nop"),            0x01: (3, "ld bc,$1234"),   0x02: (1, "ld (bc),a"),      0x03: (1, "inc bc"),
+  0x04: (1, "inc b"),          0x05: (1, "dec b"),         0x06: (2, "ld b,$34"),       0x07: (1, "rlca"),
+  0x08: (1, "ex af,af'"),      0x09: (1, "add hl,bc"),     0x0a: (1, "ld a,(bc)"),      0x0b: (1, "dec bc"),
+  0x0c: (1, "inc c"),          0x0d: (1, "dec c"),         0x0e: (2, "ld c,$34"),       0x0f: (1, "rrca"),
+  0x10: (2, "djnz $0036"),     0x11: (3, "ld de,$1234"),   0x12: (1, "ld (de),a"),      0x13: (1, "inc de"),
+  0x14: (1, "inc d"),          0x15: (1, "dec d"),         0x16: (2, "ld d,$34"),       0x17: (1, "rla"),
+  0x18: (2, "jr $0036"),       0x19: (1, "add hl,de"),     0x1a: (1, "ld a,(de)"),      0x1b: (1, "dec de"),
+  0x1c: (1, "inc e"),          0x1d: (1, "dec e"),         0x1e: (2, "ld e,$34"),       0x1f: (1, "rra"),
+  0x20: (2, "jr nz,$0036"),    0x21: (3, "ld hl,$1234"),   0x22: (3, "ld ($1234),hl"),  0x23: (1, "inc hl"),
+  0x24: (1, "inc h"),          0x25: (1, "dec h"),         0x26: (2, "ld h,$34"),       0x27: (1, "daa"),
+  0x28: (2, "jr z,$0036"),     0x29: (1, "add hl,hl"),     0x2a: (3, "ld hl,($1234)"),  0x2b: (1, "dec hl"),
+  0x2c: (1, "inc l"),          0x2d: (1, "dec l"),         0x2e: (2, "ld l,$34"),       0x2f: (1, "cpl"),
+  0x30: (2, "jr nc,$0036"),    0x31: (3, "ld sp,$1234"),   0x32: (3, "ld ($1234),a"),   0x33: (1, "inc sp"),
+  0x34: (1, "inc (hl)"),       0x35: (1, "dec (hl)"),      0x36: (2, "ld (hl),$34"),    0x37: (1, "scf"),
+  0x38: (2, "jr c,$0036"),     0x39: (1, "add hl,sp"),     0x3a: (3, "ld a,($1234)"),   0x3b: (1, "dec sp"),
+  0x3c: (1, "inc a"),          0x3d: (1, "dec a"),         0x3e: (2, "ld a,$34"),       0x3f: (1, "ccf"),
+}
+
+# Opcode: (length, instruction) of the 00-3F opcodes an index prefix
+# changes, "%s" is the index register. The prefix of any other opcode is
+# ignored by the Z80, and is disassembled as a data byte
+INDEX_00_3F = {
+  0x09: (2, "add %s,bc"),      0x19: (2, "add %s,de"),     0x21: (4, "ld %s,$1234"),    0x22: (4, "ld ($1234),%s"),
+  0x23: (2, "inc %s"),         0x24: (2, "inc %sh"),       0x25: (2, "dec %sh"),        0x26: (3, "ld %sh,$34"),
+  0x29: (2, "add %s,%s"),      0x2a: (4, "ld %s,($1234)"), 0x2b: (2, "dec %s"),         0x2c: (2, "inc %sl"),
+  0x2d: (2, "dec %sl"),        0x2e: (3, "ld %sl,$34"),    0x34: (3, "inc (%s+$34)"),   0x35: (3, "dec (%s+$34)"),
+  0x36: (4, "ld (%s+$34),$12"), 0x39: (2, "add %s,sp"),
+}
+
+
+def first_instruction(code):
+  _, length, text = next(z80dis.disassemble(code))
+  return (length, text)
+
+
+class MainBlockTest(unittest.TestCase):
+  def test_opcodes_00_3f(self):
+    for op in range(0x00, 0x40):
+      with self.subTest(opcode = "%.2x" % op):
+        self.assertEqual(first_instruction(bytes([op]) + OPERANDS), MAIN_00_3F[op])
+
+  def test_length_keeps_following_instructions_aligned(self):
+    for op in range(0x00, 0x40):
+      with self.subTest(opcode = "%.2x" % op):
+        length, _ = MAIN_00_3F[op]
+        code = bytes([op]) + OPERANDS[: length - 1] + bytes([0x00])
+        self.assertEqual(list(z80dis.disassemble(code))[-1], (length, 1, "nop"))
+
+
+class IndexBlockTest(unittest.TestCase):
+  def check_index_block(self, prefix, reg):
+    for op in range(0x00, 0x40):
+      with self.subTest(prefix = "%.2x" % prefix, opcode = "%.2x" % op):
+        code = bytes([prefix, op]) + OPERANDS
+        if op in INDEX_00_3F:
+          length, template = INDEX_00_3F[op]
+          self.assertEqual(first_instruction(code), (length, template.replace("%s", reg)))
+        else:
+          self.assertEqual(first_instruction(code), (1, "db $%.2x" % prefix))
+
+  def test_dd_opcodes_00_3f(self):
+    self.check_index_block(0xdd, "ix")
+
+  def test_fd_opcodes_00_3f(self):
+    self.check_index_block(0xfd, "iy")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -22,13 +22,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 ########################################################################
+import io
 import re
 import os
 import sys
 
+import tappipeline
+import tapprogram
+import tapstats
+
 
 block_id_registry = dict()
 
+# A TAP block length is 16 bits
+MAX_TAP_BLOCK_LENGTH = 0xffff
+
 
 def tzx_block(klass):
   global block_id_registry
@@ -37,6 +45,14 @@ def tzx_block(klass):
   return klass
 
 
+def tzx_text(text_bytes):
+  # TZX text should be ASCII, archive files are often Latin-1
+  try:
+    return text_bytes.decode('utf-8')
+  except UnicodeDecodeError:
+    return text_bytes.decode('latin-1')
+
+
 class TZXFileException(Exception):
   def __init__(self, tzx_file):
     super(TZXFileException, self).__init__()
@@ -58,6 +74,27 @@ class TXZBlockUnsupportedException(TZXFileException):
       (self.tzx_file, self.unsupported_block_id)
 
 
+class TZXBlockTruncatedException(TZXFileException):
+  def __init__(self, tzx_file, field, length, remaining):
+    super(TZXBlockTruncatedException, self).__init__(tzx_file)
+    self.field = field
+    self.length = length
+    self.remaining = remaining
+
+  def __str__(self):
+    return "[%s] is truncated, block field [%s] of length %d with %d bytes remaining" % \
+      (self.tzx_file, self.field, self.length, self.remaining)
+
+
+class TZXTurboBlockNotTapException(TZXFileException):
+  def __init__(self, tzx_file, reason):
+    super(TZXTurboBlockNotTapException, self).__init__(tzx_file)
+    self.reason = reason
+
+  def __str__(self):
+    return "[%s] contains a turbo speed data block that cannot be a TAP block, %s" % (self.tzx_file, self.reason)
+
+
 class TZXDataBlockIncorrectCountException(TZXFileException):
   def __init__(self, tzx_file, no_blocks):
     super(TZXDataBlockIncorrectCountException, self).__init__(tzx_file)
@@ -69,6 +106,8 @@ class TZXDataBlockIncorrectCountException(TZXFileException):
 
   
 class TZXBlock(object):
+  CHECKED_READ_LENGTH = 256
+
   def __init__(self, fd, attributes):
     for attr_name, no_bytes_or_callable in attributes:
       if callable(no_bytes_or_callable):
@@ -78,9 +117,25 @@ class TZXBlock(object):
           no_bytes_or_obj = no_bytes_or_callable()
       else:
         no_bytes_or_obj = no_bytes_or_callable
-      value = fd.read(no_bytes_or_obj) if isinstance(no_bytes_or_obj, int) else no_bytes_or_obj
+      if isinstance(no_bytes_or_obj, int):
+        value = TZXBlock.read(fd, attr_name, no_bytes_or_obj)
+      else:
+        value = no_bytes_or_obj
       setattr(self, attr_name, value)
 
+  @staticmethod
+  def read(fd, field, length):
+    # Only long fields can force a large allocation, short reads of small
+    # fields are caught once read
+    if length > TZXBlock.CHECKED_READ_LENGTH:
+      remaining = tapprogram.remaining_length(fd)
+      if remaining is not None and length > remaining:
+        raise TZXBlockTruncatedException(getattr(fd, 'name', '<memory>'), field, length, remaining)
+    value = fd.read(length)
+    if len(value) != length:
+      raise TZXBlockTruncatedException(getattr(fd, 'name', '<memory>'), field, length, len(value))
+    return value
+
 
 class TZXHeader(TZXBlock):
   def __init__(self, fd):
@@ -168,6 +223,80 @@ class TZXStandardSpeedDataBlock(TZXBlock):
     self.__block_data = bd
 
 
+@tzx_block
+class TZXTurboSpeedDataBlock(TZXStandardSpeedDataBlock):
+  BLOCK_ID = 0x11
+
+  def __init__(self, fd):
+    # The block data is read as for a standard speed block, after the timings
+    super(TZXStandardSpeedDataBlock, self).__init__(fd, [('pilot_pulse', 2),
+                                                         ('sync1_pulse', 2),
+                                                         ('sync2_pulse', 2),
+                                                         ('zero_pulse', 2),
+                                                         ('one_pulse', 2),
+                                                         ('pilot_pulses', 2),
+                                                         ('used_bits', 1),
+                                                         ('pause', 2),
+                                                         ('block_length', 3),
+                                                         ('block_data', lambda: self.block_length)])
+
+  @property
+  def pilot_pulse(self):
+    return self.__pilot_pulse
+
+  @pilot_pulse.setter
+  def pilot_pulse(self, value):
+    self.__pilot_pulse = int.from_bytes(value, byteorder = 'little')
+
+  @property
+  def sync1_pulse(self):
+    return self.__sync1_pulse
+
+  @sync1_pulse.setter
+  def sync1_pulse(self, value):
+    self.__sync1_pulse = int.from_bytes(value, byteorder = 'little')
+
+  @property
+  def sync2_pulse(self):
+    return self.__sync2_pulse
+
+  @sync2_pulse.setter
+  def sync2_pulse(self, value):
+    self.__sync2_pulse = int.from_bytes(value, byteorder = 'little')
+
+  @property
+  def zero_pulse(self):
+    return self.__zero_pulse
+
+  @zero_pulse.setter
+  def zero_pulse(self, value):
+    self.__zero_pulse = int.from_bytes(value, byteorder = 'little')
+
+  @property
+  def one_pulse(self):
+    return self.__one_pulse
+
+  @one_pulse.setter
+  def one_pulse(self, value):
+    self.__one_pulse = int.from_bytes(value, byteorder = 'little')
+
+  @property
+  def pilot_pulses(self):
+    return self.__pilot_pulses
+
+  @pilot_pulses.setter
+  def pilot_pulses(self, value):
+    self.__pilot_pulses = int.from_bytes(value, byteorder = 'little')
+
+  @property
+  def used_bits(self):
+    return self.__used_bits
+
+  @used_bits.setter
+  def used_bits(self, value):
+    self.__used_bits = int.from_bytes(value, byteorder = 'little')
+
+
 @tzx_block
 class TZXTextDescription(TZXBlock):
   BLOCK_ID = 0x30
@@ -190,7 +319,7 @@ class TZXTextDescription(TZXBlock):
 
   @description.setter
   def description(self, desc):
-    self.__description = desc.decode('utf-8')
+    self.__description = tzx_text(desc)
 
 
 @tzx_block
@@ -224,7 +353,7 @@ class TZXMessageBlock(TZXBlock):
 
   @message.setter
   def message(self, msg):
-    self.__message = msg.decode('utf-8')
+    self.__message = tzx_text(msg)
 
 
 @tzx_block
@@ -259,7 +388,7 @@ class TZXArchiveInfoBlock(TZXBlock):
 
     @text.setter
     def text(self, t):
-      self.__text = t.decode('utf-8')
+      self.__text = tzx_text(t)
 
   def __init__(self, fd):
     super(TZXArchiveInfoBlock, self).__init__(fd, [('length', 2),
@@ -432,58 +561,127 @@ class TZXGlueBlock(TZXBlock):
     return "%s v%d.%d" % (self.signature, self.tzx_major_version, self.tzx_minor_version)
 
 
-def tzx_parse(tzx_fd):
-  hdr = TZXHeader(tzx_fd)
-  blocks = [hdr]
+def tzx_blocks(tzx_fd):
+  """Yields the TZX header then each block as it is read.
+
+  An unsupported block is yielded as its integer block ID and ends the stream.
+  """
+  yield TZXHeader(tzx_fd)
   block_id = tzx_fd.read(1)
   while block_id:
     if block_id in block_id_registry:
       klass = block_id_registry[block_id]
-      block = klass(tzx_fd)
-      blocks.append(block)
+      yield klass(tzx_fd)
       block_id = tzx_fd.read(1)
     else:
-      blocks.append(int.from_bytes(block_id, byteorder = 'little'))
+      yield int.from_bytes(block_id, byteorder = 'little')
       block_id = None
 
-  return blocks
+
+def tzx_parse(tzx_fd):
+  return list(tzx_blocks(tzx_fd))
+
+
+def tzx_block_pairs(tzx_fd, tzx_file = None, info_blocks = None):
+  """Yields (header block, data block) for each pair of standard speed data blocks in a TZX stream.
+
+  Blocks are read as the pairs are consumed, only a header block waiting
+  for its data block is held, so concatenated TZX files of any size can be
+  converted. Blocks that are not data or glue blocks, such as archive
+  info, are appended to info_blocks if it is given.
+  """
+  tzx_file = tzx_file if tzx_file else getattr(tzx_fd, 'name', '<memory>')
+  blocks = tzx_blocks(tzx_fd)
+  hdr = next(blocks)
+  if not hdr.is_valid:
+    raise TZXFileNotValidException(tzx_file)
+  no_data_blocks = 0
+  tzx_hdr = None
+  for block in blocks:
+    if isinstance(block, int):
+      raise TXZBlockUnsupportedException(tzx_file, block)
+    if isinstance(block, TZXGlueBlock):
+      if not block.is_valid:
+        raise TZXFileNotValidException(tzx_file)
+    elif isinstance(block, TZXStandardSpeedDataBlock):
+      no_data_blocks += 1
+      if tzx_hdr is None:
+        tzx_hdr = block
+      else:
+        yield (tzx_hdr, block)
+        tzx_hdr = None
+    elif info_blocks is not None:
+      info_blocks.append(block)
+  if tzx_hdr is not None:
+    raise TZXDataBlockIncorrectCountException(tzx_file, no_data_blocks)
+
+
+def check_tap_block(tzx_file, block):
+  # A turbo speed block can be longer than a TAP block, or end part way
+  # through a byte
+  if isinstance(block, TZXTurboSpeedDataBlock):
+    if len(block.block_data) > MAX_TAP_BLOCK_LENGTH:
+      raise TZXTurboBlockNotTapException(tzx_file, "its length %d is longer than %d bytes" % \
+                                         (len(block.block_data), MAX_TAP_BLOCK_LENGTH))
+    if block.used_bits != 8:
+      raise TZXTurboBlockNotTapException(tzx_file, "only %d bits of its last byte are used" % block.used_bits)
+
+
+def tzx_programs(tzx_fd, tzx_file = None, info_blocks = None):
+  """Yields a tapprogram.Program for each header/data block pair in a TZX stream."""
+  tzx_file = tzx_file if tzx_file else getattr(tzx_fd, 'name', '<memory>')
+  for tzx_hdr, tzx_data in tzx_block_pairs(tzx_fd, tzx_file, info_blocks):
+    for block in (tzx_hdr, tzx_data):
+      check_tap_block(tzx_file, block)
+    yield tapprogram.Program(tzx_hdr.block_data, tzx_data.block_data)
+
+
+def tap_filename(tap_names, program):
+  tap_name = program.header[2:12].decode('utf-8').strip().upper()[:8]
+  if tap_name in tap_names:
+    tap_idx = tap_names[tap_name]
+    tap_idx += 1
+    tap_names[tap_name] = tap_idx
+    tap_idx_s = "_%d" % tap_idx
+    tap_name = tap_name[0:8 - len(tap_idx_s)] + tap_idx_s
+  else:
+    tap_names[tap_name] = 1
+  return re.sub(r'[\\/:\*"<>|?\.]', "_", tap_name) + '.TAP'
+
+
+def tzx_convert_bytes(tzx_bytes):
+  """Converts TZX file contents, returns a list of (TAP filename, TAP bytes) pairs."""
+  tap_names = dict()
+  return [(tap_filename(tap_names, program), program.tap_bytes) \
+          for program in tzx_programs(io.BytesIO(tzx_bytes))]
 
 
 def tzx_convert(tzx_file, tap_dir):
-  with open(tzx_file, 'rb') as tzx_fd:
-    tzx_blocks = tzx_parse(tzx_fd)
-    if not len(tzx_blocks) or not isinstance(tzx_blocks[0], TZXHeader) or not tzx_blocks[0].is_valid:
-      raise TZXFileNotValidException(tzx_file)
-    tzx_unsupported_blocks = list(filter(lambda blk: isinstance(blk, int), tzx_blocks))
-    if len(tzx_unsupported_blocks):
-      raise TXZBlockUnsupportedException(tzx_file, tzx_unsupported_blocks[0])
-    tzx_data_blocks = list(filter(lambda blk: isinstance(blk, TZXStandardSpeedDataBlock),
-                                  tzx_blocks))
-    if len(tzx_data_blocks) % 2:
-      raise TZXDataBlockIncorrectCountException(tzx_file, len(tzx_data_blocks))
-    tzx_data_block_pairs = [(tzx_data_blocks[i], tzx_data_blocks[i+1]) \
-                            for i in range(0, len(tzx_data_blocks) - 1, 2)]
-    tap_names = dict()
-    for tzx_hdr, tzx_data in tzx_data_block_pairs:
-      tap_name = tzx_hdr.block_data[2:12].decode('utf-8').strip().upper()[:8]
-      if tap_name in tap_names:
-        tap_idx = tap_names[tap_name]
-        tap_idx += 1
-        tap_names[tap_name] = tap_idx
-        tap_idx_s = "_%d" % tap_idx
-        tap_name = tap_name[0:8 - len(tap_idx_s)] + tap_idx_s
-      else:
-        tap_names[tap_name] = 1
-      tap_filename = re.sub(r'[\\/:\*"<>|?\.]', "_", tap_name) + '.TAP'
-      tap_pathname = os.path.join(tap_dir, tap_filename)
-      print(os.path.basename(tzx_file), file = sys.stderr)
-      print("  +--> Found header block of length %d bytes" % tzx_hdr.block_length, file = sys.stderr)
-      print("  +--> Found data block of length %d bytes" % tzx_data.block_length, file = sys.stderr)
-      with open(tap_pathname, 'wb') as tap_fd:
-        tap_fd.write(tzx_hdr.block_length_bytes)
-        tap_fd.write(tzx_hdr.block_data)
-        tap_fd.write(tzx_data.block_length_bytes)
-        tap_fd.write(tzx_data.block_data)
+  tap_pathnames = list()
+  try:
+    with tapstats.STATS.phase('file', file = tzx_file), open(tzx_file, 'rb') as tzx_fd:
+      tap_names = dict()
+      programs = tzx_programs(tzx_fd, tzx_file)
+      while True:
+        with tapstats.STATS.phase('parse', file = tzx_file):
+          program = next(programs, None)
+        if program is None:
+          break
+        tap_pathname = os.path.join(tap_dir, tap_filename(tap_names, program))
+        print(os.path.basename(tzx_file), file = sys.stderr)
+        print("  +--> Found header block of length %d bytes" % len(program.header), file = sys.stderr)
+        print("  +--> Found data block of length %d bytes" % len(program.data), file = sys.stderr)
+        with tapstats.STATS.phase('write', file = tap_pathname), open(tap_pathname, 'wb') as tap_fd:
+          tap_pathnames.append(tap_pathname)
+          tap_bytes = program.tap_bytes
+          tap_fd.write(tap_bytes)
+        tapstats.STATS.count(bytes = len(tap_bytes), blocks = 2)
+      tapstats.STATS.count(files = 1)
+  except TZXFileException as ex:
+    # Programs are written as they are found, remove them if the TZX file is bad
+    for tap_pathname in tap_pathnames:
+      os.remove(tap_pathname)
+    raise ex
 
 
 def tzx_to_tap(tzx_files, root_dir, force):
@@ -491,7 +689,8 @@ def tzx_to_tap(tzx_files, root_dir, force):
     tap_dirname, _ = os.path.splitext(os.path.basename(tzx_file))
     tap_dirname = tap_dirname[:8].upper()
     tap_dir = os.path.realpath(os.path.join(root_dir, tap_dirname))
-    if os.path.exists(tap_dir):
+    is_new_tap_dir = not os.path.exists(tap_dir)
+    if not is_new_tap_dir:
       if not force:
         print("%s: TAP directory [%s] exists" % (os.path.realpath(tzx_file), tap_dir),
               file = sys.stderr)
@@ -502,18 +701,55 @@ def tzx_to_tap(tzx_files, root_dir, force):
     try:
       tzx_convert(tzx_file, tap_dir)
     except TZXFileException as ex:
-      os.rmdir(tap_dir)
+      if is_new_tap_dir:
+        os.rmdir(tap_dir)
       raise ex
-    
+  return True
 
-if __name__ == '__main__':
+
+def tzx_to_tap_pipelined(tzx_files, root_dir, force, inflight):
+  def read(tzx_file):
+    with open(tzx_file, 'rb') as tzx_fd:
+      return tzx_fd.read()
+
+  def convert(tzx_file, tzx_bytes):
+    tap_dirname, _ = os.path.splitext(os.path.basename(tzx_file))
+    tap_dir = os.path.realpath(os.path.join(root_dir, tap_dirname[:8].upper()))
+    if os.path.exists(tap_dir) and not force:
+      raise FileExistsError("TAP directory [%s] exists" % tap_dir)
+    taps = tzx_convert_bytes(tzx_bytes)
+    # Files converted at the same time may share a TAP directory name, only
+    # the first to create the directory has it unless forced
+    try:
+      os.mkdir(tap_dir)
+    except FileExistsError:
+      if not force:
+        raise FileExistsError("TAP directory [%s] exists" % tap_dir)
+    print(os.path.basename(tzx_file), file = sys.stderr)
+    for tap_filename, tap_bytes in taps:
+      print("  +--> Found program of length %d bytes, writing [%s]" % (len(tap_bytes), tap_filename),
+            file = sys.stderr)
+    tapstats.STATS.count(bytes = sum(map(lambda tap: len(tap[1]), taps)), blocks = 2 * len(taps), files = 1)
+    return [(os.path.join(tap_dir, tap_filename), tap_bytes) for tap_filename, tap_bytes in taps]
+
+  def write(tzx_file, tap):
+    with open(tap[0], 'wb') as tap_fd:
+      tap_fd.write(tap[1])
+
+  errors = tappipeline.pipeline(tzx_files, read, convert, write, inflight)
+  for tzx_file, ex in errors:
+    print("%s: %s" % (os.path.realpath(tzx_file), ex), file = sys.stderr)
+  return not errors
+
+
+def main(argv = None, prog = "tzx2tap.py"):
   import argparse
 
   __VERSION = "2.0.0"
 
   default_root_dir = os.path.realpath(".")
 
-  parser = argparse.ArgumentParser(prog = "tzx2tap.py",
+  parser = argparse.ArgumentParser(prog = prog,
                                    description = "Converts a TZX files to TAP files for use with the Jester Ace (v%s)." % __VERSION)
   parser.add_argument('-f', '--force',
                       dest = 'force',
@@ -524,12 +760,26 @@ if __name__ == '__main__':
                       dest = 'root_dir',
                       default = default_root_dir,
                       help = 'Directory to which the TAP directory structure will be written (default: %s)' % default_root_dir)
+  parser.add_argument('-j', '--inflight',
+                      type = int,
+                      dest = 'inflight',
+                      default = 1,
+                      help = 'Number of TZX files read, converted and written concurrently (default: 1)')
   parser.add_argument('tzx_file',
                       type = str,
                       nargs = '+',
                       default = '',
                       help = 'TZX file to convert')
-  args = parser.parse_args()
+  tapstats.add_arguments(parser)
+  args = parser.parse_args(argv)
+  tapstats.start(args)
 
-  rc = tzx_to_tap(args.tzx_file, args.root_dir, args.force)
-  sys.exit(not rc)
+  if args.inflight > 1:
+    rc = tzx_to_tap_pipelined(args.tzx_file, args.root_dir, args.force, args.inflight)
+  else:
+    rc = tzx_to_tap(args.tzx_file, args.root_dir, args.force)
+  return rc
+
+
+if __name__ == '__main__':
+  sys.exit(not main())
@@ -0,0 +1,350 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import os
+import sys
+import wave
+
+import acetape
+import tapprogram
+
+
+CHUNK_FRAMES = 1 << 16
+MIN_PILOT_PULSES = 64
+MAX_BLOCK_LENGTH = 0xffff
+SILENCE_MS = 100
+
+# Pulse classification boundaries, in T-states
+SYNC1_MAX = (acetape.SYNC1_PULSE + acetape.SYNC2_PULSE) // 2
+ONE_MIN = (acetape.ZERO_PULSE + acetape.ONE_PULSE) // 2
+PILOT_MIN = (acetape.ONE_PULSE + acetape.PILOT_PULSE) // 2
+PILOT_MAX = acetape.PILOT_PULSE + (acetape.PILOT_PULSE - acetape.ONE_PULSE)
+
+LOW = 0
+HIGH = 1
+DEAD = 2
+
+
+class WavFormatException(Exception):
+  def __init__(self, wav_file, reason):
+    super(WavFormatException, self).__init__()
+    self.wav_file = os.path.realpath(wav_file)
+    self.reason = reason
+
+  def __str__(self):
+    return "[%s] %s" % (self.wav_file, self.reason)
+
+
+def level_table(sample_width, threshold):
+  # Maps the most significant byte of a sample to LOW, HIGH or DEAD. The
+  # dead zone between -threshold and +threshold gives the edge detector
+  # hysteresis, so noise around zero does not produce spurious pulses.
+  table = bytearray(256)
+  for b in range(0, 256):
+    if sample_width == 1:
+      value = b - 128
+    else:
+      value = b if b < 128 else b - 256
+    if value > threshold:
+      table[b] = HIGH
+    elif value < -threshold:
+      table[b] = LOW
+    else:
+      table[b] = DEAD
+  return bytes(table)
+
+
+class EdgeDetector(object):
+  def __init__(self, sample_width, channels, threshold):
+    self.__table = level_table(sample_width, threshold)
+    self.__msb = sample_width - 1
+    self.__stride = sample_width * channels
+    self.__level = None
+    self.__last_edge = 0
+    self.__sample = 0
+
+  @property
+  def sample(self):
+    return self.__sample
+
+  def feed(self, frames):
+    # Reduce each frame of the first channel to a level byte using the
+    # C level slice and translate, then hop between edges with find.
+    levels = frames[self.__msb::self.__stride].translate(self.__table)
+    base = self.__sample
+    pos = 0
+    if self.__level is None:
+      hi = levels.find(b'\x01')
+      lo = levels.find(b'\x00')
+      found = [p for p in (hi, lo) if p >= 0]
+      if found:
+        pos = min(found)
+        self.__level = levels[pos]
+        self.__last_edge = base + pos
+    if self.__level is not None:
+      while True:
+        pos = levels.find(b'\x00' if self.__level == HIGH else b'\x01', pos)
+        if pos < 0:
+          break
+        edge = base + pos
+        yield edge - self.__last_edge
+        self.__last_edge = edge
+        self.__level ^= 1
+    self.__sample = base + len(levels)
+
+  @property
+  def last_edge(self):
+    return self.__last_edge
+
+  @property
+  def samples_since_edge(self):
+    return self.__sample - self.__last_edge
+
+
+class PulseDecoder(object):
+  IDLE, PILOT, SYNC2, DATA = range(0, 4)
+
+  def __init__(self):
+    self.__reset()
+
+  def __reset(self):
+    self.__state = PulseDecoder.IDLE
+    self.__pilot_count = 0
+    self.__first_half = None
+    self.__bits = 0
+    self.__bit_count = 0
+    self.__bytes = bytearray()
+
+  def __end_block(self):
+    block = bytes(self.__bytes)
+    self.__reset()
+    return block if block else None
+
+  def feed(self, pulse):
+    state = self.__state
+    if state == PulseDecoder.DATA:
+      if pulse >= PILOT_MIN:
+        block = self.__end_block()
+        if pulse <= PILOT_MAX:
+          self.__pilot_count = 1
+        return block
+      if self.__first_half is None:
+        self.__first_half = pulse
+        return None
+      bit = 1 if self.__first_half + pulse >= 2 * ONE_MIN else 0
+      self.__first_half = None
+      self.__bits = (self.__bits << 1) | bit
+      self.__bit_count += 1
+      if self.__bit_count == 8:
+        self.__bytes.append(self.__bits)
+        self.__bits = 0
+        self.__bit_count = 0
+        # A TAP block length is 16 bits, end blocks that would not fit
+        if len(self.__bytes) == MAX_BLOCK_LENGTH:
+          return self.__end_block()
+      return None
+    if state == PulseDecoder.SYNC2:
+      self.__state = PulseDecoder.DATA if SYNC1_MAX <= pulse < ONE_MIN else PulseDecoder.IDLE
+      return None
+    if PILOT_MIN <= pulse <= PILOT_MAX:
+      self.__pilot_count += 1
+      if self.__pilot_count >= MIN_PILOT_PULSES:
+        self.__state = PulseDecoder.PILOT
+    elif state == PulseDecoder.PILOT and pulse < SYNC1_MAX:
+      self.__state = PulseDecoder.SYNC2
+    else:
+      self.__state = PulseDecoder.IDLE
+      self.__pilot_count = 0
+    return None
+
+  def silence(self):
+    # A gap with no edges, or the end of the recording, ends whatever block
+    # is in progress
+    if self.__state != PulseDecoder.DATA:
+      return None
+    if self.__first_half is not None:
+      # The second half of the last bit has no edge to end it, so it is
+      # never measured. Both halves of a bit are the same length.
+      block = self.feed(self.__first_half)
+      if block:
+        return block
+    return self.__end_block()
+
+
+def wav_open(wav_file):
+  try:
+    wav = wave.open(wav_file, 'rb')
+  except (wave.Error, EOFError) as ex:
+    raise WavFormatException(wav_file, "is not a valid WAV file (%s)" % ex)
+  if wav.getcomptype() != 'NONE':
+    wav.close()
+    raise WavFormatException(wav_file, "is compressed, only PCM WAV files are supported")
+  return wav
+
+
+def wav_blocks(wav_file, threshold, start = 0, end = None):
+  """Yields the tape blocks in frames [start, end) of a WAV file."""
+  wav = wav_open(wav_file)
+  try:
+    rate = wav.getframerate()
+    sample_width = wav.getsampwidth()
+    end = wav.getnframes() if end is None else end
+    detector = EdgeDetector(sample_width, wav.getnchannels(),
+                            int(threshold * (128 if sample_width == 1 else 127) / 100))
+    decoder = PulseDecoder()
+    tstates_per_sample = acetape.ACE_CLOCK_HZ / rate
+    silence_samples = rate * SILENCE_MS // 1000
+    wav.setpos(start)
+    remaining = end - start
+    while remaining > 0:
+      frames = wav.readframes(min(CHUNK_FRAMES, remaining))
+      if not frames:
+        break
+      remaining -= len(frames) // (sample_width * wav.getnchannels())
+      for pulse in detector.feed(frames):
+        block = decoder.feed(pulse * tstates_per_sample)
+        if block:
+          yield block
+      if detector.samples_since_edge > silence_samples:
+        block = decoder.silence()
+        if block:
+          yield block
+    block = decoder.silence()
+    if block:
+      yield block
+  finally:
+    wav.close()
+
+
+def find_silence(wav_file, frame, threshold):
+  """Returns a frame, at or after frame, in the middle of a silence."""
+  wav = wav_open(wav_file)
+  try:
+    sample_width = wav.getsampwidth()
+    detector = EdgeDetector(sample_width, wav.getnchannels(),
+                            int(threshold * (128 if sample_width == 1 else 127) / 100))
+    silence_samples = wav.getframerate() * SILENCE_MS // 1000
+    wav.setpos(frame)
+    while True:
+      frames = wav.readframes(CHUNK_FRAMES)
+      if not frames:
+        return wav.getnframes()
+      for pulse in detector.feed(frames):
+        if pulse > silence_samples:
+          return frame + detector.last_edge + pulse // 2
+      if detector.samples_since_edge > silence_samples:
+        return frame + detector.last_edge + silence_samples // 2
+  finally:
+    wav.close()
+
+
+def wav_segment_blocks(wav_file, threshold, start, end):
+  return list(wav_blocks(wav_file, threshold, start, end))
+
+
+def wav_split_points(wav_file, jobs, threshold):
+  wav = wav_open(wav_file)
+  no_frames = wav.getnframes()
+  wav.close()
+  points = [0]
+  for job in range(1, jobs):
+    point = max(find_silence(wav_file, no_frames * job // jobs, threshold), points[-1])
+    points.append(point)
+  points.append(no_frames)
+  return [(points[i], points[i + 1]) for i in range(0, jobs) if points[i] < points[i + 1]]
+
+
+def wav_to_tap(wav_file, tap_file, threshold, jobs):
+  if jobs > 1:
+    import concurrent.futures
+    segments = wav_split_points(wav_file, jobs, threshold)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs)
+    futures = [executor.submit(wav_segment_blocks, wav_file, threshold, start, end) \
+               for start, end in segments]
+    blocks = (block for future in futures for block in future.result())
+  else:
+    executor = None
+    blocks = wav_blocks(wav_file, threshold)
+
+  print(os.path.basename(wav_file), file = sys.stderr)
+  no_blocks = 0
+  no_errors = 0
+  try:
+    with open(tap_file, 'wb') as tap_fd:
+      for block in blocks:
+        kind = "header" if block[0] == acetape.HEADER_FLAG else "data"
+        print("  +--> Found %s block of length %d bytes" % (kind, len(block)),
+              file = sys.stderr,
+              end = "")
+        valid_chksum = tapprogram.valid_checksum(block, True)
+        if not valid_chksum[0]:
+          no_errors += 1
+          print(", CRC ERROR (checksum [%.2x], expected [%.2x])" % (valid_chksum[1], valid_chksum[2]),
+                file = sys.stderr,
+                end = "")
+        print(file = sys.stderr)
+        tap_fd.write(len(block).to_bytes(2, 'little'))
+        tap_fd.write(block)
+        no_blocks += 1
+  finally:
+    if executor:
+      executor.shutdown()
+  return no_blocks > 0 and no_errors == 0
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_threshold = 5
+  default_jobs = 1
+
+  parser = argparse.ArgumentParser(prog = "wav2tap.py",
+                                   description = "Decodes a Jupiter Ace cassette recording to a TAP file (v%s)." % __VERSION)
+  parser.add_argument('-o', '--output',
+                      type = str,
+                      required = True,
+                      dest = 'tap_output',
+                      help = "Output TAP file")
+  parser.add_argument('-t', '--threshold',
+                      type = int,
+                      dest = 'threshold',
+                      default = default_threshold,
+                      help = "Edge detection dead zone as a percentage of full scale (default: %d%%)" % default_threshold)
+  parser.add_argument('-j', '--jobs',
+                      type = int,
+                      dest = 'jobs',
+                      default = default_jobs,
+                      help = "Number of processes, long recordings are split at silences (default: %d)" % default_jobs)
+  parser.add_argument('wav_file',
+                      type = str,
+                      help = "WAV recording to decode")
+  args = parser.parse_args()
+
+  try:
+    rc = wav_to_tap(args.wav_file, args.tap_output, args.threshold, args.jobs)
+  except WavFormatException as ex:
+    print(ex, file = sys.stderr)
+    rc = False
+  sys.exit(not rc)
@@ -0,0 +1,250 @@
+#! /usr/bin/env python3
+########################################################################
+# MIT License
+#
+# Copyright (C) 2021-2022 Ian Johnson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+########################################################################
+import os
+import sys
+
+
+# Each table entry is (template, operands). The template is a %-format
+# string and operands lists the operand bytes that follow the opcode:
+#   'n'  8 bit immediate        'nn' 16 bit immediate
+#   'e'  relative jump          'd'  index register displacement
+# A None entry is an opcode that is not an instruction on its own page.
+R = ["b", "c", "d", "e", "h", "l", "(hl)", "a"]
+RP = ["bc", "de", "hl", "sp"]
+RP2 = ["bc", "de", "hl", "af"]
+CC = ["nz", "z", "nc", "c", "po", "pe", "p", "m"]
+ALU = ["add a,", "adc a,", "sub ", "sbc a,", "and ", "xor ", "or ", "cp "]
+ROT = ["rlc", "rrc", "rl", "rr", "sla", "sra", "sll", "srl"]
+IM = ["0", "0", "1", "2", "0", "0", "1", "2"]
+BLOCK = [["ldi", "cpi", "ini", "outi"], ["ldd", "cpd", "ind", "outd"],
+         ["ldir", "cpir", "inir", "otir"], ["lddr", "cpdr", "indr", "otdr"]]
+PREFIXES = (0xcb, 0xdd, 0xed, 0xfd)
+
+
+def _main_entry(op, hl):
+  # Decodes an unprefixed opcode, with HL, H, L and (HL) replaced by the
+  # index register when hl is "ix" or "iy"
+  x, y, z = op >> 6, (op >> 3) & 7, op & 7
+  p, q = y >> 1, y & 1
+  idx = hl != "hl"
+  mem = "(%s%%s)" % hl if idx else "(hl)"
+  mem_ops = ('d',) if idx else ()
+  r = R[:4] + ([hl + "h", hl + "l"] if idx else ["h", "l"]) + [mem, "a"]
+  rp = RP[:2] + [hl, "sp"]
+  rp2 = RP2[:2] + [hl, "af"]
+  if x == 0:
+    if z == 0:
+      return [("nop", ()), ("ex af,af'", ()), ("djnz %s", ('e',)), ("jr %s", ('e',))][y] if y < 4 \
+             else ("jr %s,%%s" % CC[y - 4], ('e',))
+    if z == 1:
+      return ("add %s,%s" % (hl, rp[p]), ()) if q else ("ld %s,%%s" % rp[p], ('nn',))
+    if z == 2:
+      return [("ld (bc),a", ()), ("ld a,(bc)", ()), ("ld (de),a", ()), ("ld a,(de)", ()),
+              ("ld (%%s),%s" % hl, ('nn',)), ("ld %s,(%%s)" % hl, ('nn',)), ("ld (%s),a", ('nn',)),
+              ("ld a,(%s)", ('nn',))][y]
+    if z == 3:
+      return ("%s %s" % ("dec" if q else "inc", rp[p]), ())
+    if z == 4 or z == 5:
+      return ("%s %s" % ("inc" if z == 4 else "dec", r[y]), mem_ops if y == 6 else ())
+    if z == 6:
+      return ("ld %s,%%s" % r[y], (mem_ops if y == 6 else ()) + ('n',))
+    return (["rlca", "rrca", "rla", "rra", "daa", "cpl", "scf", "ccf"][y], ())
+  if x == 1:
+    if y == 6 and z == 6:
+      return ("halt", ())
+    # H and L are not replaced when the other operand is (IX+d)
+    if y == 6 or z == 6:
+      return ("ld %s,%s" % ((R if z == 6 else r)[y], (R if y == 6 else r)[z]), mem_ops)
+    return ("ld %s,%s" % (r[y], r[z]), ())
+  if x == 2:
+    return ("%s%s" % (ALU[y], r[z]), mem_ops if z == 6 else ())
+  if z == 0:
+    return ("ret %s" % CC[y], ())
+  if z == 1:
+    return ("pop %s" % rp2[p], ()) if not q else \
+           [("ret", ()), ("exx", ()), ("jp (%s)" % hl, ()), ("ld sp,%s" % hl, ())][p]
+  if z == 2:
+    return ("jp %s,%%s" % CC[y], ('nn',))
+  if z == 3:
+    return [("jp %s", ('nn',)), None, ("out (%s),a", ('n',)), ("in a,(%s)", ('n',)),
+            ("ex (sp),%s" % hl, ()), ("ex de,hl", ()), ("di", ()), ("ei", ())][y]
+  if z == 4:
+    return ("call %s,%%s" % CC[y], ('nn',))
+  if z == 5:
+    return ("push %s" % rp2[p], ()) if not q else (("call %s", ('nn',)) if p == 0 else None)
+  if z == 6:
+    return ("%s%%s" % ALU[y], ('n',))
+  return ("rst $%.2x" % (y * 8), ())
+
+
+def _cb_entry(op, reg = None):
+  # Decodes a CB prefixed opcode, or a DDCB/FDCB opcode when reg is "ix" or "iy"
+  x, y, z = op >> 6, (op >> 3) & 7, op & 7
+  operand = "(%s%%s)" % reg if reg else R[z]
+  # Undocumented DDCB forms also copy the result to a register
+  copy = "," + R[z] if reg and z != 6 and x != 1 else ""
+  operands = ('d',) if reg else ()
+  if x == 0:
+    return ("%s %s%s" % (ROT[y], operand, copy), operands)
+  return ("%s %d,%s%s" % (["bit", "res", "set"][x - 1], y, operand, copy), operands)
+
+
+def _ed_entry(op):
+  x, y, z = op >> 6, (op >> 3) & 7, op & 7
+  p, q = y >> 1, y & 1
+  if x == 1:
+    if z == 0:
+      return ("in %s,(c)" % R[y], ()) if y != 6 else ("in (c)", ())
+    if z == 1:
+      return ("out (c),%s" % R[y], ()) if y != 6 else ("out (c),0", ())
+    if z == 2:
+      return ("%s hl,%s" % ("adc" if q else "sbc", RP[p]), ())
+    if z == 3:
+      return ("ld %s,(%%s)" % RP[p], ('nn',)) if q else ("ld (%%s),%s" % RP[p], ('nn',))
+    if z == 4:
+      return ("neg", ())
+    if z == 5:
+      return ("reti" if y == 1 else "retn", ())
+    if z == 6:
+      return ("im %s" % IM[y], ())
+    return (["ld i,a", "ld r,a", "ld a,i", "ld a,r", "rrd", "rld"][y], ()) if y < 6 else None
+  if x == 2 and z <= 3 and y >= 4:
+    return (BLOCK[y - 4][z], ())
+  return None
+
+
+def _index_table(reg):
+  # An index prefix only changes instructions that use HL, otherwise the
+  # prefix is ignored by the Z80 and is shown as a data byte
+  return [None if op in PREFIXES or _main_entry(op, reg) == _main_entry(op, "hl") else _main_entry(op, reg) \
+          for op in range(0, 256)]
+
+
+MAIN = [None if op in PREFIXES else _main_entry(op, "hl") for op in range(0, 256)]
+CB = [_cb_entry(op) for op in range(0, 256)]
+ED = [_ed_entry(op) for op in range(0, 256)]
+DD = _index_table("ix")
+FD = _index_table("iy")
+DDCB = [_cb_entry(op, "ix") for op in range(0, 256)]
+FDCB = [_cb_entry(op, "iy") for op in range(0, 256)]
+OPERAND_LENGTHS = {(): 0, ('n',): 1, ('e',): 1, ('d',): 1, ('nn',): 2, ('d', 'n'): 2}
+
+BYTE_STRINGS = ["$%.2x" % b for b in range(0, 256)]
+DISPLACEMENT_STRINGS = ["+$%.2x" % d for d in range(0, 128)] + ["-$%.2x" % (256 - d) for d in range(128, 256)]
+
+
+def _decode(code, idx):
+  # Returns (entry, opcode length) for the instruction at idx
+  op = code[idx]
+  if op == 0xcb:
+    return (CB[code[idx + 1]], 2) if idx + 1 < len(code) else (None, 1)
+  if op == 0xed:
+    return (ED[code[idx + 1]], 2) if idx + 1 < len(code) else (None, 1)
+  if op == 0xdd or op == 0xfd:
+    if idx + 1 >= len(code):
+      return (None, 1)
+    if code[idx + 1] == 0xcb:
+      # DD CB d op, the displacement comes before the opcode so the
+      # opcode length of 3 counts the prefixes and the opcode
+      if idx + 3 >= len(code):
+        return (None, 1)
+      return ((DDCB if op == 0xdd else FDCB)[code[idx + 3]], 3)
+    return ((DD if op == 0xdd else FD)[code[idx + 1]], 2)
+  return (MAIN[op], 1)
+
+
+def disassemble(code, origin = 0):
+  """Yields (address, length, instruction) for each instruction in code.
+
+  Bytes that do not start an instruction, or an instruction cut short by
+  the end of code, are yielded one at a time as "db" directives.
+  """
+  idx = 0
+  code_length = len(code)
+  while idx < code_length:
+    entry, op_length = _decode(code, idx)
+    if entry is not None:
+      template, operands = entry
+      length = op_length + OPERAND_LENGTHS[operands]
+      if idx + length > code_length:
+        entry = None
+    if entry is None:
+      yield (origin + idx, 1, "db " + BYTE_STRINGS[code[idx]])
+      idx += 1
+      continue
+    if not operands:
+      text = template
+    elif op_length == 3:
+      text = template % DISPLACEMENT_STRINGS[code[idx + 2]]
+    else:
+      pos = idx + op_length
+      values = list()
+      for operand in operands:
+        if operand == 'n':
+          values.append(BYTE_STRINGS[code[pos]])
+        elif operand == 'd':
+          values.append(DISPLACEMENT_STRINGS[code[pos]])
+        elif operand == 'e':
+          offset = code[pos] if code[pos] < 128 else code[pos] - 256
+          values.append("$%.4x" % ((origin + idx + length + offset) & 0xffff))
+        else:
+          values.append("$%.4x" % (code[pos] | (code[pos + 1] << 8)))
+          pos += 1
+        pos += 1
+      text = template % tuple(values)
+    yield (origin + idx, length, text)
+    idx += length
+
+
+def listing(code, origin = 0):
+  """Returns the lines of an assembler listing of code."""
+  return ["%.4x  %-12s %s" % (addr, ' '.join(BYTE_STRINGS[b][1:] for b in code[addr - origin : addr - origin + length]), text) \
+          for addr, length, text in disassemble(code, origin)]
+
+
+if __name__ == '__main__':
+  import argparse
+
+  __VERSION = "1.0.0"
+  default_origin = 0x4000
+
+  parser = argparse.ArgumentParser(prog = "z80dis.py",
+                                   description = "Disassemble a Z80 binary file (v%s)." % __VERSION)
+  parser.add_argument('-a', '--address',
+                      type = lambda s: int(s, 0),
+                      dest = 'origin',
+                      default = default_origin,
+                      help = "Address of the first byte of the file (default: %d)" % default_origin)
+  parser.add_argument('bin_file',
+                      type = str,
+                      help = "Binary file to disassemble")
+  args = parser.parse_args()
+
+  if not os.path.exists(args.bin_file):
+    print("Binary file [%s] does not exist" % args.bin_file, file = sys.stderr)
+    sys.exit(1)
+  with open(args.bin_file, 'rb') as bin_fd:
+    for line in listing(bin_fd.read(), args.origin):
+      print(line)